@@ -4,7 +4,9 @@ Copyright (C) 2023 Martin J Levy - W6LHI/G8LHI - @mahtin - https://github.com/ma
 """
 
 from .es100 import ES100, ES100Error
+from .history import History
+from .clockstep import ClockStep
 
 __version__ = '0.4.4'
 
-__all__ = ['ES100', 'ES100Error']
+__all__ = ['ES100', 'ES100Error', 'History', 'ClockStep']
@@ -0,0 +1,83 @@
+""" Notice when the system clock is stepped; using timestamps taken as CLOCK_REALTIME/CLOCK_MONOTONIC pairs
+
+Copyright (C) 2023 Martin J Levy - W6LHI/G8LHI - @mahtin - https://github.com/mahtin
+
+ntpd, chronyd, date(1) or a leap second can step the system clock at any time; including in the
+middle of a 134 second reception or while waiting for HH:MM:55. Slewing (adjtime() or a frequency
+change) moves CLOCK_REALTIME and CLOCK_MONOTONIC together; a step only moves CLOCK_REALTIME.
+Hence the difference between the two, from a pair of readings taken back to back, only changes
+when the clock is stepped:
+
+    step        (realtime - monotonic) now minus (realtime - monotonic) then
+    restated    monotonic then + (realtime - monotonic) now; i.e. an old timestamp on today's clock
+
+A change smaller than the threshold is taken to be the time between the two readings of a pair.
+
+Hence a slew is never seen; not even chronyd's fast ones (maxslewrate). CLOCK_MONOTONIC_RAW would show
+slews, but it also drifts from CLOCK_REALTIME by the clock's frequency error; over the minutes (or hours)
+between pairs that's well past the threshold and would be counted as steps.
+
+Works with micropython; the pairs are passed in (as ES100 reads its clocks via its own time_ns()
+and monotonic_ns()).
+"""
+
+DEFAULT_CLOCK_STEP = 0.002          # seconds; smaller changes are noise
+
+class ClockStep:
+    """ ClockStep()
+
+    :param threshold: Smallest change (in seconds) that counts as a step
+    :return: New instance of ClockStep()
+
+    ES100.clock is one of these; it follows every pair the ES100 takes.
+    """
+
+    def __init__(self, threshold=DEFAULT_CLOCK_STEP):
+        """ :meta private: """
+        if threshold <= 0:
+            raise ValueError('clock step threshold must be positive: %s' % (threshold))
+        self._threshold_ns = int(threshold * 1000000000)
+        self._offset_ns = None
+        self.count = 0
+        self.total_ns = 0
+        self.last_ns = 0
+
+    def __str__(self):
+        """ :meta private: """
+        return '[clock steps=%d total=%.6fs]' % (self.count, self.total_ns / 1000000000.0)
+
+    def check(self, realtime_ns, monotonic_ns):
+        """ check()
+
+        :param realtime_ns: System time (nanoseconds since the epoch)
+        :param monotonic_ns: Monotonic time (nanoseconds) read straight after realtime_ns
+        :return: The step (nanoseconds; positive is forward) since the previous pair; 0 if none
+        """
+        offset_ns = realtime_ns - monotonic_ns
+        previous_ns = self._offset_ns
+        self._offset_ns = offset_ns
+        if previous_ns is None:
+            return 0
+        return self._counted(offset_ns - previous_ns)
+
+    def since(self, realtime_ns, monotonic_ns, now_realtime_ns, now_monotonic_ns):
+        """ since()
+
+        :param realtime_ns: System time of an earlier pair
+        :param monotonic_ns: Monotonic time of an earlier pair
+        :param now_realtime_ns: System time now
+        :param now_monotonic_ns: Monotonic time now
+        :return: The step (nanoseconds) between the two pairs; 0 if none
+
+        Unlike check(), the pairs need not be in order (or from the same thread)
+        """
+        return self._counted((now_realtime_ns - now_monotonic_ns) - (realtime_ns - monotonic_ns))
+
+    def _counted(self, step_ns):
+        """ _counted """
+        if abs(step_ns) < self._threshold_ns:
+            return 0
+        self.count += 1
+        self.total_ns += step_ns
+        self.last_ns = step_ns
+        return step_ns
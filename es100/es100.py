@@ -21,8 +21,27 @@ except ImportError:
     # micropython does not have logging
     from pico.logging import logging
 
+try:
+    time_ns = time.time_ns
+except AttributeError:
+    # older micropython does not have time_ns()
+    def time_ns():
+        """ :meta private: """
+        return int(time.time() * 1000000000)
+
+try:
+    monotonic_ns = time.monotonic_ns
+except AttributeError:
+    # micropython has ticks_us() in place of monotonic_ns()
+    def monotonic_ns():
+        """ :meta private: """
+        return time.ticks_us() * 1000
+
 from es100.gpio_control import ES100GPIO, ES100GPIOError
 from es100.i2c_control import ES100I2C, ES100I2CError
+from es100 import trace
+from es100.history import History, DEFAULT_HISTORY_SIZE
+from es100.clockstep import ClockStep, DEFAULT_CLOCK_STEP
 
 I2C_DEFAULT_BUS = 1
 ES100_SLAVE_ADDR = 0x32             # I2C slave address
@@ -33,6 +52,7 @@ T_TRACKING_RECEPTION = 24.5         # Tracking Reception 24.5 seconds
 T_IRQ_DELAY = 0.1                   # -100 thru 100 ms
 
 T_SLACK = 10                        # This is just for timeouts on IRQ's - should never happen
+T_MINUTE_NS = 60 * 1000000000
 
 class ES100Error(Exception):
     """ raise this any ES100 error """
@@ -46,6 +66,9 @@ class ES100:
     :param bus: i2c bus number
     :param address: i2c address
     :param use_gpiod: gpiod usage (default is no)
+    :param history: Number of reception attempts kept in ES100.history
+    :param guard: Latency guard (or None); told when an IRQ is expected and when it's been handled
+    :param clock_step: Smallest change (in seconds) between the system and monotonic clocks that counts as a clock step
     :param debug: True to enable debug messages
     :param verbose: True to enable verbose messages
     :return: New instance of ES100()
@@ -130,7 +153,7 @@ class ES100:
         DST1            = 0x40  # DST[0:1] 11 == DST in effect, 01 == DST ends today
         TRACKING        = 0x80  # 1 == reception was tracking operation
 
-    def __init__(self, antenna=None, irq=None, en=None, bus=None, address=None, use_gpiod=False, debug=False, verbose=False):
+    def __init__(self, antenna=None, irq=None, en=None, bus=None, address=None, use_gpiod=False, history=DEFAULT_HISTORY_SIZE, guard=None, clock_step=DEFAULT_CLOCK_STEP, debug=False, verbose=False):
         """ :meta private: """
 
         self._gpio = None
@@ -211,6 +234,7 @@ class ES100:
         self._recv_time = {}
         self._recv_dst_info = {}
         self._system_time_received = None
+        self._system_time_received_ns = None
         self._wwvb_time_received = None
         self._delta_seconds = None
         self._status0 = 0x00
@@ -230,6 +254,34 @@ class ES100:
         self._dst_next = [None, None, None]
         self._dst_special = None
 
+        # per reception attempt information; see attempt()
+        self._attempt = {}
+        self._start_time_ns = None
+        self._start_monotonic_ns = None
+        self._irq_monotonic_ns = None
+        self._cycles = 0
+        self._timeouts = 0
+        self._i2c_ns = []
+        self._trace_ns = 0
+        self._clock_steps = 0
+        self._clock_step_ns = 0
+
+        # every timestamp is a system/monotonic pair; a step between two pairs is noticed (see clockstep.py)
+        try:
+            self.clock = ClockStep(clock_step)
+        except ValueError as err:
+            raise ES100Error(str(err)) from err
+
+        # guard.expect(es100, earliest_irq_ns) after each START (or retry) and guard.done(es100) once
+        # the timestamp and registers have been read; i.e. wwvb/gcguard.py keeps garbage collection out
+        self._guard = guard
+
+        # the last few attempts; see history.py
+        try:
+            self.history = History(history)
+        except ValueError as err:
+            raise ES100Error(str(err)) from err
+
         # find device id
         if not self._es100_device_id():
             raise ES100Error('i2c bus probe failed to find ES100 chip')
@@ -271,6 +323,17 @@ class ES100:
             raise ES100Error('No reception yet')
         return self._system_time_received
 
+    def system_time_ns(self):
+        """ system_time_ns()
+
+        :return: integer nanoseconds since the epoch for reception system time
+
+        Same as system_time(); however, without any rounding to milliseconds.
+        """
+        if not self._rx_complete and not self._status_ok:
+            raise ES100Error('No reception yet')
+        return self._system_time_received_ns
+
     def wwvb_time(self):
         """ wwvb_time()
 
@@ -320,6 +383,20 @@ class ES100:
             raise ES100Error('No reception yet')
         return self._delta_seconds
 
+    def attempt(self):
+        """ attempt()
+
+        :return: dict describing the most recent reception attempt (successful or not)
+
+        Keys are: start_ns, irq_ns (system time in nanoseconds), duration_ns (START to final IRQ),
+        tracking, antenna, irq_status, status0, cycles, timeouts, outcome, wwvb_time, delta_seconds
+        and i2c_ns (a list of each i2c transaction time). outcome is one of 'RX_OK', 'RX_FAIL',
+        'CYCLE_COMPLETE' or 'I2C_ERROR'. clock_steps counts the system clock steps seen during the
+        attempt and clock_step_ns is by how much the clock was stepped between START and the final IRQ
+        (0 if it wasn't); irq_ns, delta_seconds etc are already restated for a step after the IRQ.
+        """
+        return self._attempt
+
     def _enable(self):
         """ _enable """
         self._gpio.en_high()
@@ -334,15 +411,47 @@ class ES100:
         """ _wait_for_interrupt """
         self._log.debug('wait for irq')
         self._system_time_received = None
+        self._system_time_received_ns = None
+        start_ns = trace.begin()
         irq_happened = self._gpio.irq_wait(timeout)
         # save away the current time quikly - i.e. time of decoded reception
-        self._system_time_received = datetime.utcnow().replace(tzinfo=timezone.utc)
-        # round down to milliseconds
+        self._system_time_received_ns = time_ns()
+        self._irq_monotonic_ns = monotonic_ns()
+        if start_ns:
+            trace.end('es100.irq_wait', start_ns, {'irq': irq_happened})
+        # the same instant as system_time_ns(); rounded down to milliseconds
         # WWVB is accurate; but our reception isn't down to the microsecond ('cause linux)
-        msec = int(self._system_time_received.microsecond/1000.0)
-        self._system_time_received = self._system_time_received.replace(microsecond=msec*1000)
+        self._system_time_received = self._system_time_from_ns(self._system_time_received_ns)
         if not irq_happened:
+            self._timeouts += 1
             self._log.warning('wait for irq - timeout')
+        # the IRQ timestamp is on the stepped clock already; however, the START wasn't
+        self._clock_step_ns += self._clock_check(self._system_time_received_ns, self._irq_monotonic_ns, 'during reception')
+
+    def _clock_check(self, realtime_ns, mono_ns, where):
+        """ _clock_check """
+        step_ns = self.clock.check(realtime_ns, mono_ns)
+        if step_ns:
+            self._clock_steps += 1
+            self._log.warning('system clock stepped %+.6f seconds %s', step_ns / 1000000000.0, where)
+        return step_ns
+
+    def _clock_restate(self):
+        """ _clock_restate
+
+        Restate the IRQ timestamp on the clock as it is now; a step after the IRQ would otherwise end up in delta_seconds
+        """
+        step_ns = self._clock_check(time_ns(), monotonic_ns(), 'since the IRQ')
+        if not step_ns:
+            return
+        self._system_time_received_ns += step_ns
+        self._system_time_received = self._system_time_from_ns(self._system_time_received_ns)
+
+    @classmethod
+    def _system_time_from_ns(cls, value_ns):
+        """ _system_time_from_ns - datetime (rounded down to milliseconds) for nanoseconds since the epoch """
+        msec = (value_ns // 1000000) % 1000
+        return datetime.fromtimestamp(value_ns // 1000000000, timezone.utc).replace(microsecond=msec*1000)
 
     def _read_register(self, addr):
         """ _read_register
@@ -360,6 +469,7 @@ class ES100:
                 self._log.error('_read_register: %s: invalid name', addr)
                 raise ES100Error('i2c read: %s' % (err)) from err
 
+        start_ns = monotonic_ns()
         try:
             self._i2c.write(addr)
         except ES100I2CError as err:
@@ -371,17 +481,20 @@ class ES100:
         except ES100I2CError as err:
             self._log.error('i2c read: %s', err)
             raise ES100Error('i2c read: %s' % (err)) from err
+        self._i2c_ns.append(monotonic_ns() - start_ns)
         self._log.debug('register %d read => 0x%02x', addr, rval & 0xff)
         return rval & 0xff
 
     def _write_register(self, addr, data):
         """ _write_register """
         self._log.debug('register %d write <= 0x%02x', addr, data)
+        start_ns = monotonic_ns()
         try:
             self._i2c.write_addr(addr, data)
         except ES100I2CError as err:
             self._log.error('i2c write: %s', err)
             raise ES100Error('i2c write: %s' % (err)) from err
+        self._i2c_ns.append(monotonic_ns() - start_ns)
 
     def _get_device_id(self):
         """ _get_device_id """
@@ -413,9 +526,15 @@ class ES100:
 
     def _read_and_report_irq_and_status0_reg(self):
         """ _read_and_report_irq_and_status0_reg """
+        start_ns = trace.begin()
         self._irq_status = self._get_irq_status()
         self._cycle_complete = bool(self._irq_status & ES100.IRQSTATUS.CYCLE_COMPLETE)
         self._rx_complete = bool(self._irq_status & ES100.IRQSTATUS.RX_COMPLETE)
+        if self._cycle_complete:
+            self._cycles += 1
+            if self._guard:
+                # the ES100 has started over by itself
+                self._guard.expect(self, self._earliest_irq_ns(False, time_ns()))
 
         if not self._rx_complete:
             self._log.info('irq_status = 0x%02x <...,%s,-,%s>',
@@ -424,10 +543,14 @@ class ES100:
                                 'RX_COMPLETE' if self._rx_complete else '-',
                         )
             # don't bother with status0 because it's not valid yet
+            if start_ns:
+                trace.end('es100.status', start_ns, {'irq_status': self._irq_status})
             return
 
         # status0 should now contain information
         self._status0 = self._get_status0()
+        if start_ns:
+            trace.end('es100.status', start_ns, {'irq_status': self._irq_status, 'status0': self._status0})
         self._tracking_operation = bool(self._status0 & ES100.STATUS0.TRACKING)
         self._rx_antenna = 'Antenna2' if self._status0 & ES100.STATUS0.ANT else 'Antenna1'
         self._status_ok = bool(self._status0 & ES100.STATUS0.RX_OK)
@@ -444,7 +567,10 @@ class ES100:
 
     def _read_and_report_control0_reg(self):
         """ _read_and_report_control0_reg """
+        start_ns = trace.begin()
         self._control0 = self._get_control0()
+        if start_ns:
+            trace.end('es100.control0_readback', start_ns, {'control0': self._control0})
 
         # we don't need to save any of thise bits becuase they aren't referenced
         tracking_enabled = bool(self._control0 & ES100.CONTROL0.TRACKING_ENABLE)
@@ -485,7 +611,10 @@ class ES100:
                 control0 |= ES100.CONTROL0.ANT2_OFF
             else:
                 control0 |= ES100.CONTROL0.ANT1_OFF
+        start_ns = trace.begin()
         self._write_control0(control0)
+        if start_ns:
+            trace.end('es100.start', start_ns, {'control0': control0})
 
     def _start_rx(self):
         """ _start_rx """
@@ -535,20 +664,27 @@ class ES100:
         # somewhere else in the code and simple timeout a reception there.
         # this will only be hit if we do a successful reception first.
 
-        time_now = datetime.utcnow()
-        if not (10 <= time_now.minute < 16 or 40 <= time_now.minute < 46):
-            # all good!
-            return
-
-        # need to delay - we only use the lower digit of the minute
-        # we caculate remaining seconds till HH:16:00 or HH:46:00
-        remaining_seconds = 6 * 60 - ((time_now.minute % 10) * 60 + time_now.second)
+        while True:
+            self._clock_check(time_ns(), monotonic_ns(), 'before waiting for HH:M6:00')
+            time_now = datetime.utcnow()
+            if not (10 <= time_now.minute < 16 or 40 <= time_now.minute < 46):
+                # all good!
+                return
 
-        self._log.info('sleeping %d seconds till %02d:%1d6:00', remaining_seconds, time_now.hour, int(time_now.minute / 10))
-        # The suspension time may be longer than requested by an arbitrary amount, because
-        # of the scheduling of other activity in the system.
-        # We ignore this fact presently
-        time.sleep(remaining_seconds)
+            # need to delay - we only use the lower digit of the minute
+            # we caculate remaining seconds till HH:16:00 or HH:46:00
+            remaining_seconds = 6 * 60 - ((time_now.minute % 10) * 60 + time_now.second)
+
+            self._log.info('sleeping %d seconds till %02d:%1d6:00', remaining_seconds, time_now.hour, int(time_now.minute / 10))
+            # The suspension time may be longer than requested by an arbitrary amount, because
+            # of the scheduling of other activity in the system.
+            # We ignore this fact presently
+            start_ns = trace.begin()
+            time.sleep(remaining_seconds)
+            trace.end('es100.wait_blackout', start_ns)
+            if not self._clock_check(time_ns(), monotonic_ns(), 'while waiting for HH:M6:00'):
+                return
+            # sleep() runs on the monotonic clock; the wait is worked out again on the stepped clock
 
     def _wait_till_55seconds(self):
         """ _wait_till_55seconds """
@@ -556,15 +692,22 @@ class ES100:
         # Tracking should not start till :55 second point
         # (we assume ntp is running - chicken-n-egg issue)
 
-        time_now = datetime.utcnow()
-        remaining_seconds = 55.0 - (time_now.second + time_now.microsecond/1000000.0)
-        if remaining_seconds < 0.0:
-            remaining_seconds += 60.0
-        self._log.debug('sleeping %.1f seconds till HH:MM:55', remaining_seconds)
-        # The suspension time may be longer than requested by an arbitrary amount, because
-        # of the scheduling of other activity in the system.
-        # We ignore this fact presently
-        time.sleep(remaining_seconds)
+        while True:
+            self._clock_check(time_ns(), monotonic_ns(), 'before waiting for HH:MM:55')
+            time_now = datetime.utcnow()
+            remaining_seconds = 55.0 - (time_now.second + time_now.microsecond/1000000.0)
+            if remaining_seconds < 0.0:
+                remaining_seconds += 60.0
+            self._log.debug('sleeping %.1f seconds till HH:MM:55', remaining_seconds)
+            # The suspension time may be longer than requested by an arbitrary amount, because
+            # of the scheduling of other activity in the system.
+            # We ignore this fact presently
+            start_ns = trace.begin()
+            time.sleep(remaining_seconds)
+            trace.end('es100.wait_55s', start_ns)
+            if not self._clock_check(time_ns(), monotonic_ns(), 'while waiting for HH:MM:55'):
+                return
+            # sleep() runs on the monotonic clock; the wait is worked out again on the stepped clock
 
     def _es100_receive(self, tracking=False, do_cycles=False):
         """ _es100_receive """
@@ -574,6 +717,12 @@ class ES100:
             self._start_rx()
         else:
             self._start_tracking()
+        self._start_time_ns = time_ns()
+        self._start_monotonic_ns = monotonic_ns()
+        self._clock_check(self._start_time_ns, self._start_monotonic_ns, 'before START')
+        self._clock_step_ns = 0
+        if self._guard:
+            self._guard.expect(self, self._earliest_irq_ns(tracking, self._start_time_ns))
 
         # the host microcontroller initiates the reception attempt by writing to the CONTROL 0
         # register to set the START bit high. This will cause the ES100 to begin signal reception
@@ -618,6 +767,16 @@ class ES100:
         # yippe - we exited the loop because RX_COMPLETE is set
         # hence there should be a reception/tracking info
 
+    @classmethod
+    def _earliest_irq_ns(cls, tracking, start_ns):
+        """ _earliest_irq_ns
+
+        Tracking ends 24.5 seconds after START; a reception needs a whole minute frame (which starts on the minute)
+        """
+        if tracking:
+            return start_ns + int((T_TRACKING_RECEPTION - T_IRQ_DELAY) * 1000000000)
+        return (start_ns // T_MINUTE_NS + 2) * T_MINUTE_NS
+
     @classmethod
     def _bcd(cls, val):
         """ _bcd """
@@ -648,16 +807,25 @@ class ES100:
             # swap 2 -> 1 and 1 -> 2
             self._antenna = 2 if self._antenna == 1 else 1
 
+        self._start_attempt()
+
         try:
             # receive time from WWVB
             self._es100_receive(tracking, do_cycles)
         except ES100Error as err:
             self._log.warning('read/receive failed: %s', err)
+            self._finish_attempt(tracking, 'I2C_ERROR')
+            return None
+
+        if not self._rx_complete:
+            # only happens with do_cycles
+            self._finish_attempt(tracking, 'CYCLE_COMPLETE')
             return None
 
         if self._tracking_operation:
             if not self._status_ok:
                 self._log.debug('tracking operation unsuccessful, %s', self._rx_antenna)
+                self._finish_attempt(tracking, 'RX_FAIL')
                 return None
 
             # No value for date/time or other items in tracking mode; just second.
@@ -673,8 +841,16 @@ class ES100:
             self._recv_dst_info = {}
 
             # only second register is valid
-            for reg in ['SECOND']:
-                self._recv_time[reg] = self._read_register(reg)
+            start_ns = trace.begin()
+            try:
+                for reg in ['SECOND']:
+                    self._recv_time[reg] = self._read_register(reg)
+            except ES100Error as err:
+                self._log.warning('read/receive failed: %s', err)
+                self._finish_attempt(tracking, 'I2C_ERROR')
+                return None
+            trace.end('es100.read_registers', start_ns)
+            self._clock_restate()
 
             seconds = ES100._bcd(self._recv_time['SECOND'] & 0x7f)
             self._log.info('tracking operation successful, HH:MM:%02d at system time %02d.%03d, %s',
@@ -692,15 +868,26 @@ class ES100:
                                     tzinfo=timezone.utc
                             )
 
+            self._finish_attempt(tracking, 'RX_OK')
             return self._wwvb_time_received
 
         if not self._status_ok:
             self._log.debug('reception unsuccessful, %s', self._rx_antenna)
             # No value for data/time, didn't get reception
+            self._finish_attempt(tracking, 'RX_FAIL')
             return None
 
         # we have date and time and much more
-        self._read_all_registers()
+        start_ns = trace.begin()
+        try:
+            self._read_all_registers()
+        except ES100Error as err:
+            self._log.warning('read/receive failed: %s', err)
+            self._finish_attempt(tracking, 'I2C_ERROR')
+            return None
+        trace.end('es100.read_registers', start_ns)
+        self._clock_restate()
+        start_ns = trace.begin()
 
         self._wwvb_time_received = datetime(
                                 ES100._bcd(self._recv_date['YEAR'] & 0xff) + 2000,
@@ -715,6 +902,7 @@ class ES100:
 
         # Success! We have date and time!
         self._delta_seconds = (self._wwvb_time_received - self._system_time_received).total_seconds()
+        trace.end('es100.decode', start_ns)
         self._log.info('Reception of %s at system time %s with difference %.3f via %s',
                                 self._wwvb_time_received,
                                 self._system_time_received,
@@ -726,8 +914,54 @@ class ES100:
         # self._disable()
         # time.sleep(T_WAKEUP)
 
+        self._finish_attempt(tracking, 'RX_OK')
         return self._wwvb_time_received
 
+    def _start_attempt(self):
+        """ _start_attempt """
+        self._trace_ns = trace.begin()
+        self._start_time_ns = None
+        self._start_monotonic_ns = None
+        self._irq_monotonic_ns = None
+        self._cycles = 0
+        self._timeouts = 0
+        self._i2c_ns = []
+        self._clock_steps = 0
+        self._clock_step_ns = 0
+        self._status0 = 0x00
+        self._irq_status = 0x00
+        self._rx_antenna = None
+
+    def _finish_attempt(self, tracking, outcome):
+        """ _finish_attempt """
+        if self._start_monotonic_ns is not None and self._irq_monotonic_ns is not None:
+            duration_ns = self._irq_monotonic_ns - self._start_monotonic_ns
+        else:
+            duration_ns = None
+        self._attempt = {
+            'start_ns': self._start_time_ns,
+            'irq_ns': self._system_time_received_ns if self._irq_monotonic_ns is not None else None,
+            'irq_monotonic_ns': self._irq_monotonic_ns,
+            'duration_ns': duration_ns,
+            'tracking': bool(tracking),
+            'antenna': self._rx_antenna if self._rx_antenna else 'Antenna%d' % (self._antenna),
+            'irq_status': self._irq_status,
+            'status0': self._status0,
+            'cycles': self._cycles,
+            'timeouts': self._timeouts,
+            'outcome': outcome,
+            'wwvb_time': self._wwvb_time_received if outcome == 'RX_OK' else None,
+            'delta_seconds': self._delta_seconds if outcome == 'RX_OK' else None,
+            'i2c_ns': self._i2c_ns,
+            'clock_steps': self._clock_steps,
+            'clock_step_ns': self._clock_step_ns,
+        }
+        if self._guard:
+            self._guard.done(self)
+        self.history.append(self._attempt)
+        if self._trace_ns:
+            trace.end('es100.time', self._trace_ns, {'outcome': outcome, 'antenna': self._attempt['antenna']})
+
     def _read_all_registers(self):
         """ _read_all_registers()
 
@@ -7,6 +7,8 @@ import os
 import sys
 import time
 
+from es100 import trace
+
 DEVICE_LIBRARY_UNKNOWN = 0
 DEVICE_LIBRARY_GPIO = 1
 DEVICE_LIBRARY_PIN = 2
@@ -101,7 +103,8 @@ class ES100GPIO:
         """ _close """
         self.en_low()
         if DEVICE_LIBRARY == DEVICE_LIBRARY_GPIO:
-            GPIO.cleanup()
+            # only our pins; other ES100's may still be running
+            GPIO.cleanup([self._gpio_en, self._gpio_irq])
         if DEVICE_LIBRARY == DEVICE_LIBRARY_PIN:
             pass
         if DEVICE_LIBRARY == DEVICE_LIBRARY_BLINKA:
@@ -113,6 +116,7 @@ class ES100GPIO:
         EN set low
         """
         # Enable Input. When low, the ES100 powers down all circuitry.
+        trace.tracepoint('gpio.en_low')
         if DEVICE_LIBRARY == DEVICE_LIBRARY_GPIO:
             GPIO.output(self._gpio_en, GPIO.LOW)
         if DEVICE_LIBRARY == DEVICE_LIBRARY_PIN:
@@ -126,6 +130,7 @@ class ES100GPIO:
         EN set high
         """
         # Enable Input. When high, the device is operational.
+        trace.tracepoint('gpio.en_high')
         if DEVICE_LIBRARY == DEVICE_LIBRARY_GPIO:
             GPIO.output(self._gpio_en, GPIO.HIGH)
         if DEVICE_LIBRARY == DEVICE_LIBRARY_PIN:
@@ -142,6 +147,7 @@ class ES100GPIO:
         IRQ- will go active low once the receiver has some info to return.
         """
         # IRQ/Interrupt is active low to signal data available
+        # no span here; trace.end() runs the callbacks, which would delay the caller's IRQ timestamp
         if self._debug:
             sys.stderr.write('IRQ WAIT: ')
             # sys.stderr.flush()
@@ -0,0 +1,210 @@
+""" Fixed size history of reception attempts; kept in arrays (not lists of dicts or datetimes)
+
+Copyright (C) 2023 Martin J Levy - W6LHI/G8LHI - @mahtin - https://github.com/mahtin
+
+Each attempt is one row across a set of array columns:
+
+    start_ns    int64   system time START was written (nanoseconds since the epoch; 0 if unknown)
+    irq_ns      int64   system time of the final IRQ (0 if there wasn't one)
+    delta       float   delta seconds (WWVB time minus system time); NaN unless a successful reception
+    status0     uint8   STATUS0 register
+    antenna     uint8   1 or 2
+    mode        uint8   MODE_RECEPTION or MODE_TRACKING
+    outcome     uint8   one of OUTCOMES (by index)
+
+Appending is O(1) and the memory used never grows; the oldest row is overwritten. A row is about
+30 bytes; hence 64 attempts (an hour of tracking) is 2KB which is fine on a Pico.
+
+Works with micropython (which has array); on a Pico delta is a single precision float.
+When numpy is installed numpy() returns the columns as ndarrays (a view where it can be).
+
+Written by the ES100's (one) reception thread; a reader on another thread may see a row that's part written.
+"""
+
+import math
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+DEFAULT_HISTORY_SIZE = 64
+
+MODE_RECEPTION = 0
+MODE_TRACKING = 1
+
+OUTCOMES = ('RX_OK', 'RX_FAIL', 'CYCLE_COMPLETE', 'I2C_ERROR')
+OUTCOME_RX_OK = 0
+
+NAN = float('nan')
+
+def _float_typecode():
+    """ :meta private: """
+    try:
+        array('d')
+        return 'd'
+    except ValueError:
+        # micropython built with single precision floats (i.e. rp2)
+        return 'f'
+
+COLUMNS = (
+    ('start_ns', 'q'),
+    ('irq_ns', 'q'),
+    ('delta', _float_typecode()),
+    ('status0', 'B'),
+    ('antenna', 'B'),
+    ('mode', 'B'),
+    ('outcome', 'B'),
+)
+
+class History:
+    """ History()
+
+    :param size: Number of attempts remembered
+    :return: New instance of History()
+
+    ES100.history is one of these; the last size attempts (successful or not).
+    """
+
+    def __init__(self, size=DEFAULT_HISTORY_SIZE):
+        """ :meta private: """
+        if size < 1:
+            raise ValueError('history size must be at least 1: %d' % (size))
+        self._size = size
+        self._next = 0
+        self._count = 0
+        self.total = 0
+        self._columns = {}
+        for (name, typecode) in COLUMNS:
+            self._columns[name] = array(typecode, [0] * size)
+
+    def __len__(self):
+        """ __len__ """
+        return self._count
+
+    def __str__(self):
+        """ __str__ """
+        return '[history %d/%d total=%d]' % (self._count, self._size, self.total)
+
+    def size(self):
+        """ size()
+
+        :return: Number of attempts that can be remembered
+        """
+        return self._size
+
+    def memory(self):
+        """ memory()
+
+        :return: Bytes used by the columns
+        """
+        return sum([column.itemsize * self._size for column in self._columns.values()])
+
+    def append(self, attempt):
+        """ append()
+
+        :param attempt: dict from ES100.attempt()
+        """
+        i = self._next
+        columns = self._columns
+        outcome = OUTCOMES.index(attempt['outcome']) if attempt['outcome'] in OUTCOMES else len(OUTCOMES)
+        tracking = attempt['tracking']
+        columns['start_ns'][i] = attempt['start_ns'] or 0
+        columns['irq_ns'][i] = attempt['irq_ns'] or 0
+        if outcome == OUTCOME_RX_OK and not tracking and attempt['delta_seconds'] is not None:
+            columns['delta'][i] = attempt['delta_seconds']
+        else:
+            # tracking has no date; hence no delta
+            columns['delta'][i] = NAN
+        columns['status0'][i] = attempt['status0'] & 0xff
+        columns['antenna'][i] = 2 if attempt['antenna'] == 'Antenna2' else 1
+        columns['mode'][i] = MODE_TRACKING if tracking else MODE_RECEPTION
+        columns['outcome'][i] = outcome
+        # the row is complete before it's counted
+        self._next = (i + 1) % self._size
+        if self._count < self._size:
+            self._count += 1
+        self.total += 1
+
+    def column(self, name, last=None):
+        """ column()
+
+        :param name: Column name (see COLUMNS)
+        :param last: Only the most recent last attempts (None is all of them)
+        :return: array of values; oldest first (a copy)
+        """
+        (start, count) = self._window(last)
+        column = self._columns[name]
+        if start + count <= self._size:
+            return column[start:start + count]
+        # wrapped
+        return column[start:] + column[:start + count - self._size]
+
+    def numpy(self, name, last=None):
+        """ numpy()
+
+        :param name: Column name (see COLUMNS)
+        :param last: Only the most recent last attempts (None is all of them)
+        :return: numpy ndarray of values; oldest first (a view onto the column unless it has wrapped)
+        :raises ImportError: If numpy isn't installed
+        """
+        if numpy is None:
+            raise ImportError('numpy not installed')
+        (start, count) = self._window(last)
+        view = numpy.frombuffer(self._columns[name], dtype=self._columns[name].typecode)
+        if start + count <= self._size:
+            return view[start:start + count]
+        return numpy.concatenate((view[start:], view[:start + count - self._size]))
+
+    def success_rate(self, last=None, tracking=None):
+        """ success_rate()
+
+        :param last: Only the most recent last attempts (None is all of them)
+        :param tracking: True for tracking only, False for reception only, None for both
+        :return: Fraction of the attempts that were RX_OK (None if there were none)
+        """
+        if numpy is not None:
+            outcome = self.numpy('outcome', last)
+            if tracking is not None:
+                outcome = outcome[self.numpy('mode', last) == (MODE_TRACKING if tracking else MODE_RECEPTION)]
+            if len(outcome) == 0:
+                return None
+            return float(numpy.count_nonzero(outcome == OUTCOME_RX_OK)) / len(outcome)
+
+        attempts = 0
+        successes = 0
+        modes = self.column('mode', last)
+        for (n, outcome) in enumerate(self.column('outcome', last)):
+            if tracking is not None and modes[n] != (MODE_TRACKING if tracking else MODE_RECEPTION):
+                continue
+            attempts += 1
+            if outcome == OUTCOME_RX_OK:
+                successes += 1
+        if attempts == 0:
+            return None
+        return successes / attempts
+
+    def delta_stats(self, last=None):
+        """ delta_stats()
+
+        :param last: Only the most recent last attempts (None is all of them)
+        :return: (count, mean, standard deviation) of delta seconds over the successful receptions; (0, None, None) if none
+        """
+        if numpy is not None:
+            delta = self.numpy('delta', last)
+            delta = delta[~numpy.isnan(delta)]
+            if len(delta) == 0:
+                return (0, None, None)
+            return (len(delta), float(delta.mean()), float(delta.std()))
+
+        delta = [v for v in self.column('delta', last) if not math.isnan(v)]
+        if len(delta) == 0:
+            return (0, None, None)
+        mean = sum(delta) / len(delta)
+        return (len(delta), mean, math.sqrt(sum([(v - mean) ** 2 for v in delta]) / len(delta)))
+
+    def _window(self, last):
+        """ _window """
+        count = self._count if last is None else max(0, min(last, self._count))
+        return ((self._next - count) % self._size, count)
@@ -5,6 +5,8 @@ Copyright (C) 2023 Martin J Levy - W6LHI/G8LHI - @mahtin - https://github.com/ma
 
 import time
 
+from es100 import trace
+
 DEVICE_LIBRARY_UNKNOWN = 0
 DEVICE_LIBRARY_SMBUS = 1
 DEVICE_LIBRARY_I2C = 2
@@ -83,6 +85,7 @@ class ES100I2C:
 
     def read(self, addr=0):
         """ read """
+        start_ns = trace.begin()
         count = 0
         while True:
             try:
@@ -91,15 +94,20 @@ class ES100I2C:
                 if DEVICE_LIBRARY == DEVICE_LIBRARY_I2C:
                     rval = self._device.readfrom(self._i2c_address, 1)
                     rval = rval[0]
+                if start_ns:
+                    trace.end('i2c.read', start_ns, {'addr': addr, 'retries': count})
                 return rval
             except OSError as err:
                 if count > 10:
+                    if start_ns:
+                        trace.end('i2c.read', start_ns, {'addr': addr, 'retries': count, 'error': str(err)})
                     raise ES100I2CError('i2c read: %s' % (err)) from err
             time.sleep(ES100I2C.ERROR_DELAY_SEC)
             count += 1
 
     def write_addr(self, addr, data):
         """ write_addr """
+        start_ns = trace.begin()
         count = 0
         while True:
             try:
@@ -107,15 +115,20 @@ class ES100I2C:
                     self._device.write_byte_data(self._i2c_address, addr, data)
                 if DEVICE_LIBRARY == DEVICE_LIBRARY_I2C:
                     self._device.writeto_mem(self._i2c_address, addr, bytes([data]))
+                if start_ns:
+                    trace.end('i2c.write_addr', start_ns, {'addr': addr, 'retries': count})
                 return
             except OSError as err:
                 if count > 10:
+                    if start_ns:
+                        trace.end('i2c.write_addr', start_ns, {'addr': addr, 'retries': count, 'error': str(err)})
                     raise ES100I2CError('i2c write 0x%02x: %s' % (addr, err)) from err
             time.sleep(ES100I2C.ERROR_DELAY_SEC)
             count += 1
 
     def write(self, data):
         """ write """
+        start_ns = trace.begin()
         count = 0
         while True:
             try:
@@ -123,9 +136,13 @@ class ES100I2C:
                     self._device.write_byte(self._i2c_address, data)
                 if DEVICE_LIBRARY == DEVICE_LIBRARY_I2C:
                     self._device.writeto(self._i2c_address, bytes([data]))
+                if start_ns:
+                    trace.end('i2c.write', start_ns, {'data': data, 'retries': count})
                 return
             except OSError as err:
                 if count > 10:
+                    if start_ns:
+                        trace.end('i2c.write', start_ns, {'data': data, 'retries': count, 'error': str(err)})
                     raise ES100I2CError('i2c write 0x%02x: %s' % (data, err)) from err
             time.sleep(ES100I2C.ERROR_DELAY_SEC)
             count += 1
@@ -0,0 +1,178 @@
+""" Lightweight tracing of the ES100 reception lifecycle
+
+Copyright (C) 2023 Martin J Levy - W6LHI/G8LHI - @mahtin - https://github.com/mahtin
+
+Usage at a trace point is:
+
+    start_ns = trace.begin()
+    ... do the work ...
+    trace.end('es100.irq_wait', start_ns)
+
+begin() returns 0 when no callback is registered and end() returns at once when given 0;
+hence an untraced run pays for two function calls and nothing else.
+Where a span carries args, build them only when tracing:
+
+    if start_ns:
+        trace.end('i2c.read', start_ns, {'addr': addr})
+
+Each callback is called with a span tuple: (name, start_ns, end_ns, thread, args).
+Times are monotonic nanoseconds. end_ns is None for an instant tracepoint().
+"""
+
+import time
+
+try:
+    import json
+except ImportError:
+    json = None
+
+try:
+    monotonic_ns = time.monotonic_ns
+except AttributeError:
+    # micropython has ticks_us() in place of monotonic_ns()
+    def monotonic_ns():
+        """ :meta private: """
+        return time.ticks_us() * 1000
+
+try:
+    from _thread import get_ident
+except ImportError:
+    def get_ident():
+        """ :meta private: """
+        return 0
+
+try:
+    from os import getpid
+except ImportError:
+    # micropython
+    def getpid():
+        """ :meta private: """
+        return 0
+
+_callbacks = []
+
+def add_callback(callback):
+    """ add_callback()
+
+    :param callback: Called with each span tuple (name, start_ns, end_ns, thread, args)
+    """
+    if callback not in _callbacks:
+        _callbacks.append(callback)
+
+def remove_callback(callback):
+    """ remove_callback()
+
+    :param callback: A previously added callback
+    """
+    if callback in _callbacks:
+        _callbacks.remove(callback)
+
+def enabled():
+    """ enabled()
+
+    :return: True if anything is listening
+    """
+    return len(_callbacks) > 0
+
+def begin():
+    """ begin()
+
+    :return: monotonic nanoseconds (or 0 if nothing is listening)
+    """
+    if _callbacks:
+        return monotonic_ns()
+    return 0
+
+def end(name, start_ns, args=None):
+    """ end()
+
+    :param name: Span name; by convention module.phase (i.e. 'es100.irq_wait')
+    :param start_ns: Value returned by begin()
+    :param args: Optional dict of extra values
+    """
+    if not start_ns or not _callbacks:
+        return
+    _emit((name, start_ns, monotonic_ns(), get_ident(), args))
+
+def tracepoint(name, args=None):
+    """ tracepoint()
+
+    :param name: Tracepoint name
+    :param args: Optional dict of extra values
+    """
+    if not _callbacks:
+        return
+    _emit((name, monotonic_ns(), None, get_ident(), args))
+
+def _emit(span):
+    """ _emit """
+    for callback in _callbacks:
+        try:
+            callback(span)
+        except Exception:           # pylint: disable=broad-except
+            # tracing must never break reception
+            pass
+
+class ChromeTrace:
+    """ ChromeTrace()
+
+    :param max_spans: Oldest spans are dropped beyond this
+    :return: New instance of ChromeTrace()
+
+    A callback that keeps spans and writes them as Chrome trace-event JSON;
+    which loads into chrome://tracing or https://ui.perfetto.dev
+    """
+
+    def __init__(self, max_spans=100000):
+        """ :meta private: """
+        self._max_spans = max_spans
+        self._spans = []
+        self._pid = getpid()
+
+    def __call__(self, span):
+        """ __call__ """
+        self._spans.append(span)
+        if len(self._spans) > self._max_spans:
+            # trim in chunks; deleting from the front of a list one at a time is expensive
+            del self._spans[:max(1, self._max_spans // 10)]
+
+    def __len__(self):
+        """ __len__ """
+        return len(self._spans)
+
+    def events(self):
+        """ events()
+
+        :return: list of trace-event dicts (timestamps in microseconds)
+        """
+        events = []
+        for (name, start_ns, end_ns, thread, args) in list(self._spans):
+            event = {
+                'name': name,
+                'cat': name.split('.')[0],
+                'ts': start_ns / 1000.0,
+                'pid': self._pid,
+                'tid': thread,
+            }
+            if end_ns is None:
+                event['ph'] = 'i'
+                event['s'] = 't'
+            else:
+                event['ph'] = 'X'
+                event['dur'] = (end_ns - start_ns) / 1000.0
+            if args:
+                event['args'] = args
+            events.append(event)
+        return events
+
+    def dump(self, filename):
+        """ dump()
+
+        :param filename: File to write the trace into
+        """
+        with open(filename, 'w', encoding='utf-8') as fd:
+            json.dump({'traceEvents': self.events(), 'displayTimeUnit': 'ms'}, fd)
+
+    def clear(self):
+        """ clear() """
+        self._spans = []
@@ -0,0 +1,405 @@
+#!/usr/bin/env python3
+
+"""
+How many ES100s can one process drive? Many simulated ES100-MODs run through the real ES100 code
+
+Each simulated device answers the ES100 code's i2c reads/writes and IRQ waits like the real chip:
+tracking completes ~24.5 seconds after its START and reception at the end of the next whole minute.
+Time is compressed (--scale); every sleep, utcnow(), time_ns() and monotonic_ns() in es100/es100.py runs on a
+simulated clock. Each device runs on its own thread (as wwvb does with several receivers) and hands
+its receptions to one publishing thread that computes the NTP sample and publishes it (to a sink
+that does nothing) and updates the precision estimate.
+
+For each device count this reports:
+    cpu/fix     process CPU time per successful reception (not compressed)
+    start       how far from HH:MM:55 each tracking START was written; in real milliseconds
+                (i.e. the simulated error divided by the scale; what a real receiver would see)
+    publish     IRQ to the end of publishing in real milliseconds
+    mem/device  Python memory allocated per device (ES100 instance plus simulator)
+
+Copyright (C) 2023 Martin J Levy - W6LHI/G8LHI - @mahtin - https://github.com/mahtin
+"""
+
+import os
+import sys
+import time
+import queue
+import random
+import getopt
+import logging
+import threading
+import tracemalloc
+from datetime import datetime, timezone
+
+sys.path.insert(0, os.path.abspath('.'))
+
+from es100 import ES100
+from es100.i2c_control import ES100I2CError
+from wwvb.ntpdriver28 import NTPSample, datetime_to_ns
+from wwvb.sinks import Sinks
+from wwvb.precision import PrecisionEstimator
+
+DEFAULT_DEVICES = [1, 2, 5, 10, 20, 50, 100, 200, 500]
+DEFAULT_SCALE = 60.0            # simulated seconds per real second
+DEFAULT_MINUTES = 8             # simulated minutes per device count
+DEFAULT_FAIL = 0.1              # fraction of attempts that fail (RX_OK not set)
+
+TRACKING_NS = 24500000000       # START to IRQ for tracking
+MINUTE_NS = 60 * 1000000000
+
+ES100_MODULE = sys.modules['es100.es100']
+
+def bcd(value):
+    """ bcd """
+    return ((value // 10) << 4) | (value % 10)
+
+class SimClock:
+    """ SimClock - simulated wall clock running scale times faster than real time """
+
+    def __init__(self, start_ns, scale):
+        """ __init__ """
+        self.scale = scale
+        self._start_ns = start_ns
+        self._real_ns = time.perf_counter_ns()
+        self.stopped = threading.Event()
+
+    def time_ns(self):
+        """ time_ns """
+        return self._start_ns + int((time.perf_counter_ns() - self._real_ns) * self.scale)
+
+    def monotonic_ns(self):
+        """ monotonic_ns - same rate as time_ns(); hence never a clock step """
+        return int((time.perf_counter_ns() - self._real_ns) * self.scale)
+
+    def sleep(self, seconds):
+        """ sleep - returns early once stopped """
+        if seconds > 0:
+            self.stopped.wait(seconds / self.scale)
+
+    def sleep_until(self, when_ns):
+        """ sleep_until """
+        self.sleep((when_ns - self.time_ns()) / 1000000000.0)
+
+CLOCK = None
+
+class SimTime:
+    """ SimTime - stands in for the time module inside es100/es100.py """
+
+    @staticmethod
+    def sleep(seconds):
+        """ sleep """
+        CLOCK.sleep(seconds)
+
+    @staticmethod
+    def time():
+        """ time """
+        return CLOCK.time_ns() / 1000000000.0
+
+class SimDatetime(datetime):
+    """ SimDatetime - stands in for datetime inside es100/es100.py """
+
+    @classmethod
+    def utcnow(cls):
+        """ utcnow """
+        return datetime.fromtimestamp(CLOCK.time_ns() / 1000000000.0, timezone.utc).replace(tzinfo=None)
+
+def sim_time_ns():
+    """ sim_time_ns """
+    return CLOCK.time_ns()
+
+def sim_monotonic_ns():
+    """ sim_monotonic_ns """
+    return CLOCK.monotonic_ns()
+
+DEVICES = {}
+
+class SimDevice:
+    """ SimDevice - the ES100-MOD registers, START and IRQ behaviour """
+
+    def __init__(self, number, fail, rng):
+        """ __init__ """
+        self.number = number
+        self._fail = fail
+        self._rng = rng
+        self._registers = [0] * 16
+        self._registers[ES100.REGISTERS.DEVICE_ID] = 0x10
+        self._pointer = 0
+        self._irq_ns = None
+        self._tracking = False
+        self._antenna = 1
+        # for the benchmark
+        self.irq_real_ns = None
+        self.start_errors = []
+
+    def write(self, addr):
+        """ write - set the register pointer """
+        if CLOCK.stopped.is_set():
+            raise ES100I2CError('simulation stopped')
+        self._pointer = addr
+
+    def read(self, addr=0):
+        """ read """
+        if CLOCK.stopped.is_set():
+            raise ES100I2CError('simulation stopped')
+        value = self._registers[self._pointer]
+        if self._pointer == ES100.REGISTERS.IRQSTATUS:
+            # reading IRQ status releases IRQ-
+            self._registers[ES100.REGISTERS.IRQSTATUS] = 0
+        return value
+
+    def write_addr(self, addr, data):
+        """ write_addr """
+        if CLOCK.stopped.is_set():
+            raise ES100I2CError('simulation stopped')
+        self._registers[addr] = data
+        if addr == ES100.REGISTERS.CONTROL0 and data & ES100.CONTROL0.START:
+            self._start(data)
+
+    def _start(self, control0):
+        """ _start """
+        now_ns = CLOCK.time_ns()
+        self._tracking = bool(control0 & ES100.CONTROL0.TRACKING_ENABLE)
+        self._antenna = 2 if control0 & (ES100.CONTROL0.ANT1_OFF | ES100.CONTROL0.START_ANT) else 1
+        self._registers[ES100.REGISTERS.IRQSTATUS] = 0
+        self._registers[ES100.REGISTERS.STATUS0] = 0
+        if self._tracking:
+            error_ns = (now_ns - 55 * 1000000000) % MINUTE_NS
+            if error_ns >= MINUTE_NS // 2:
+                error_ns -= MINUTE_NS
+            self.start_errors.append(error_ns / CLOCK.scale / 1000000.0)
+            self._irq_ns = now_ns + TRACKING_NS
+        else:
+            # the end of the first whole minute frame heard
+            self._irq_ns = (now_ns // MINUTE_NS + 2) * MINUTE_NS
+
+    def en_low(self):
+        """ en_low """
+        self._irq_ns = None
+
+    def en_high(self):
+        """ en_high """
+
+    def irq_wait(self, timeout=None):
+        """ irq_wait """
+        now_ns = CLOCK.time_ns()
+        if self._irq_ns is None or (timeout is not None and self._irq_ns - now_ns > timeout * 1000000000):
+            CLOCK.sleep(timeout if timeout is not None else 1.0)
+            return False
+        CLOCK.sleep_until(self._irq_ns)
+        self.irq_real_ns = time.perf_counter_ns()
+        self._irq()
+        return True
+
+    def _irq(self):
+        """ _irq """
+        irq_ns = self._irq_ns
+        self._irq_ns = None
+        status0 = ES100.STATUS0.ANT if self._antenna == 2 else 0
+        if self._tracking:
+            status0 |= ES100.STATUS0.TRACKING
+        if self._rng.random() >= self._fail:
+            status0 |= ES100.STATUS0.RX_OK
+        registers = self._registers
+        registers[ES100.REGISTERS.IRQSTATUS] = ES100.IRQSTATUS.RX_COMPLETE
+        registers[ES100.REGISTERS.STATUS0] = status0
+        when = datetime.fromtimestamp(irq_ns // 1000000000, timezone.utc)
+        registers[ES100.REGISTERS.YEAR] = bcd(when.year - 2000)
+        registers[ES100.REGISTERS.MONTH] = bcd(when.month)
+        registers[ES100.REGISTERS.DAY] = bcd(when.day)
+        registers[ES100.REGISTERS.HOUR] = bcd(when.hour)
+        registers[ES100.REGISTERS.MINUTE] = bcd(when.minute)
+        registers[ES100.REGISTERS.SECOND] = bcd(when.second)
+
+class SimGPIO:
+    """ SimGPIO - stands in for ES100GPIO; the irq pin number picks the device """
+
+    def __init__(self, en=None, irq=None, use_gpiod=False, debug=False):
+        """ __init__ """
+        self._device = DEVICES[irq]
+
+    def en_low(self):
+        """ en_low """
+        self._device.en_low()
+
+    def en_high(self):
+        """ en_high """
+        self._device.en_high()
+
+    def irq_wait(self, timeout=None):
+        """ irq_wait """
+        return self._device.irq_wait(timeout)
+
+class SimI2C:
+    """ SimI2C - stands in for ES100I2C; the bus number picks the device """
+
+    def __init__(self, bus, address, debug=False):
+        """ __init__ """
+        self._device = DEVICES[bus]
+
+    def read(self, addr=0):
+        """ read """
+        return self._device.read(addr)
+
+    def write(self, data):
+        """ write """
+        self._device.write(data)
+
+    def write_addr(self, addr, data):
+        """ write_addr """
+        self._device.write_addr(addr, data)
+
+class NullSink:
+    """ NullSink - a sink that takes the sample and does nothing """
+
+    def __str__(self):
+        """ __str__ """
+        return 'null'
+
+    def publish(self, sample):
+        """ publish """
+
+def simulate():
+    """ simulate - point es100/es100.py at the simulator """
+    ES100_MODULE.ES100GPIO = SimGPIO
+    ES100_MODULE.ES100I2C = SimI2C
+    ES100_MODULE.time = SimTime
+    ES100_MODULE.time_ns = sim_time_ns
+    ES100_MODULE.monotonic_ns = sim_monotonic_ns
+    ES100_MODULE.datetime = SimDatetime
+    # a stopped simulation makes every ES100 complain about i2c; that's not interesting
+    logging.getLogger('ES100').setLevel(logging.CRITICAL)
+
+def receive(es100, device, tracking, results):
+    """ receive - one thread per device """
+    while not CLOCK.stopped.is_set():
+        received_dt = es100.time(tracking=tracking)
+        if received_dt is None or CLOCK.stopped.is_set():
+            continue
+        results.put((device.irq_real_ns, received_dt, es100.system_time_ns(), es100.leap_second(), es100.rx_antenna()))
+
+def publish(results, sinks, precision, latencies, counts):
+    """ publish - the main loop's share of each reception """
+    while True:
+        item = results.get()
+        if item is None:
+            return
+        (irq_real_ns, received_dt, system_time_ns, leap_second, rx_antenna) = item
+        if received_dt.year == 1:
+            # tracking; only the second is valid
+            offset_ns = (received_dt.second * 1000000000 - system_time_ns) % MINUTE_NS
+            if offset_ns >= MINUTE_NS // 2:
+                offset_ns -= MINUTE_NS
+            precision.add(('tracking', rx_antenna, 'simulated'), offset_ns / 1000000000.0)
+        else:
+            sample = NTPSample(datetime_to_ns(received_dt), system_time_ns, leap_second)
+            key = ('reception', rx_antenna, 'simulated')
+            precision.add(key, sample.offset)
+            sample.precision = precision.precision(key)
+            sinks.publish(sample)
+        latencies.append((time.perf_counter_ns() - irq_real_ns) / 1000000.0)
+        counts[0] += 1
+
+def percentiles(values):
+    """ percentiles - p50 p99 max """
+    if not values:
+        return (0.0, 0.0, 0.0)
+    values = sorted(values)
+    return (values[len(values) // 2], values[min(len(values) - 1, int(len(values) * 0.99))], values[-1])
+
+def run(count, tracking, scale, minutes, fail):
+    """ run - one device count """
+    global CLOCK                # pylint: disable=global-statement
+
+    # HH:MM:20 of a recent hour; away from the HH:10 and HH:40 blackouts for a while
+    start_ns = (time.time_ns() // 3600000000000) * 3600000000000 + 20 * 1000000000
+    CLOCK = SimClock(start_ns, scale)
+    DEVICES.clear()
+    rng = random.Random(count)
+
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    es100s = []
+    for number in range(count):
+        DEVICES[number] = SimDevice(number, fail, rng)
+        es100s.append(ES100(irq=number, en=number, bus=number))
+    memory = (tracemalloc.get_traced_memory()[0] - before) / count
+    tracemalloc.stop()
+
+    results = queue.Queue()
+    sinks = Sinks()
+    sinks.add(NullSink())
+    precision = PrecisionEstimator()
+    latencies = []
+    counts = [0]
+    publisher = threading.Thread(target=publish, args=(results, sinks, precision, latencies, counts), daemon=True)
+    threads = [threading.Thread(target=receive, args=(es100, DEVICES[number], tracking, results), daemon=True)
+                    for (number, es100) in enumerate(es100s)]
+
+    cpu = time.process_time()
+    publisher.start()
+    for thread in threads:
+        thread.start()
+    time.sleep(minutes * 60 / scale)
+    CLOCK.stopped.set()
+    for thread in threads:
+        thread.join()
+    results.put(None)
+    publisher.join()
+    cpu = time.process_time() - cpu
+
+    fixes = counts[0]
+    start_errors = [abs(error) for device in DEVICES.values() for error in device.start_errors]
+    return (fixes, cpu / fixes * 1000.0 if fixes else 0.0, percentiles(start_errors), percentiles(latencies), memory)
+
+def doit(args):
+    """ doit """
+
+    usage = 'usage: es100_bench.py [-n|--devices=N[,N...]] [-s|--scale=X] [-m|--minutes=N] [-f|--fail=X] [-r|--reception]'
+
+    devices = DEFAULT_DEVICES
+    scale = DEFAULT_SCALE
+    minutes = DEFAULT_MINUTES
+    fail = DEFAULT_FAIL
+    tracking = True
+    try:
+        opts, args = getopt.getopt(args, 'n:s:m:f:r', ['devices=', 'scale=', 'minutes=', 'fail=', 'reception'])
+        for opt, arg in opts:
+            if opt in ('-n', '--devices'):
+                devices = [int(v) for v in arg.split(',')]
+            if opt in ('-s', '--scale'):
+                scale = float(arg)
+            if opt in ('-m', '--minutes'):
+                minutes = int(arg)
+            if opt in ('-f', '--fail'):
+                fail = float(arg)
+            if opt in ('-r', '--reception'):
+                tracking = False
+    except (getopt.GetoptError, ValueError):
+        sys.exit(usage)
+    if scale <= 0 or minutes <= 0 or min(devices) <= 0:
+        sys.exit(usage)
+
+    simulate()
+    print('%s; %d simulated minutes per run at %.0fx (%.1f real seconds)' % (
+                'tracking' if tracking else 'reception', minutes, scale, minutes * 60 / scale))
+    print('%7s %7s %11s %26s %26s %11s' % ('devices', 'fixes', 'cpu/fix ms', 'start error ms p50/p99/max', 'publish ms p50/p99/max', 'mem/dev KB'))
+    for count in devices:
+        (fixes, cpu_per_fix, start, published, memory) = run(count, tracking, scale, minutes, fail)
+        print('%7d %7d %11.3f %26s %26s %11.1f' % (
+                    count,
+                    fixes,
+                    cpu_per_fix,
+                    '%.2f/%.2f/%.2f' % start if tracking else '-',
+                    '%.2f/%.2f/%.2f' % published,
+                    memory / 1024.0,
+                ))
+        sys.stdout.flush()
+
+def main(args=None):
+    """ main """
+    if args is None:
+        args = sys.argv[1:]
+    doit(args)
+
+if __name__ == '__main__':
+    main()
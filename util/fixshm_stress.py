@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+
+"""
+Stress the fix shm seqlock with concurrent reader processes
+
+The writer stores values that are all derived from one counter.
+Each reader checks every snapshot it gets and counts any where they don't match - i.e. a torn read.
+With --unsafe the readers skip the sequence checks; which shows the test does find torn reads.
+With --check-only they skip the sequence checks but keep the CRC; a torn copy that gets past it is what a
+weakly ordered CPU (i.e. ARM, where the seq may be seen out of order with the fix) could let through.
+
+Copyright (C) 2023 Martin J Levy - W6LHI/G8LHI - @mahtin - https://github.com/mahtin
+"""
+
+import os
+import sys
+import time
+import getopt
+import tempfile
+import multiprocessing
+
+sys.path.insert(0, os.path.abspath('.'))
+
+from wwvb.fixshm import FixSHM, FixSHMReader, FixSHMError
+
+DEFAULT_SECONDS = 5
+DEFAULT_READERS = 2
+
+def torn(snapshot):
+    """ torn() - True if the values didn't all come from the same write """
+    i = snapshot.sys_ns
+    return (snapshot.wwvb_ns != i + 1000
+            or snapshot.offset != float(i)
+            or snapshot.uncertainty != float(i)
+            or snapshot.antenna != i % 2 + 1
+            or snapshot.votes != i % 256)
+
+def reader(path, seconds, unsafe, check_only, results):
+    """ reader() - runs in its own process """
+
+    fixshm = FixSHMReader(path)
+
+    reads = empty = bad = 0
+    elapsed = 0
+    end = time.monotonic() + seconds
+    while time.monotonic() < end:
+        start_ns = time.perf_counter_ns()
+        if unsafe or check_only:
+            snapshot = fixshm.read_unchecked(verify=check_only)
+        else:
+            snapshot = fixshm.read()
+        elapsed += time.perf_counter_ns() - start_ns
+        reads += 1
+        if snapshot is None or snapshot.sys_ns == 0:
+            empty += 1
+            continue
+        if torn(snapshot):
+            bad += 1
+
+    fixshm.close()
+    results.put((reads, empty, bad, elapsed))
+
+def doit(args):
+    """ doit """
+
+    usage = 'usage: fixshm_stress.py [-u|--unsafe] [-c|--check-only] [-r|--readers=N] [-s|--seconds=N] [path]'
+
+    unsafe = False
+    check_only = False
+    readers = DEFAULT_READERS
+    seconds = DEFAULT_SECONDS
+    try:
+        opts, args = getopt.getopt(args, 'ucr:s:', ['unsafe', 'check-only', 'readers=', 'seconds='])
+        for opt, arg in opts:
+            if opt in ('-u', '--unsafe'):
+                unsafe = True
+            if opt in ('-c', '--check-only'):
+                check_only = True
+            if opt in ('-r', '--readers'):
+                readers = int(arg)
+            if opt in ('-s', '--seconds'):
+                seconds = float(arg)
+    except (getopt.GetoptError, ValueError):
+        sys.exit(usage)
+
+    # never touch a live file; default to a scratch one
+    if len(args) > 0:
+        path = args[0]
+    else:
+        path = os.path.join('/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir(), 'wwvb-fix-stress.%d' % (os.getpid()))
+
+    try:
+        fixshm = FixSHM(path)
+    except FixSHMError as err:
+        sys.exit(err)
+
+    try:
+        results = multiprocessing.Queue()
+        children = [multiprocessing.Process(target=reader, args=(path, seconds, unsafe, check_only, results)) for _ in range(readers)]
+        for child in children:
+            child.start()
+
+        written = 0
+        while any([child.is_alive() for child in children]):
+            for _ in range(1000):
+                written += 1
+                fixshm.write(written + 1000, written, float(written), float(written), 0, 0, written % 2 + 1, -10, written % 256, 1)
+
+        total_bad = 0
+        for child in children:
+            (reads, empty, bad, elapsed) = results.get()
+            total_bad += bad
+            print('reader: %d reads (%d empty), %d torn; %.3f microseconds per read' % (
+                        reads, empty, bad, elapsed / max(reads, 1) / 1000.0
+                    ))
+        for child in children:
+            child.join()
+        print('%d fixes written; %d torn reads%s' % (written, total_bad, ' (unsafe)' if unsafe else ' (check only)' if check_only else ''))
+        if total_bad and not unsafe:
+            sys.exit(1)
+    finally:
+        fixshm.close()
+        if len(args) == 0:
+            os.unlink(path)
+
+def main(args=None):
+    """ main """
+    if args is None:
+        args = sys.argv[1:]
+    doit(args)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+
+"""
+Simulate a fleet of wwvb sites sending fixes to a collector; all on loopback
+
+A child process sends one record per site per minute (as fast as it can) while this process
+runs the collector on one core. A few sites are given a bad offset (or a misdecoded minute);
+they should be the only ones flagged.
+
+Copyright (C) 2023 Martin J Levy - W6LHI/G8LHI - @mahtin - https://github.com/mahtin
+"""
+
+import os
+import sys
+import time
+import random
+import getopt
+import multiprocessing
+
+sys.path.insert(0, os.path.abspath('.'))
+
+from wwvb.fleet import FleetCollector, FleetError, pack_record, MINUTE_NS
+
+DEFAULT_SITES = 300
+DEFAULT_MINUTES = 30
+DEFAULT_BAD = 3
+
+def sender(address, sites, minutes, bad, first_minute):
+    """ sender() - runs in its own process """
+    import socket       # pylint: disable=import-outside-toplevel
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    rng = random.Random(42)
+    for minute in range(first_minute, first_minute + minutes):
+        for site in range(sites):
+            offset = rng.gauss(0.002, 0.0005)
+            if site < bad:
+                # 250ms out; or the wrong minute altogether
+                offset += 0.25 if site % 2 == 0 else 60.0
+            sys_ns = minute * MINUTE_NS + rng.randrange(0, 1000000000)
+            wwvb_ns = sys_ns + int(offset * 1000000000)
+            sock.sendto(pack_record('site%03d' % (site), wwvb_ns, sys_ns, offset, 5000000, -10, 0, 1), address)
+        # let the collector keep up; a real fleet spreads these out over the minute
+        time.sleep(0.002)
+    sock.close()
+
+def doit(args):
+    """ doit """
+
+    usage = 'usage: fleet_sim.py [-s|--sites=N] [-m|--minutes=N] [-b|--bad=N]'
+
+    sites = DEFAULT_SITES
+    minutes = DEFAULT_MINUTES
+    bad = DEFAULT_BAD
+    try:
+        opts, args = getopt.getopt(args, 's:m:b:', ['sites=', 'minutes=', 'bad='])
+        for opt, arg in opts:
+            if opt in ('-s', '--sites'):
+                sites = int(arg)
+            if opt in ('-m', '--minutes'):
+                minutes = int(arg)
+            if opt in ('-b', '--bad'):
+                bad = int(arg)
+    except (getopt.GetoptError, ValueError):
+        sys.exit(usage)
+
+    # simulated minutes are in the recent past; a long grace stops them being late
+    first_minute = time.time_ns() // MINUTE_NS - minutes - 1
+    grace = (minutes + 2) * 60
+    try:
+        collector = FleetCollector(['127.0.0.1:0'], grace=grace)
+    except FleetError as err:
+        sys.exit(err)
+
+    expected = sites * minutes
+    child = multiprocessing.Process(target=sender, args=(collector.addresses()[0], sites, minutes, bad, first_minute))
+
+    cpu = time.process_time()
+    start = time.monotonic()
+    child.start()
+    while collector.received + collector.rejected + collector.late < expected:
+        collector.poll(0.5)
+        if not child.is_alive() and time.monotonic() - start > 1.0:
+            # drain anything left and stop
+            collector.poll(0.1)
+            break
+    elapsed = time.monotonic() - start
+    cpu = time.process_time() - cpu
+    child.join()
+
+    results = collector.complete(time.time_ns() + grace * 1000000000)
+    flagged = set()
+    worst = 0.0
+    for consensus in results:
+        flagged |= set([site for site, _ in consensus.deviating])
+        worst = max(worst, abs(consensus.offset - 0.002))
+    lost = expected - collector.received - collector.late - collector.rejected
+
+    print('%d sites x %d minutes: %d records received (%d lost, %d late, %d rejected) in %.3f seconds; %.1f microseconds CPU per record' % (
+                sites, minutes, collector.received, lost, collector.late, collector.rejected, elapsed, cpu / max(collector.received, 1) * 1e6
+            ))
+    print('%d minutes of consensus; worst consensus error %.6f seconds' % (len(results), worst))
+    print('flagged: %s' % (', '.join(sorted(flagged)) if flagged else 'none'))
+    expected_flagged = set(['site%03d' % (site) for site in range(bad)])
+    collector.close()
+    if flagged != expected_flagged:
+        sys.exit('expected %s flagged' % (', '.join(sorted(expected_flagged))))
+
+def main(args=None):
+    """ main """
+    if args is None:
+        args = sys.argv[1:]
+    doit(args)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+
+"""
+A simple benchmark of writing samples into an NTP shared memory segment
+
+Copyright (C) 2023 Martin J Levy - W6LHI/G8LHI - @mahtin - https://github.com/mahtin
+"""
+
+import os
+import sys
+import time
+import datetime
+
+sys.path.insert(0, os.path.abspath('.'))
+
+from wwvb.ntpdriver28 import NTPDriver28, NTPDriver28Error, NTPD_DEFAULT_KEY, ARCH_TO_BITS
+
+try:
+    import sysv_ipc
+except ImportError:
+    sysv_ipc = None
+
+# a unit well away from anything ntpd or chronyd should be using
+DEFAULT_UNIT = 250
+DEFAULT_LOOPS = 100000
+
+def report(name, loops, elapsed):
+    """ report """
+    print('%-12s %d updates in %.3f seconds; %.3f microseconds per update' % (
+                name,
+                loops,
+                elapsed / 1e9,
+                elapsed / loops / 1000.0,
+            ))
+
+def doit(args):
+    """ doit """
+
+    if not sysv_ipc:
+        sys.exit('sysv_ipc package not installed - no shared memory access')
+
+    unit = DEFAULT_UNIT
+    loops = DEFAULT_LOOPS
+    try:
+        if len(args) > 0:
+            unit = int(args[0])
+        if len(args) > 1:
+            loops = int(args[1])
+    except ValueError:
+        sys.exit('usage: shm_bench.py [unit [loops]]')
+
+    size = 96 if ARCH_TO_BITS.get(os.uname().machine, 32) == 64 else 80
+
+    # we create (and later remove) our own segment - never touch a live one
+    try:
+        shm = sysv_ipc.SharedMemory(NTPD_DEFAULT_KEY + unit, sysv_ipc.IPC_CREX, mode=0o666, size=size)
+    except sysv_ipc.ExistentialError as err:
+        sys.exit('unit %d: %s - pick another unit' % (unit, err))
+
+    try:
+        d28 = NTPDriver28(unit=unit)
+        wwvb_dt = datetime.datetime(2023, 3, 4, 12, 58, 22, 5018, tzinfo=datetime.timezone.utc)
+        sys_dt = wwvb_dt + datetime.timedelta(microseconds=1234)
+
+        wwvb_ns = 1677934702005018000
+        sys_ns = wwvb_ns + 1234567
+
+        # warm up
+        for _ in range(1000):
+            d28.update(wwvb_dt, sys_dt)
+
+        start = time.perf_counter_ns()
+        for _ in range(loops):
+            d28.update(wwvb_dt, sys_dt)
+        elapsed = time.perf_counter_ns() - start
+        report('update()', loops, elapsed)
+
+        start = time.perf_counter_ns()
+        for _ in range(loops):
+            d28.update_ns(wwvb_ns, sys_ns)
+        elapsed = time.perf_counter_ns() - start
+        report('update_ns()', loops, elapsed)
+
+        del d28
+    except NTPDriver28Error as err:
+        print(err, file=sys.stderr)
+    finally:
+        shm.detach()
+        shm.remove()
+
+def main(args=None):
+    """ main """
+    if args is None:
+        args = sys.argv[1:]
+    doit(args)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+
+"""
+Stand in for ntpd; consume samples from an NTP shared memory unit and show what ntpd would see
+
+Copyright (C) 2023 Martin J Levy - W6LHI/G8LHI - @mahtin - https://github.com/mahtin
+"""
+
+import os
+import sys
+import time
+import getopt
+import logging
+
+sys.path.insert(0, os.path.abspath('.'))
+
+from wwvb.shmconsumer import SHMConsumer, SHMConsumerError, DEFAULT_NSAMPLES
+
+DEFAULT_UNIT = 2
+DEFAULT_POLL = 64               # seconds; ntpd's default minpoll for a refclock (2^6)
+
+def percentile(values, fraction):
+    """ percentile """
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+def doit(args):
+    """ doit """
+
+    usage = 'usage: shm_consumer.py [-v|--verbose] [-p|--poll=seconds] [-n|--nsamples=N] [unit]'
+
+    required_format = '%(asctime)s %(name)s %(levelname)s %(message)s'
+    logging.basicConfig(format=required_format)
+
+    flag_verbose = False
+    poll = DEFAULT_POLL
+    nsamples = DEFAULT_NSAMPLES
+
+    try:
+        opts, args = getopt.getopt(args, 'vp:n:', ['verbose', 'poll=', 'nsamples='])
+        for opt, arg in opts:
+            if opt in ('-v', '--verbose'):
+                flag_verbose = True
+            if opt in ('-p', '--poll'):
+                poll = float(arg)
+            if opt in ('-n', '--nsamples'):
+                nsamples = int(arg)
+        unit = int(args[0]) if len(args) > 0 else DEFAULT_UNIT
+    except (getopt.GetoptError, ValueError):
+        sys.exit(usage)
+
+    try:
+        consumer = SHMConsumer(unit=unit, nsamples=nsamples, verbose=flag_verbose)
+    except SHMConsumerError as err:
+        sys.exit(err)
+
+    next_poll = time.monotonic() + poll
+    while True:
+        try:
+            # ntpd's shm_timer() runs once a second
+            (status, offset) = consumer.poll()
+            if status not in ['OK', 'NOTREADY']:
+                print('%s: %s' % (consumer, status))
+            elif offset is not None:
+                print('%s: sample offset %+.9f' % (consumer, offset))
+            sys.stdout.flush()
+
+            if time.monotonic() >= next_poll:
+                next_poll += poll
+                result = consumer.sample()
+                if result:
+                    (offset, jitter, n) = result
+                    latency = consumer.latency_ns
+                    print('%s: poll offset %+.9f jitter %.9f from %d samples; publish to poll latency p50 %.3fs p99 %.3fs; %s' % (
+                                consumer, offset, jitter, n,
+                                percentile(latency, 0.50) / 1e9,
+                                percentile(latency, 0.99) / 1e9,
+                                consumer.status,
+                            ))
+                    consumer.latency_ns = []
+                sys.stdout.flush()
+            time.sleep(1.0)
+        except KeyboardInterrupt:
+            break
+
+def main(args=None):
+    """ main """
+    if args is None:
+        args = sys.argv[1:]
+    doit(args)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+
+"""
+Stress the NTP shared memory handshake with a concurrent reader process
+
+The writer (NTPDriver28) stores identical clock and receive timestamps in every sample.
+The reader behaves like ntpd (mode 1) or chronyd (mode 0) and counts any accepted
+sample where the two differ - i.e. a torn sample.
+
+The writer pauses WRITE_INTERVAL between samples; as ntpd and chronyd clear valid once they have a
+sample, a writer that never paused would clear it again before the reader got there (and the run
+would say nothing). At least MIN_ACCEPTED of the samples written must be accepted.
+
+Left alone the two processes rarely overlap; hence every HOLD_EVERY samples seen the reader forces one.
+Having seen valid set (and, in mode 1, taken count) it asks the writer to start a sample; the writer
+stops half way (valid cleared, count bumped, seconds written but not nanoseconds) until the reader
+has taken its copy. Every one of these forced copies must be rejected.
+
+Copyright (C) 2023 Martin J Levy - W6LHI/G8LHI - @mahtin - https://github.com/mahtin
+"""
+
+import os
+import sys
+import time
+import datetime
+import multiprocessing
+
+sys.path.insert(0, os.path.abspath('.'))
+
+from wwvb.ntpdriver28 import NTPDriver28, NTPDriver28Error, NTPD_DEFAULT_KEY, ARCH_TO_BITS
+from wwvb.ntpdriver28 import SHM_LAYOUT32, SHM_LAYOUT64, SHM_SAMPLE_FIELDS, SHM_NSEC_FIELDS, compile_layout
+
+try:
+    import sysv_ipc
+except ImportError:
+    sysv_ipc = None
+
+# a unit well away from anything ntpd or chronyd should be using
+DEFAULT_UNIT = 251
+DEFAULT_SECONDS = 5
+HOLD_EVERY = 10             # samples seen between forced mid-write copies
+HOLD_TIMEOUT = 1.0          # seconds either side waits for the other
+WRITE_INTERVAL = 0.0005     # seconds between samples; long enough for the reader to see valid set
+MIN_ACCEPTED = 0.5          # fraction of the samples written that must be accepted
+
+class HoldingDriver(NTPDriver28):
+    """ HoldingDriver - NTPDriver28 that stops mid-write when the reader asks it to """
+
+    def __init__(self, want, held, release, **kwargs):
+        """ __init__ """
+        super().__init__(**kwargs)
+        self._want = want
+        self._held = held
+        self._release = release
+
+    def _put(self, compiled, offset, *values):
+        """ _put - the first put of a sample is the seconds; the nanoseconds come next """
+        super()._put(compiled, offset, *values)
+        if not self._want.is_set() or len(values) < 4:
+            return
+        self._want.clear()
+        self._held.set()
+        self._release.wait(HOLD_TIMEOUT)
+        self._release.clear()
+
+def _forced_copy(view, want, held, release):
+    """ _forced_copy - a copy taken while the writer is held mid-write (None if it never got there) """
+    held.clear()
+    want.set()
+    if not held.wait(HOLD_TIMEOUT):
+        want.clear()
+        return None
+    copy = bytes(view)
+    release.set()
+    return copy
+
+def reader(unit, mode, seconds, want, held, release, results):
+    """ reader() - runs in its own process """
+
+    shm = sysv_ipc.SharedMemory(NTPD_DEFAULT_KEY + unit)
+    view = memoryview(shm)
+    layout = SHM_LAYOUT64 if shm.size == 96 else SHM_LAYOUT32
+    count_offset = layout['count'][0]
+    valid_offset = layout['valid'][0]
+    (sample_offset, sample) = compile_layout(layout, SHM_SAMPLE_FIELDS)
+    (nsec_offset, nsec) = compile_layout(layout, SHM_NSEC_FIELDS)
+    (_, word) = compile_layout(layout, ['count'])
+
+    accepted = rejected = torn = forced = missed = 0
+    seen = 0
+    end = time.monotonic() + seconds
+    while time.monotonic() < end:
+        # only a sample that is there now can be interrupted mid-write
+        force = False
+        if word.unpack_from(view, valid_offset)[0]:
+            seen += 1
+            force = seen % HOLD_EVERY == 0
+        if mode == 1:
+            # ntpd's refclock_shm: check valid, snapshot count, copy, recheck count
+            # (plus valid within the copy - the writer clears it before touching anything)
+            if not word.unpack_from(view, valid_offset)[0]:
+                continue
+            count = word.unpack_from(view, count_offset)[0]
+            copy = _forced_copy(view, want, held, release) if force else bytes(view)
+            if copy is None:
+                continue
+            if count != word.unpack_from(view, count_offset)[0] or not word.unpack_from(copy, valid_offset)[0]:
+                rejected += 1
+                forced += force
+                continue
+        else:
+            # chronyd's refclock_shm: copy, then check valid in the copy
+            copy = _forced_copy(view, want, held, release) if force else bytes(view)
+            if copy is None:
+                continue
+            if not word.unpack_from(copy, valid_offset)[0]:
+                rejected += force
+                forced += force
+                continue
+        missed += force
+        word.pack_into(view, valid_offset, 0)
+
+        (c_sec, c_usec, r_sec, r_usec, _, _) = sample.unpack_from(copy, sample_offset)
+        (c_nsec, r_nsec) = nsec.unpack_from(copy, nsec_offset)
+        if (c_sec, c_usec, c_nsec) != (r_sec, r_usec, r_nsec) or c_nsec // 1000 != c_usec:
+            torn += 1
+        accepted += 1
+
+    view.release()
+    shm.detach()
+    results.put((accepted, rejected, torn, forced, missed))
+
+def doit(args):
+    """ doit """
+
+    if not sysv_ipc:
+        sys.exit('sysv_ipc package not installed - no shared memory access')
+
+    mode = 1
+    seconds = DEFAULT_SECONDS
+    unit = DEFAULT_UNIT
+    try:
+        if len(args) > 0:
+            mode = int(args[0])
+        if len(args) > 1:
+            seconds = float(args[1])
+        if len(args) > 2:
+            unit = int(args[2])
+    except ValueError:
+        sys.exit('usage: shm_stress.py [mode [seconds [unit]]]')
+
+    size = 96 if ARCH_TO_BITS.get(os.uname().machine, 32) == 64 else 80
+
+    # we create (and later remove) our own segment - never touch a live one
+    # (zero filled; sysv_ipc fills with spaces by default, which reads as valid)
+    try:
+        shm = sysv_ipc.SharedMemory(NTPD_DEFAULT_KEY + unit, sysv_ipc.IPC_CREX, mode=0o666, size=size, init_character=b'\0')
+    except sysv_ipc.ExistentialError as err:
+        sys.exit('unit %d: %s - pick another unit' % (unit, err))
+
+    try:
+        want = multiprocessing.Event()
+        held = multiprocessing.Event()
+        release = multiprocessing.Event()
+        d28 = HoldingDriver(want, held, release, unit=unit, mode=mode)
+
+        results = multiprocessing.Queue()
+        child = multiprocessing.Process(target=reader, args=(unit, mode, seconds, want, held, release, results))
+        child.start()
+
+        base = datetime.datetime(2023, 3, 4, 12, 0, 0, tzinfo=datetime.timezone.utc)
+        written = 0
+        while child.is_alive():
+            dt = base + datetime.timedelta(seconds=written, milliseconds=written % 1000)
+            d28.update(dt, dt)
+            written += 1
+            time.sleep(WRITE_INTERVAL)
+
+        (accepted, rejected, torn, forced, missed) = results.get()
+        child.join()
+        del d28
+
+        print('mode %d: %d samples written, %d accepted, %d rejected (%d of them forced mid-write), %d forced copies accepted, %d torn' % (
+                    mode, written, accepted, rejected, forced, missed, torn
+                ))
+        if forced == 0:
+            print('no mid-write copy was forced; the reject path was not exercised')
+            sys.exit(1)
+        if accepted < MIN_ACCEPTED * written:
+            print('only %d of %d samples accepted; too few to show anything' % (accepted, written))
+            sys.exit(1)
+        if missed or (torn and mode == 1):
+            sys.exit(1)
+        if torn:
+            # mode 0 has no count; a reader that is pre-empted mid-copy can't tell
+            print('mode 0 cannot detect a writer that completes during the copy - use mode 1 if possible')
+    except NTPDriver28Error as err:
+        print(err, file=sys.stderr)
+    finally:
+        shm.detach()
+        shm.remove()
+
+def main(args=None):
+    """ main """
+    if args is None:
+        args = sys.argv[1:]
+    doit(args)
+
+if __name__ == '__main__':
+    main()
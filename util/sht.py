@@ -1,7 +1,10 @@
 #!/usr/bin/env python3
 
 """
-A simple display of the NTP shared memory segment
+A simple display of the NTP shared memory segment(s)
+
+Attaches read-only to one or more units and polls just the count word.
+A segment is only decoded when its count changes.
 
 Copyright (C) 2023 Martin J Levy - W6LHI/G8LHI - @mahtin - https://github.com/mahtin
 """
@@ -9,7 +12,7 @@ Copyright (C) 2023 Martin J Levy - W6LHI/G8LHI - @mahtin - https://github.com/ma
 import os
 import sys
 import time
-import datetime
+import getopt
 import logging
 
 sys.path.insert(0, os.path.abspath('.'))
@@ -19,35 +22,134 @@ from wwvb.ntpdriver28 import NTPDriver28, NTPDriver28Error
 # based on ...
 # https://github.com/ntp-project/ntp/blob/9c75327c3796ff59ac648478cd4da8b205bceb77/util/sht.c
 
+DEFAULT_UNIT = 2
+DEFAULT_RATE = 10.0             # polls per second
+
+class UnitMonitor:
+    """ UnitMonitor
+
+    Change driven view of one unit
+    """
+
+    def __init__(self, unit, debug=False):
+        """ __init__ """
+        self.d28 = NTPDriver28(unit=unit, debug=debug, read_only=True)
+        self.count = self.d28.count()
+        self.samples = 0
+        self.torn = 0
+        self.first_change = None
+        self.last_change = None
+        self.last = None
+
+    def poll(self, now):
+        """ poll() - returns a decoded sample if count changed, else None """
+        count = self.d28.count()
+        if count == self.count:
+            return None
+        values = self.d28.snapshot()
+        if values is None:
+            # the writer was part way through (count moved or valid clear) - we see it next poll
+            self.torn += 1
+            return None
+        self.count = values['count']
+        self.samples += 1
+        if self.first_change is None:
+            self.first_change = now
+        self.last_change = now
+        self.last = values
+        return values
+
+    def rate(self):
+        """ rate() - samples per minute since the first change we saw """
+        if self.samples < 2:
+            return 0.0
+        return (self.samples - 1) * 60.0 / (self.last_change - self.first_change)
+
+def sample_ns(values, prefix):
+    """ sample_ns() - nanoseconds since the epoch; from Sec + NSec (or USec if NSec isn't filled in) """
+    nsec = values[prefix + 'NSec']
+    if nsec == 0:
+        nsec = values[prefix + 'USec'] * 1000
+    return values[prefix + 'Sec'] * 1000000000 + nsec
+
 def doit(args):
     """ doit """
 
+    usage = 'usage: sht.py [-d|--debug] [-r|--rate=polls-per-second] [unit ...]'
+
     required_format = '%(asctime)s %(name)s %(levelname)s %(message)s'
     logging.basicConfig(format=required_format)
     logging.basicConfig(level=logging.INFO)
 
-    if len(args) > 0:
+    flag_debug = False
+    rate = DEFAULT_RATE
+
+    try:
+        opts, args = getopt.getopt(args, 'dr:', ['debug', 'rate='])
+    except getopt.GetoptError:
+        sys.exit(usage)
+
+    for opt, arg in opts:
+        if opt in ('-d', '--debug'):
+            flag_debug = True
+            continue
+        if opt in ('-r', '--rate'):
+            try:
+                rate = float(arg)
+                if rate <= 0.0:
+                    raise ValueError
+            except ValueError:
+                sys.exit('%s: invalid rate\n%s' % (arg, usage))
+            continue
+
+    units = []
+    for arg in args:
         try:
-            unit = int(args[0])
+            units.append(int(arg))
         except ValueError:
-            sys.exit('%s: invalid argument - should be interger' % (args[0]))
-    else:
-        unit = 2
+            sys.exit('%s: invalid argument - should be interger' % (arg))
+    if len(units) == 0:
+        units = [DEFAULT_UNIT]
 
-    try:
-        d28 = NTPDriver28(unit=unit, debug=True)
-    except NTPDriver28Error as err:
-        sys.exit(err)
+    monitors = {}
+    for unit in units:
+        try:
+            monitors[unit] = UnitMonitor(unit, debug=flag_debug)
+        except NTPDriver28Error as err:
+            sys.exit('unit %d: %s' % (unit, err))
 
+    interval = 1.0 / rate
+    next_poll = time.monotonic()
     while True:
         try:
-            d28.load()
-            d28.dump()
-            time.sleep(1)
+            now = time.monotonic()
+            for unit, monitor in monitors.items():
+                values = monitor.poll(now)
+                if values is None:
+                    continue
+                clock_ns = sample_ns(values, 'clockTimeStamp')
+                receive_ns = sample_ns(values, 'receiveTimeStamp')
+                print('unit %d: count=%d valid=%d leap=%d precision=%d offset=%+.9f age=%.3f rate=%.2f/min torn=%d' % (
+                            unit,
+                            values['count'],
+                            values['valid'],
+                            values['leap'],
+                            values['precision'],
+                            (clock_ns - receive_ns) / 1e9,
+                            (time.time_ns() - receive_ns) / 1e9,
+                            monitor.rate(),
+                            monitor.torn,
+                        ))
+                sys.stdout.flush()
+                if flag_debug:
+                    monitor.d28.load()
+                    monitor.d28.dump()
+            next_poll += interval
+            time.sleep(max(0.0, next_poll - time.monotonic()))
         except KeyboardInterrupt:
             break
 
-    del d28
+    monitors.clear()
 
 def main(args=None):
     """ main """
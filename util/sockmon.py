@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+
+"""
+A simple display of samples sent to a chrony SOCK refclock
+
+Run this in place of chronyd (it binds the socket itself) to see what wwvb sends.
+
+Copyright (C) 2023 Martin J Levy - W6LHI/G8LHI - @mahtin - https://github.com/mahtin
+"""
+
+import os
+import sys
+import socket
+import datetime
+
+sys.path.insert(0, os.path.abspath('.'))
+
+from wwvb.chronysock import SOCK_SAMPLE, SOCK_MAGIC
+
+DEFAULT_PATH = '/tmp/chrony.wwvb.sock'
+
+def doit(args):
+    """ doit """
+
+    if len(args) > 0:
+        path = args[0]
+    else:
+        path = DEFAULT_PATH
+
+    if os.path.exists(path):
+        os.unlink(path)
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    sock.bind(path)
+    print('listening on %s' % (path))
+
+    try:
+        while True:
+            data = sock.recv(1024)
+            if len(data) != SOCK_SAMPLE.size:
+                print('bad sample size %d (expected %d)' % (len(data), SOCK_SAMPLE.size))
+                continue
+            (tv_sec, tv_usec, offset, pulse, leap, _, magic) = SOCK_SAMPLE.unpack(data)
+            if magic != SOCK_MAGIC:
+                print('bad magic 0x%08x' % (magic))
+                continue
+            dt = datetime.datetime.fromtimestamp(tv_sec, datetime.timezone.utc).replace(microsecond=tv_usec)
+            print('%s offset=%+.9f pulse=%d leap=%d' % (dt, offset, pulse, leap))
+            sys.stdout.flush()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sock.close()
+        os.unlink(path)
+
+def main(args=None):
+    """ main """
+    if args is None:
+        args = sys.argv[1:]
+    doit(args)
+
+if __name__ == '__main__':
+    main()
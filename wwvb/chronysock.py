@@ -0,0 +1,181 @@
+""" chrony SOCK refclock driver
+
+See README.md for detailed/further reading.
+
+Copyright (C) 2023 Martin J Levy - W6LHI/G8LHI - @mahtin - https://github.com/mahtin
+"""
+
+import socket
+import struct
+import logging
+
+try:
+    import ctypes
+except ImportError:
+    ctypes = None
+
+from es100 import trace
+
+from .ntpdriver28 import NTPSample, datetime_to_ns
+
+# https://github.com/mlichvar/chrony/blob/master/refclock_sock.c
+SOCK_MAGIC = 0x534f434b
+
+# struct sock_sample {
+#   struct timeval tv;      /* Time of the measurement (system time) */
+#   double offset;          /* Offset between the true time and the system time (in seconds) */
+#   int pulse;              /* Non-zero if the sample is from a PPS signal */
+#   int leap;               /* 0 - normal, 1 - insert leap second, 2 - delete leap second */
+#   int _pad;               /* Padding, ignored */
+#   int magic;              /* Protocol identifier (SOCK_MAGIC) */
+# };
+# chronyd is on the same host; hence native alignment is right. The size of struct timeval isn't
+# always a long each: 32-bit Linux built with a 64-bit time_t (i.e. Debian's armhf t64 and later,
+# as on a Pi) has two 8 byte fields. chronyd drops any datagram that isn't sizeof(struct sock_sample);
+# 32 bytes with a 32-bit time_t and 40 bytes with a 64-bit time_t.
+SOCK_SAMPLES = {
+    32: struct.Struct('@iidiiii'),
+    64: struct.Struct('@qqdiiii'),
+}
+SOCK_SAMPLE_SIZES = {32: 32, 64: 40}
+
+def time_t_bits():
+    """ time_t_bits()
+
+    :return: 32 or 64; the size of time_t in bits for this Python (and hence, most likely, chronyd)
+    """
+    c_time_t = getattr(ctypes, 'c_time_t', None) if ctypes else None
+    if c_time_t is not None:
+        # Python 3.12 and later
+        return ctypes.sizeof(c_time_t) * 8
+    # before that, assume time_t is a long; wrong only on 32-bit systems with a 64-bit time_t
+    return struct.calcsize('@l') * 8
+
+SOCK_SAMPLE = SOCK_SAMPLES.get(time_t_bits(), SOCK_SAMPLES[64])
+
+class ChronySOCKError(Exception):
+    """ raise this any ChronySOCK error """
+
+class ChronySOCK:
+    """ ChronySOCK()
+
+    :param path: The socket path configured via "refclock SOCK" in chrony.conf
+    :param time_bits: Size of chronyd's time_t (32 or 64); None to use this Python's
+    :param debug: True to enable debug messages
+    :param verbose: True to enable verbose messages
+    :return: New instance of ChronySOCK()
+
+    Pushes each sample to chronyd over a Unix datagram socket.
+    See https://chrony-project.org/doc/latest/chrony.conf.html#refclock
+
+    chronyd creates (and owns) the socket; we simply send to it.
+    """
+
+    def __init__(self, path=None, time_bits=None, debug=False, verbose=False):
+        """ :meta private: """
+
+        self._sock = None
+
+        if not isinstance(path, str) or len(path) == 0:
+            raise ChronySOCKError('chrony socket path invalid "%s"' % (path))
+        self._path = path
+
+        if time_bits is None:
+            time_bits = time_t_bits()
+        if time_bits not in SOCK_SAMPLES:
+            raise ChronySOCKError('chrony time_t size invalid: %s (must be 32 or 64)' % (time_bits))
+        self._sample = SOCK_SAMPLES[time_bits]
+        if self._sample.size != SOCK_SAMPLE_SIZES[time_bits]:
+            raise ChronySOCKError('chrony sample is %d bytes; chronyd expects %d' % (self._sample.size, SOCK_SAMPLE_SIZES[time_bits]))
+        self._time_bits = time_bits
+
+        self._log = logging.getLogger(__class__.__name__)
+
+        self._debug = debug
+        if self._debug:
+            self._log.setLevel(logging.DEBUG)
+
+        self._verbose = verbose
+        if self._verbose:
+            self._log.setLevel(logging.INFO)
+
+        try:
+            self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        except OSError as err:
+            raise ChronySOCKError('unable to create socket: %s' % (err)) from err
+        self._sock.setblocking(False)
+
+        self._log.info('SOCK ready: %s', self)
+
+    def __del__(self):
+        """ __del__ """
+        if self._sock:
+            self._sock.close()
+            self._sock = None
+
+    def __str__(self):
+        """ __str__ """
+        return '[SOCK %s]' % (self._path)
+
+    def __repr__(self):
+        """ __repr__ """
+        return self.__str__()
+
+    def update(self, received_dt, sys_received_dt, leap_second=None):
+        """ update()
+
+        :param received_dt: WWVB received date and time
+        :param sys_received_dt: System time when received
+        :param leap_second: leap second indication
+
+        Send the sample to chronyd
+        """
+
+        self.update_ns(datetime_to_ns(received_dt), datetime_to_ns(sys_received_dt), leap_second)
+
+    def update_ns(self, received_ns, sys_received_ns, leap_second=None):
+        """ update_ns()
+
+        :param received_ns: WWVB received time in nanoseconds since the epoch
+        :param sys_received_ns: System time when received in nanoseconds since the epoch
+        :param leap_second: leap second indication
+
+        Send the sample to chronyd
+        """
+
+        self.publish(NTPSample(received_ns, sys_received_ns, leap_second))
+
+    def publish(self, sample):
+        """ publish()
+
+        :param sample: NTPSample instance
+
+        Send a precomputed sample to chronyd
+        """
+
+        self._log.info('publish(%s)', sample)
+
+        if sample.leap > 2:
+            # chrony has no value for LEAP_NOTINSYNC - don't send anything
+            self._log.warning('%s: leap second "%s" unknown - sample not sent', self, sample.leap_second)
+            return
+
+        data = self._sample.pack(
+                    sample.receive_sec, sample.receive_nsec // 1000,
+                    sample.offset,
+                    0,
+                    sample.leap,
+                    0,
+                    SOCK_MAGIC
+                )
+        start_ns = trace.begin()
+        try:
+            self._sock.sendto(data, self._path)
+        except OSError as err:
+            # normally chronyd isn't running (or not configured for this socket)
+            raise ChronySOCKError('%s: send failed: %s' % (self, err)) from err
+        finally:
+            if start_ns:
+                trace.end('chrony.publish', start_ns, {'path': self._path})
+
+        self._log.debug('Sending time to chronyd offset=%.9f leap=%d', sample.offset, sample.leap)
@@ -8,6 +8,22 @@ Copyright (C) 2023 Martin J Levy - W6LHI/G8LHI - @mahtin - https://github.com/ma
 import os
 import configparser
 
+DEFAULT_RECEIVER_NAME = 'es100'    # the one (unnamed) receiver configured by [WWVB]
+
+def config_list(config_value):
+    """ config_list()
+    :param config_value: a single value or a comma separated string
+
+    :return: list of values (strings stripped); an empty list for None
+    """
+    if config_value is None:
+        return []
+    if isinstance(config_value, str):
+        return [v.strip() for v in config_value.split(',') if len(v.strip()) > 0]
+    if isinstance(config_value, list):
+        return config_value
+    return [config_value]
+
 def readconfig(filename='wwvb.ini'):
     """ readconfig()
     :param filename: config file name
@@ -45,6 +61,21 @@ def readconfig(filename='wwvb.ini'):
         for option in ['nighttime', 'tracking']:
             config_value = cp.getboolean(section, option, fallback=False)
             values[section.lower() + '.' + option] = config_value
+        for option in ['clock_step']:
+            config_value = cp.get(section, option, fallback=None)
+            if isinstance(config_value, str) and len(config_value) == 0:
+                config_value = None
+            try:
+                if config_value is not None:
+                    config_value = float(config_value)
+            except (ValueError, TypeError):
+                pass
+            values[section.lower() + '.' + option] = config_value
+        for option in ['receivers']:
+            config_value = cp.get(section, option, fallback=None)
+            if isinstance(config_value, str) and len(config_value) == 0:
+                config_value = None
+            values[section.lower() + '.' + option] = config_value
         for option in ['station']:
             config_value = cp.get(section, option, fallback=None)
             if isinstance(config_value, str) and len(config_value) == 0:
@@ -62,7 +93,25 @@ def readconfig(filename='wwvb.ini'):
 
     section = 'NTPD'
     if cp.has_section(section):
-        for option in ['unit']:
+        for option in ['unit', 'mode']:
+            config_value = cp.get(section, option, fallback=None)
+            if isinstance(config_value, str) and len(config_value) == 0:
+                config_value = None
+            try:
+                if config_value is not None:
+                    config_value = int(config_value)
+            except (ValueError, TypeError):
+                pass
+            values[section.lower() + '.' + option] = config_value
+
+    section = 'CHRONY'
+    if cp.has_section(section):
+        for option in ['socket']:
+            config_value = cp.get(section, option, fallback=None)
+            if isinstance(config_value, str) and len(config_value) == 0:
+                config_value = None
+            values[section.lower() + '.' + option] = config_value
+        for option in ['time_bits']:
             config_value = cp.get(section, option, fallback=None)
             if isinstance(config_value, str) and len(config_value) == 0:
                 config_value = None
@@ -73,6 +122,111 @@ def readconfig(filename='wwvb.ini'):
                 pass
             values[section.lower() + '.' + option] = config_value
 
+    section = 'METRICS'
+    if cp.has_section(section):
+        for option in ['port', 'address']:
+            config_value = cp.get(section, option, fallback=None)
+            if isinstance(config_value, str) and len(config_value) == 0:
+                config_value = None
+            try:
+                if config_value is not None and option == 'port':
+                    config_value = int(config_value)
+            except (ValueError, TypeError):
+                pass
+            values[section.lower() + '.' + option] = config_value
+
+    section = 'JOURNAL'
+    if cp.has_section(section):
+        for option in ['path', 'max_bytes', 'max_age', 'backups', 'fsync_interval']:
+            config_value = cp.get(section, option, fallback=None)
+            if isinstance(config_value, str) and len(config_value) == 0:
+                config_value = None
+            try:
+                if config_value is not None and option != 'path':
+                    config_value = float(config_value) if option == 'fsync_interval' else int(config_value)
+            except (ValueError, TypeError):
+                pass
+            values[section.lower() + '.' + option] = config_value
+
+    section = 'HISTORY'
+    if cp.has_section(section):
+        for option in ['path']:
+            config_value = cp.get(section, option, fallback=None)
+            if isinstance(config_value, str) and len(config_value) == 0:
+                config_value = None
+            values[section.lower() + '.' + option] = config_value
+
+    section = 'DAEMON'
+    if cp.has_section(section):
+        for option in ['socket', 'fixshm']:
+            config_value = cp.get(section, option, fallback=None)
+            if isinstance(config_value, str) and len(config_value) == 0:
+                config_value = None
+            values[section.lower() + '.' + option] = config_value
+        for option in ['processes']:
+            if cp.has_option(section, option):
+                config_value = cp.getboolean(section, option, fallback=False)
+                values[section.lower() + '.' + option] = config_value
+
+    section = 'REALTIME'
+    if cp.has_section(section):
+        for option in ['priority', 'prefault']:
+            config_value = cp.get(section, option, fallback=None)
+            if isinstance(config_value, str) and len(config_value) == 0:
+                config_value = None
+            try:
+                if config_value is not None:
+                    config_value = int(config_value)
+            except (ValueError, TypeError):
+                pass
+            values[section.lower() + '.' + option] = config_value
+        for option in ['cpus']:
+            config_value = cp.get(section, option, fallback=None)
+            if isinstance(config_value, str) and len(config_value) == 0:
+                config_value = None
+            values[section.lower() + '.' + option] = config_value
+        for option in ['gc_lead']:
+            config_value = cp.get(section, option, fallback=None)
+            if isinstance(config_value, str) and len(config_value) == 0:
+                config_value = None
+            try:
+                if config_value is not None:
+                    config_value = float(config_value)
+            except (ValueError, TypeError):
+                pass
+            values[section.lower() + '.' + option] = config_value
+        for option in ['enabled', 'lock_memory', 'gc_guard']:
+            if cp.has_option(section, option):
+                config_value = cp.getboolean(section, option, fallback=False)
+                values[section.lower() + '.' + option] = config_value
+
+    section = 'FLEET'
+    if cp.has_section(section):
+        for option in ['collector', 'site', 'listen']:
+            config_value = cp.get(section, option, fallback=None)
+            if isinstance(config_value, str) and len(config_value) == 0:
+                config_value = None
+            values[section.lower() + '.' + option] = config_value
+
+    # each receiver named in [WWVB] receivers has its own section; missing values come from [WWVB]
+    for receiver in config_list(values.get('wwvb.receivers')):
+        if cp.has_section(receiver):
+            section = receiver
+            for option in ['bus', 'address', 'irq', 'en', 'antenna']:
+                config_value = cp.get(section, option, fallback=None)
+                if isinstance(config_value, str) and len(config_value) == 0:
+                    config_value = None
+                try:
+                    if config_value is not None:
+                        config_value = int(config_value)
+                except (ValueError, TypeError):
+                    pass
+                values[section.lower() + '.' + option] = config_value
+            for option in ['gpiod']:
+                if cp.has_option(section, option):
+                    config_value = cp.getboolean(section, option, fallback=False)
+                    values[section.lower() + '.' + option] = config_value
+
     if our_station:
         if cp.has_section(our_station):
             section = our_station
@@ -0,0 +1,84 @@
+""" deadline.py
+
+Notice when a tracking START was missed because we were late getting back to the ES100
+
+Copyright (C) 2023 Martin J Levy - W6LHI/G8LHI - @mahtin - https://github.com/mahtin
+
+Tracking is started at HH:MM:55 and its IRQ comes about 24.5 seconds later (HH:MM:19 or so). The next
+START is due at the following :55; if whatever ran after the IRQ (decoding, publishing, logging, ...)
+takes us past it, ES100._wait_till_55seconds() quietly waits for the next minute and a whole minute
+of tracking is lost. The guard compares when the receiver is re-armed against when the START was due.
+
+A reception (rather than tracking) START has no such deadline; only the time to re-arm is kept.
+"""
+
+import logging
+
+MINUTE_NS = 60 * 1000000000
+START_SECOND = 55
+
+class DeadlineGuard:
+    """ DeadlineGuard()
+
+    :param name: Receiver name (for messages)
+    :param debug: True to enable debug messages
+    :param verbose: True to enable verbose messages
+    :return: New instance of DeadlineGuard()
+    """
+
+    def __init__(self, name, debug=False, verbose=False):
+        """ :meta private: """
+        self._name = name
+        self._irq_ns = None
+        self._tracking = False
+        self.missed = 0
+        self.last_rearm_ns = None
+
+        self._log = logging.getLogger('%s.%s' % (__class__.__name__, name))
+        self._debug = debug
+        if self._debug:
+            self._log.setLevel(logging.DEBUG)
+        self._verbose = verbose
+        if self._verbose:
+            self._log.setLevel(logging.INFO)
+
+    def __str__(self):
+        """ __str__ """
+        return '[deadline %s missed=%d]' % (self._name, self.missed)
+
+    def done(self, attempt):
+        """ done()
+
+        :param attempt: dict from ES100.attempt() (or None if there wasn't a new attempt)
+        """
+        if attempt:
+            self._irq_ns = attempt['irq_ns']
+            self._tracking = attempt['tracking']
+
+    def rearm(self, now_ns, tracking):
+        """ rearm()
+
+        :param now_ns: System time (nanoseconds since the epoch) we're about to START again
+        :param tracking: True if the START is for tracking
+        :return: Nanoseconds late (negative is the slack left) or None if this START had no deadline
+        """
+        irq_ns = self._irq_ns
+        self._irq_ns = None
+        if irq_ns is None:
+            return None
+        self.last_rearm_ns = now_ns - irq_ns
+        if not tracking or not self._tracking:
+            self._log.debug('re-armed %.3f seconds after the IRQ', self.last_rearm_ns / 1000000000.0)
+            return None
+
+        due_ns = irq_ns - irq_ns % MINUTE_NS + START_SECOND * 1000000000
+        if due_ns <= irq_ns:
+            due_ns += MINUTE_NS
+        late_ns = now_ns - due_ns
+        if late_ns > 0:
+            self.missed += 1
+            self._log.warning('tracking START missed by %.3f seconds (re-armed %.3f seconds after the IRQ); next START is a minute later',
+                                late_ns / 1000000000.0, self.last_rearm_ns / 1000000000.0)
+        else:
+            self._log.debug('re-armed %.3f seconds after the IRQ; %.3f seconds before the START', self.last_rearm_ns / 1000000000.0, -late_ns / 1000000000.0)
+        return late_ns
@@ -0,0 +1,387 @@
+""" fixserver.py
+
+Unix domain socket API for the latest WWVB fix; plus "wwvb query" to use it
+
+Copyright (C) 2023 Martin J Levy - W6LHI/G8LHI - @mahtin - https://github.com/mahtin
+
+The protocol is one line in, JSON lines out:
+
+    fix             the latest fix (see below) and then the connection stays open for more commands
+    subscribe       the latest fix (if any) and then every new fix as it's published
+    quit            close the connection
+
+A fix is a JSON object with these keys:
+
+    receiver        receiver name
+    mode            "reception" (only full receptions are fixes)
+    antenna         "Antenna1" or "Antenna2"
+    wwvb_time       decoded time (ISO 8601) including our latency
+    sys_received_ns system time (nanoseconds since the epoch) of the IRQ
+    offset          WWVB minus system time (seconds)
+    precision       precision published to the sinks (log2 seconds)
+    leap            leap indicator published to the sinks
+    delta_seconds   as reported by the ES100
+    votes           receivers that agreed with this fix (1 with a single receiver)
+    candidates      receivers that had a fix for this minute
+    age             seconds since sys_received_ns (when sent)
+
+If there's no fix yet, {"error": "no fix"} is returned.
+"""
+
+import os
+import sys
+import json
+import time
+import errno
+import socket
+import getopt
+import logging
+import selectors
+import threading
+from datetime import datetime, timezone
+
+from .config import readconfig
+
+DEFAULT_MAX_CLIENTS = 64            # connections beyond this are closed straight away
+DEFAULT_MAX_BUFFER = 64 * 1024      # bytes waiting for a slow client before it's dropped
+MAX_LINE = 1024                     # longest command accepted
+
+class FixServerError(Exception):
+    """ raise this any FixServer error """
+
+class _Client:
+    """ _Client """
+
+    __slots__ = ('sock', 'inbuf', 'outbuf', 'subscribed', 'sent_from')
+
+    def __init__(self, sock):
+        """ :meta private: """
+        self.sock = sock
+        self.inbuf = b''
+        self.outbuf = bytearray()
+        self.subscribed = False
+        self.sent_from = None
+
+class FixServer:
+    """ FixServer()
+
+    :param path: Unix domain socket path
+    :param max_clients: Maximum number of connected clients
+    :param max_buffer: Bytes waiting for a slow client before it's dropped
+    :param debug: True to enable debug messages
+    :param verbose: True to enable verbose messages
+    :return: New instance of FixServer()
+
+    update() is called from the reception loop; it only swaps a reference and writes one byte to wake
+    the server thread. All formatting, queries and (non-blocking) writes to clients are done by the server
+    thread; hence the number of clients has no effect on reception timing.
+    """
+
+    def __init__(self, path=None, max_clients=DEFAULT_MAX_CLIENTS, max_buffer=DEFAULT_MAX_BUFFER, debug=False, verbose=False):
+        """ :meta private: """
+
+        self._sock = None
+        self._thread = None
+
+        if not isinstance(path, str) or len(path) == 0:
+            raise FixServerError('fix server socket path invalid "%s"' % (path))
+        self._path = path
+        self._max_clients = max_clients
+        self._max_buffer = max_buffer
+
+        self._log = logging.getLogger(__class__.__name__)
+        self._debug = debug
+        if self._debug:
+            self._log.setLevel(logging.DEBUG)
+        self._verbose = verbose
+        if self._verbose:
+            self._log.setLevel(logging.INFO)
+
+        # written by update() (reception loop), read by the server thread
+        self._latest = None
+        # server thread only
+        self._formatted = None
+        self._formatted_from = None
+        self._clients = {}
+        self._selector = None
+        self._wake_r = None
+        self._wake_w = None
+        self._closing = False
+
+    def __del__(self):
+        """ __del__ """
+        self.stop()
+
+    def __str__(self):
+        """ __str__ """
+        return '[fixserver %s]' % (self._path)
+
+    def start(self):
+        """ start()
+
+        Listen on the socket and serve clients from a background (daemon) thread
+        """
+        try:
+            # a stale socket from a previous run stops the bind
+            os.unlink(self._path)
+        except FileNotFoundError:
+            pass
+        except OSError as err:
+            raise FixServerError('%s: %s' % (self._path, err)) from err
+        try:
+            self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self._sock.bind(self._path)
+            self._sock.listen(self._max_clients)
+            self._sock.setblocking(False)
+            (self._wake_r, self._wake_w) = socket.socketpair()
+        except OSError as err:
+            self._sock = None
+            raise FixServerError('%s: %s' % (self._path, err)) from err
+        self._wake_r.setblocking(False)
+        self._wake_w.setblocking(False)
+
+        self._selector = selectors.DefaultSelector()
+        self._selector.register(self._sock, selectors.EVENT_READ, None)
+        self._selector.register(self._wake_r, selectors.EVENT_READ, None)
+
+        self._thread = threading.Thread(target=self._serve, name='fixserver', daemon=True)
+        self._thread.start()
+        self._log.info('fix server ready: %s', self)
+
+    def stop(self):
+        """ stop() """
+        if self._thread is None:
+            return
+        self._closing = True
+        self._wakeup()
+        self._thread.join()
+        self._thread = None
+        try:
+            os.unlink(self._path)
+        except OSError:
+            pass
+
+    def update(self, reception, sample, votes=1, candidates=1):
+        """ update()
+
+        :param reception: Reception instance (full reception)
+        :param sample: NTPSample published for this reception
+        :param votes: Receivers that agreed with this fix
+        :param candidates: Receivers that had a fix for this minute
+
+        Called from the reception loop; never blocks
+        """
+        self._latest = (reception, sample, votes, candidates)
+        self._wakeup()
+
+    def _wakeup(self):
+        """ _wakeup """
+        if self._wake_w is None:
+            return
+        try:
+            self._wake_w.send(b'\0')
+        except OSError:
+            # already a wakeup waiting (or we're shutting down); either way nothing more to do
+            pass
+
+    def _fix(self, latest):
+        """ _fix """
+        if latest is not self._formatted_from:
+            (reception, sample, votes, candidates) = latest
+            fix = {
+                'receiver': reception.receiver,
+                'mode': 'reception',
+                'antenna': reception.rx_antenna,
+                'wwvb_time': datetime.fromtimestamp(sample.clock_sec, timezone.utc).replace(microsecond=sample.clock_nsec // 1000).isoformat(),
+                'sys_received_ns': sample.sys_received_ns,
+                'offset': sample.offset,
+                'precision': sample.precision,
+                'leap': sample.leap,
+                'delta_seconds': reception.delta_seconds,
+                'votes': votes,
+                'candidates': candidates,
+            }
+            # everything but the age is fixed; so only that's formatted per query
+            self._formatted = json.dumps(fix)[:-1] + ', "age": '
+            self._formatted_from = latest
+        return self._formatted
+
+    def _response(self, latest):
+        """ _response """
+        if latest is None:
+            return b'{"error": "no fix"}\n'
+        age = (time.time_ns() - latest[1].sys_received_ns) / 1000000000.0
+        return (self._fix(latest) + '%.6f}\n' % (age)).encode('utf-8')
+
+    def _serve(self):
+        """ _serve """
+        while not self._closing:
+            for key, events in self._selector.select():
+                sock = key.fileobj
+                if sock is self._sock:
+                    self._accept()
+                elif sock is self._wake_r:
+                    try:
+                        while self._wake_r.recv(4096):
+                            pass
+                    except OSError:
+                        pass
+                else:
+                    client = key.data
+                    if client.sock not in self._clients:
+                        # dropped earlier in this pass
+                        continue
+                    if events & selectors.EVENT_READ:
+                        self._read(client)
+                    if events & selectors.EVENT_WRITE and client.sock in self._clients:
+                        self._write(client)
+            latest = self._latest
+            if latest is not None:
+                # a new fix; stream it to every subscriber that hasn't already been sent it
+                line = None
+                for client in [c for c in self._clients.values() if c.subscribed and c.sent_from is not latest]:
+                    if line is None:
+                        line = self._response(latest)
+                    client.sent_from = latest
+                    self._send(client, line)
+
+        for client in list(self._clients.values()):
+            self._drop(client, 'shutdown')
+        self._selector.close()
+        self._sock.close()
+        self._wake_r.close()
+        self._wake_w.close()
+        self._sock = None
+        self._wake_w = None
+
+    def _accept(self):
+        """ _accept """
+        try:
+            (sock, _) = self._sock.accept()
+        except OSError:
+            return
+        if len(self._clients) >= self._max_clients:
+            self._log.warning('%s: too many clients; connection refused', self)
+            sock.close()
+            return
+        sock.setblocking(False)
+        client = _Client(sock)
+        self._clients[sock] = client
+        self._selector.register(sock, selectors.EVENT_READ, client)
+        self._log.debug('%s: client connected (%d)', self, len(self._clients))
+
+    def _read(self, client):
+        """ _read """
+        try:
+            data = client.sock.recv(4096)
+        except BlockingIOError:
+            return
+        except OSError as err:
+            self._drop(client, str(err))
+            return
+        if not data:
+            self._drop(client, 'closed')
+            return
+        client.inbuf += data
+        while b'\n' in client.inbuf:
+            (line, client.inbuf) = client.inbuf.split(b'\n', 1)
+            command = line.strip().decode('utf-8', 'replace').lower()
+            if command == 'fix':
+                self._send(client, self._response(self._latest))
+            elif command == 'subscribe':
+                # the fix sent now is the one not to stream again
+                client.subscribed = True
+                client.sent_from = self._latest
+                self._send(client, self._response(client.sent_from))
+            elif command == 'quit':
+                self._drop(client, 'quit')
+                return
+            elif command:
+                self._send(client, b'{"error": "unknown command"}\n')
+            if client.sock not in self._clients:
+                return
+        if len(client.inbuf) > MAX_LINE:
+            self._drop(client, 'line too long')
+
+    def _send(self, client, data):
+        """ _send """
+        if len(client.outbuf) + len(data) > self._max_buffer:
+            # never wait for a slow client
+            self._drop(client, 'too slow')
+            return
+        client.outbuf += data
+        self._write(client)
+
+    def _write(self, client):
+        """ _write """
+        try:
+            sent = client.sock.send(client.outbuf)
+        except BlockingIOError:
+            sent = 0
+        except OSError as err:
+            if err.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                self._drop(client, str(err))
+                return
+            sent = 0
+        del client.outbuf[:sent]
+        events = selectors.EVENT_READ | (selectors.EVENT_WRITE if client.outbuf else 0)
+        self._selector.modify(client.sock, events, client)
+
+    def _drop(self, client, reason):
+        """ _drop """
+        self._log.debug('%s: client dropped (%s)', self, reason)
+        del self._clients[client.sock]
+        self._selector.unregister(client.sock)
+        client.sock.close()
+
+def query(program_name, args):
+    """ query()
+
+    :param program_name: $0 in shell terms
+    :param args: $* in shell terms (after "query")
+    """
+
+    socket_path = None
+    flag_subscribe = False
+
+    usage = program_name + ' query ' + ' '.join([
+                                '[-h|--help]',
+                                '[--socket=path]',
+                                '[--subscribe]',
+                            ])
+
+    config = readconfig()
+    if 'daemon.socket' in config:
+        socket_path = config['daemon.socket']
+
+    try:
+        opts, args = getopt.getopt(args, 'h', ['help', 'socket=', 'subscribe'])
+    except getopt.GetoptError:
+        sys.exit('usage: ' + usage)
+
+    for opt, arg in opts:
+        if opt in ('-h', '--help'):
+            print("%s %s" % ('usage:', usage), file=sys.stderr)
+            sys.exit(0)
+        if opt == '--socket':
+            socket_path = arg
+        elif opt == '--subscribe':
+            flag_subscribe = True
+
+    if not socket_path:
+        print("%s %s" % (program_name, 'no socket (use --socket or [DAEMON] in wwvb.ini)'), file=sys.stderr)
+        sys.exit('usage: ' + usage)
+
+    try:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(socket_path)
+        sock.sendall(b'subscribe\n' if flag_subscribe else b'fix\n')
+        fd = sock.makefile('r', encoding='utf-8')
+        for line in fd:
+            print(line, end='')
+            sys.stdout.flush()
+            if not flag_subscribe:
+                break
+    except OSError as err:
+        sys.exit('%s: %s' % (socket_path, err))
+    sock.close()
@@ -0,0 +1,298 @@
+""" fixshm.py
+
+The latest fix in a small memory mapped file (normally under /dev/shm) guarded by a seqlock
+
+Copyright (C) 2023 Martin J Levy - W6LHI/G8LHI - @mahtin - https://github.com/mahtin
+
+For local programs that want the latest fix on every tick; reading it is a memory copy (no syscalls).
+The layout is native byte order (readers are on the same host) and 64 bytes long:
+
+    offset  type    name
+    0       4s      magic           b'WWVB'
+    4       H       version         2
+    6       H       size            64
+    8       I       seq             odd while being written; even when stable (0 means no fix yet)
+    12      I       check           CRC-32 (zlib.crc32) of the stable seq (4 bytes) then bytes 16 thru 63
+    16      q       wwvb_ns         WWVB time (plus our latency) in nanoseconds since the epoch
+    24      q       sys_ns          system time of the IRQ in nanoseconds since the epoch
+    32      d       offset          WWVB minus system time (seconds)
+    40      d       uncertainty     seconds (2 ** precision; precision is based on measured jitter)
+    48      q       published_ns    system time the fix was written
+    56      b       leap            NTP leap indicator
+    57      B       dst             DST bits from STATUS0 (bit 0 DST0, bit 1 DST1)
+    58      B       antenna         1 or 2
+    59      b       precision       log2 seconds
+    60      B       votes           receivers that agreed with this fix
+    61      B       candidates      receivers that had a fix for this minute
+    62      2x      (padding)
+
+The fix age is now minus sys_ns; readers work that out as they need it.
+
+Writer: seq becomes odd, the fix and check are written, seq becomes even.
+Reader: read seq (retry if odd), copy check and fix, read seq again (retry if it moved), then retry
+unless check matches that seq and the copied fix.
+
+Python has no memory barrier; on a weakly ordered CPU (i.e. the ARM in a Raspberry Pi) the reader can
+see the writer's stores in any order, and seq alone can't promise a consistent copy. The check can:
+a copy with a stable, even seq whose check matches is one complete write; a torn one fails the CRC.
+"""
+
+import os
+import mmap
+import time
+import zlib
+import struct
+import logging
+import threading
+from collections import namedtuple
+
+DEFAULT_FIXSHM_PATH = '/dev/shm/wwvb-fix'
+
+FIXSHM_MAGIC = b'WWVB'
+FIXSHM_VERSION = 2
+
+HEADER = struct.Struct('=4sHH')
+SEQ = struct.Struct('=I')
+SEQ_OFFSET = 8
+CHECK = struct.Struct('=I')
+CHECK_OFFSET = 12
+FIX = struct.Struct('=qqddqbBBbBB2x')
+FIX_OFFSET = 16
+FIXSHM_SIZE = FIX_OFFSET + FIX.size
+
+# pylint: disable=invalid-name
+FixSnapshot = namedtuple('FixSnapshot', [
+    'wwvb_ns', 'sys_ns', 'offset', 'uncertainty', 'published_ns',
+    'leap', 'dst', 'antenna', 'precision', 'votes', 'candidates', 'seq',
+])
+
+class FixSHMError(Exception):
+    """ raise this any FixSHM error """
+
+def _fence(barrier):
+    """ _fence() """
+    # A process-private threading.Lock; it orders nothing as seen from another process (see check above).
+    # It keeps this thread's steps in order and, on x86, that's also the order other processes see.
+    with barrier:
+        pass
+
+def _check(seq, fix):
+    """ _check() """
+    return zlib.crc32(fix, zlib.crc32(SEQ.pack(seq)))
+
+class FixSHM:
+    """ FixSHM()
+
+    :param path: File to memory map (Default is /dev/shm/wwvb-fix)
+    :param debug: True to enable debug messages
+    :param verbose: True to enable verbose messages
+    :return: New instance of FixSHM()
+
+    The (only) writer. The file is created if needed; readers use FixSHMReader().
+    """
+
+    def __init__(self, path=DEFAULT_FIXSHM_PATH, debug=False, verbose=False):
+        """ :meta private: """
+
+        self._mmap = None
+        self._view = None
+
+        if not isinstance(path, str) or len(path) == 0:
+            raise FixSHMError('fix shm path invalid "%s"' % (path))
+        self._path = path
+
+        self._log = logging.getLogger(__class__.__name__)
+        self._debug = debug
+        if self._debug:
+            self._log.setLevel(logging.DEBUG)
+        self._verbose = verbose
+        if self._verbose:
+            self._log.setLevel(logging.INFO)
+
+        try:
+            fd = os.open(self._path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                os.ftruncate(fd, FIXSHM_SIZE)
+                self._mmap = mmap.mmap(fd, FIXSHM_SIZE, mmap.MAP_SHARED, mmap.PROT_READ | mmap.PROT_WRITE)
+            finally:
+                os.close(fd)
+        except OSError as err:
+            raise FixSHMError('%s: %s' % (self._path, err)) from err
+        self._view = memoryview(self._mmap)
+        self._barrier = threading.Lock()
+
+        # start again; no fix until the first update()
+        self._seq = 0
+        SEQ.pack_into(self._view, SEQ_OFFSET, 0)
+        _fence(self._barrier)
+        HEADER.pack_into(self._view, 0, FIXSHM_MAGIC, FIXSHM_VERSION, FIXSHM_SIZE)
+
+        self._log.info('fix shm ready: %s', self)
+
+    def __del__(self):
+        """ __del__ """
+        self.close()
+
+    def __str__(self):
+        """ __str__ """
+        return '[fixshm %s]' % (self._path)
+
+    def close(self):
+        """ close() """
+        if self._view is not None:
+            self._view.release()
+            self._view = None
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+
+    def update(self, reception, sample, votes=1, candidates=1):
+        """ update()
+
+        :param reception: Reception instance (full reception)
+        :param sample: NTPSample published for this reception
+        :param votes: Receivers that agreed with this fix
+        :param candidates: Receivers that had a fix for this minute
+        """
+        attempt = reception.attempt
+        dst = ((attempt['status0'] or 0) >> 5) & 0x3 if attempt else 0
+        antenna = 2 if reception.rx_antenna == 'Antenna2' else 1
+        self.write(sample.received_ns, sample.sys_received_ns, sample.offset, 2.0 ** sample.precision,
+                    sample.leap, dst, antenna, sample.precision, votes, candidates)
+
+    def write(self, wwvb_ns, sys_ns, offset, uncertainty, leap, dst, antenna, precision, votes=1, candidates=1):
+        """ write()
+
+        :param wwvb_ns: WWVB time in nanoseconds since the epoch
+        :param sys_ns: System time when received in nanoseconds since the epoch
+        :param offset: WWVB minus system time (seconds)
+        :param uncertainty: Seconds
+        :param leap: NTP leap indicator
+        :param dst: DST bits
+        :param antenna: 1 or 2
+        :param precision: log2 seconds
+        :param votes: Receivers that agreed with this fix
+        :param candidates: Receivers that had a fix for this minute
+
+        The seqlock write; the check (not the fences) is what makes a reordered write detectable
+        """
+        view = self._view
+        fix = FIX.pack(wwvb_ns, sys_ns, offset, uncertainty, time.time_ns(),
+                        leap, dst, antenna, precision, min(votes, 255), min(candidates, 255))
+        # 0 means no fix; skip it when seq wraps
+        stable = ((self._seq + 2) & 0xffffffff) or 2
+        self._seq = (self._seq + 1) & 0xffffffff
+        SEQ.pack_into(view, SEQ_OFFSET, self._seq)
+        _fence(self._barrier)
+        view[FIX_OFFSET:FIXSHM_SIZE] = fix
+        CHECK.pack_into(view, CHECK_OFFSET, _check(stable, fix))
+        _fence(self._barrier)
+        self._seq = stable
+        SEQ.pack_into(view, SEQ_OFFSET, self._seq)
+
+class FixSHMReader:
+    """ FixSHMReader()
+
+    :param path: File written by FixSHM (Default is /dev/shm/wwvb-fix)
+    :return: New instance of FixSHMReader()
+
+    read() is a memory copy, two sequence checks and a CRC; no syscalls.
+    """
+
+    def __init__(self, path=DEFAULT_FIXSHM_PATH):
+        """ :meta private: """
+
+        self._mmap = None
+        self._view = None
+        self._path = path
+
+        try:
+            fd = os.open(self._path, os.O_RDONLY)
+            try:
+                self._mmap = mmap.mmap(fd, FIXSHM_SIZE, mmap.MAP_SHARED, mmap.PROT_READ)
+            finally:
+                os.close(fd)
+        except (OSError, ValueError) as err:
+            raise FixSHMError('%s: %s' % (self._path, err)) from err
+        self._view = memoryview(self._mmap)
+        self._barrier = threading.Lock()
+
+        (magic, version, size) = HEADER.unpack_from(self._view, 0)
+        if magic != FIXSHM_MAGIC or version != FIXSHM_VERSION or size != FIXSHM_SIZE:
+            self.close()
+            raise FixSHMError('%s: not a version %d fix file' % (self._path, FIXSHM_VERSION))
+
+    def __del__(self):
+        """ __del__ """
+        self.close()
+
+    def __str__(self):
+        """ __str__ """
+        return '[fixshm reader %s]' % (self._path)
+
+    def close(self):
+        """ close() """
+        if self._view is not None:
+            self._view.release()
+            self._view = None
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+
+    def seq(self):
+        """ seq()
+
+        :return: The present sequence number
+
+        A cheap check for a new fix - only four bytes are read
+        """
+        return SEQ.unpack_from(self._view, SEQ_OFFSET)[0]
+
+    def read(self, retries=1000):
+        """ read()
+
+        :param retries: Give up after this many torn reads
+        :return: FixSnapshot or None (no fix yet or the writer never got out of the way)
+        """
+        view = self._view
+        barrier = self._barrier
+        for _ in range(retries):
+            before = SEQ.unpack_from(view, SEQ_OFFSET)[0]
+            if before & 1:
+                continue
+            _fence(barrier)
+            copy = bytes(view[CHECK_OFFSET:FIXSHM_SIZE])
+            _fence(barrier)
+            if SEQ.unpack_from(view, SEQ_OFFSET)[0] != before:
+                continue
+            if before == 0:
+                return None
+            fix = copy[FIX_OFFSET - CHECK_OFFSET:]
+            if CHECK.unpack_from(copy, 0)[0] != _check(before, fix):
+                # torn; the stores arrived out of order
+                continue
+            return FixSnapshot(*FIX.unpack(fix), before)
+        return None
+
+    def read_unchecked(self, verify=False):
+        """ read_unchecked()
+
+        :param verify: True to still compare the check (against whatever seq is there)
+        :return: FixSnapshot (seq is 0); may be torn unless verify (then None if it is)
+
+        No sequence checks; only for showing that read() is needed, and that the check alone
+        catches a torn copy however the stores were ordered (see util/fixshm_stress.py)
+        """
+        copy = bytes(self._view[SEQ_OFFSET:FIXSHM_SIZE])
+        fix = copy[FIX_OFFSET - SEQ_OFFSET:]
+        if verify and CHECK.unpack_from(copy, CHECK_OFFSET - SEQ_OFFSET)[0] != _check(SEQ.unpack_from(copy, 0)[0], fix):
+            return None
+        return FixSnapshot(*FIX.unpack(fix), 0)
+
+    def age(self, snapshot):
+        """ age()
+
+        :param snapshot: FixSnapshot from read()
+        :return: Seconds since the fix was received
+        """
+        return (time.time_ns() - snapshot.sys_ns) / 1000000000.0
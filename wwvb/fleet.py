@@ -0,0 +1,475 @@
+""" fleet.py
+
+Send each fix to a fleet collector; plus "wwvb collect" - the collector
+
+Copyright (C) 2023 Martin J Levy - W6LHI/G8LHI - @mahtin - https://github.com/mahtin
+
+Every site sends one compact record per published fix over UDP (or a Unix datagram socket).
+The collector groups records by decoded WWVB minute; once a minute is complete it works out a
+consensus offset (weighted median; weights from each site's advertised precision) and the spread
+(MAD; median absolute deviation) and flags any site too far from the consensus.
+
+A record more than 30 seconds out is filed under the minute of its system time; so a site that
+decoded the wrong minute (or hour, or day) is flagged rather than being a minute of its own.
+
+Offsets are WWVB (already corrected for that site's distance to WWVB) minus that site's system time;
+so sites are comparable as long as their system clocks are (i.e. they run NTP).
+
+Record (network byte order; 64 bytes):
+
+    4s  magic       b'WWVF'
+    B   version     1
+    B   flags       0
+    H   (reserved)
+    16s site        site name (UTF-8, NUL padded)
+    q   wwvb_ns     WWVB time (plus latency) in nanoseconds since the epoch
+    q   sys_ns      system time of the IRQ in nanoseconds since the epoch
+    d   offset      WWVB minus system time (seconds)
+    q   latency_ns  distance correction already applied to wwvb_ns
+    b   precision   log2 seconds
+    b   leap        NTP leap indicator
+    B   antenna     1 or 2
+    B   votes       receivers (at that site) that agreed with this fix
+    B   candidates  receivers (at that site) that had a fix for this minute
+    3x  (padding)
+"""
+
+import os
+import sys
+import time
+import errno
+import socket
+import struct
+import getopt
+import logging
+import selectors
+from datetime import datetime, timezone
+
+from .config import readconfig
+
+DEFAULT_FLEET_PORT = 9761
+DEFAULT_GRACE = 5.0             # seconds after a minute ends before its consensus is worked out
+DEFAULT_THRESHOLD = 0.1         # seconds; never flag a site closer than this to the consensus
+DEFAULT_MAD_SCALE = 4.0         # ... or closer than this many (MAD based) standard deviations
+DEFAULT_RCVBUF = 4 * 1024 * 1024
+
+MINUTE_NS = 60 * 1000000000
+MAX_OFFSET = 30.0               # seconds; beyond this a record's WWVB minute can't be trusted
+
+FLEET_MAGIC = b'WWVF'
+FLEET_VERSION = 1
+RECORD = struct.Struct('!4sBBH16sqqdqbbBBB3x')
+
+class FleetError(Exception):
+    """ raise this any Fleet error """
+
+def parse_address(address):
+    """ parse_address()
+
+    :param address: host:port, :port or a Unix socket path (anything with a /)
+    :return: (family, address)
+    """
+    if '/' in address:
+        return (socket.AF_UNIX, address)
+    (host, _, port) = address.rpartition(':')
+    try:
+        port = int(port)
+    except ValueError as err:
+        raise FleetError('fleet address invalid "%s"' % (address)) from err
+    return (socket.AF_INET6 if ':' in host else socket.AF_INET, (host.strip('[]') or '0.0.0.0', port))
+
+def pack_record(site, wwvb_ns, sys_ns, offset, latency_ns, precision, leap, antenna, votes=1, candidates=1):
+    """ pack_record()
+
+    :return: bytes ready to send
+    """
+    return RECORD.pack(FLEET_MAGIC, FLEET_VERSION, 0, 0, site.encode('utf-8')[:16],
+                        wwvb_ns, sys_ns, offset, latency_ns, precision, leap, antenna, min(votes, 255), min(candidates, 255))
+
+class FleetSender:
+    """ FleetSender()
+
+    :param address: Collector's host:port (UDP) or Unix datagram socket path
+    :param site: Our site name (Default is the hostname)
+    :param latency_ns: Our distance correction (nanoseconds)
+    :param debug: True to enable debug messages
+    :param verbose: True to enable verbose messages
+    :return: New instance of FleetSender()
+
+    update() packs one record and does a single non-blocking send; a lost record is simply lost.
+    """
+
+    def __init__(self, address=None, site=None, latency_ns=0, debug=False, verbose=False):
+        """ :meta private: """
+
+        self._sock = None
+
+        if not isinstance(address, str) or len(address) == 0:
+            raise FleetError('fleet address invalid "%s"' % (address))
+        (family, self._address) = parse_address(address)
+        self._site = site if site else socket.gethostname().split('.')[0]
+        self._latency_ns = latency_ns
+
+        self._log = logging.getLogger(__class__.__name__)
+        self._debug = debug
+        if self._debug:
+            self._log.setLevel(logging.DEBUG)
+        self._verbose = verbose
+        if self._verbose:
+            self._log.setLevel(logging.INFO)
+
+        try:
+            self._sock = socket.socket(family, socket.SOCK_DGRAM)
+        except OSError as err:
+            raise FleetError('unable to create socket: %s' % (err)) from err
+        self._sock.setblocking(False)
+
+        self._log.info('fleet sender ready: %s', self)
+
+    def __del__(self):
+        """ __del__ """
+        if self._sock:
+            self._sock.close()
+            self._sock = None
+
+    def __str__(self):
+        """ __str__ """
+        return '[fleet %s -> %s]' % (self._site, self._address)
+
+    def update(self, reception, sample, votes=1, candidates=1):
+        """ update()
+
+        :param reception: Reception instance (full reception)
+        :param sample: NTPSample published for this reception
+        :param votes: Receivers that agreed with this fix
+        :param candidates: Receivers that had a fix for this minute
+        """
+        data = pack_record(self._site, sample.received_ns, sample.sys_received_ns, sample.offset, self._latency_ns,
+                            sample.precision, sample.leap, 2 if reception.rx_antenna == 'Antenna2' else 1, votes, candidates)
+        try:
+            self._sock.sendto(data, self._address)
+        except OSError as err:
+            # the collector being away is not our problem
+            self._log.debug('%s: send failed: %s', self, err)
+
+class FleetRecord:
+    """ FleetRecord()
+
+    :param data: bytes (one record)
+    :param received_ns: Collector's system time when it arrived
+    :return: New instance of FleetRecord()
+    """
+
+    __slots__ = ('site', 'wwvb_ns', 'sys_ns', 'offset', 'latency_ns', 'precision', 'leap', 'antenna', 'votes', 'candidates', 'received_ns')
+
+    def __init__(self, data, received_ns=0):
+        """ :meta private: """
+        (magic, version, _, _, site,
+            self.wwvb_ns, self.sys_ns, self.offset, self.latency_ns,
+            self.precision, self.leap, self.antenna, self.votes, self.candidates) = RECORD.unpack_from(data)
+        if magic != FLEET_MAGIC or version != FLEET_VERSION:
+            raise FleetError('not a version %d fleet record' % (FLEET_VERSION))
+        self.site = site.rstrip(b'\0').decode('utf-8', 'replace')
+        self.received_ns = received_ns
+
+    def __str__(self):
+        """ __str__ """
+        return '[%s %+.6f 2^%d]' % (self.site, self.offset, self.precision)
+
+class Consensus:
+    """ Consensus()
+
+    :param minute: WWVB minute (minutes since the epoch)
+    :param records: list of FleetRecord (one per site)
+    :param threshold: Seconds; never flag a site closer than this to the consensus
+    :param mad_scale: ... or closer than this many (MAD based) standard deviations
+    :return: New instance of Consensus()
+
+    offset is the weighted median of the site offsets; weights are 1/uncertainty^2 where uncertainty is 2^precision.
+    spread is the MAD scaled to a standard deviation (1.4826 * MAD). deviating is a list of (site, offset - consensus).
+    """
+
+    __slots__ = ('minute', 'records', 'offset', 'spread', 'deviating')
+
+    def __init__(self, minute, records, threshold=DEFAULT_THRESHOLD, mad_scale=DEFAULT_MAD_SCALE):
+        """ :meta private: """
+        self.minute = minute
+        self.records = records
+        self.offset = weighted_median([(r.offset, 4.0 ** -r.precision) for r in records])
+        self.spread = 1.4826 * weighted_median([(abs(r.offset - self.offset), 1.0) for r in records])
+        limit = max(threshold, mad_scale * self.spread)
+        self.deviating = [(r.site, r.offset - self.offset) for r in records if abs(r.offset - self.offset) > limit]
+
+    def __str__(self):
+        """ __str__ """
+        when = datetime.fromtimestamp(self.minute * 60, timezone.utc).strftime('%Y-%m-%dT%H:%MZ')
+        line = '%s consensus %+.6f s spread %.6f s from %d site%s' % (
+                    when, self.offset, self.spread, len(self.records), '' if len(self.records) == 1 else 's'
+                )
+        if self.deviating:
+            line += '; deviating: ' + ', '.join(['%s (%+.6f)' % (site, d) for site, d in sorted(self.deviating)])
+        return line
+
+def weighted_median(values):
+    """ weighted_median()
+
+    :param values: list of (value, weight)
+    :return: the value where half the total weight is below (or None if empty)
+    """
+    if len(values) == 0:
+        return None
+    values = sorted(values)
+    half = sum([w for _, w in values]) / 2.0
+    total = 0.0
+    for value, weight in values:
+        total += weight
+        if total >= half:
+            return value
+    return values[-1][0]
+
+class FleetCollector:
+    """ FleetCollector()
+
+    :param addresses: list of host:port (UDP) and/or Unix datagram socket paths to listen on
+    :param grace: Seconds after a minute ends before its consensus is worked out
+    :param threshold: Seconds; never flag a site closer than this to the consensus
+    :param mad_scale: ... or closer than this many (MAD based) standard deviations
+    :param debug: True to enable debug messages
+    :param verbose: True to enable verbose messages
+    :return: New instance of FleetCollector()
+
+    One thread, one core. Each wakeup drains every socket (a batch of datagrams) into one
+    preallocated buffer; records are then unpacked in place.
+    """
+
+    def __init__(self, addresses=None, grace=DEFAULT_GRACE, threshold=DEFAULT_THRESHOLD, mad_scale=DEFAULT_MAD_SCALE, debug=False, verbose=False):
+        """ :meta private: """
+
+        self._socks = []
+        self._unix_paths = []
+        self._grace_ns = int(grace * 1000000000)
+        self._threshold = threshold
+        self._mad_scale = mad_scale
+        self._minutes = {}
+        self._buffer = bytearray(RECORD.size + 1)
+        self._view = memoryview(self._buffer)
+        self.received = 0
+        self.rejected = 0
+        self.late = 0
+
+        self._log = logging.getLogger(__class__.__name__)
+        self._debug = debug
+        if self._debug:
+            self._log.setLevel(logging.DEBUG)
+        self._verbose = verbose
+        if self._verbose:
+            self._log.setLevel(logging.INFO)
+
+        if not addresses:
+            raise FleetError('fleet collector needs an address to listen on')
+
+        self._selector = selectors.DefaultSelector()
+        for address in addresses:
+            self._listen(address)
+
+    def __del__(self):
+        """ __del__ """
+        self.close()
+
+    def __str__(self):
+        """ __str__ """
+        return '[fleet collector %s]' % (', '.join([str(sock.getsockname()) for sock in self._socks]))
+
+    def _listen(self, address):
+        """ _listen """
+        (family, address) = parse_address(address)
+        try:
+            sock = socket.socket(family, socket.SOCK_DGRAM)
+            if family == socket.AF_UNIX:
+                try:
+                    os.unlink(address)
+                except FileNotFoundError:
+                    pass
+                self._unix_paths.append(address)
+            try:
+                # room for a burst from hundreds of sites while we're busy
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, DEFAULT_RCVBUF)
+            except OSError:
+                pass
+            sock.bind(address)
+        except OSError as err:
+            raise FleetError('%s: %s' % (address, err)) from err
+        sock.setblocking(False)
+        self._socks.append(sock)
+        self._selector.register(sock, selectors.EVENT_READ)
+
+    def close(self):
+        """ close() """
+        for sock in self._socks:
+            sock.close()
+        self._socks = []
+        for path in self._unix_paths:
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+        self._unix_paths = []
+
+    def addresses(self):
+        """ addresses()
+
+        :return: list of bound addresses (i.e. to find the port when bound to port 0)
+        """
+        return [sock.getsockname() for sock in self._socks]
+
+    def poll(self, timeout=None):
+        """ poll()
+
+        :param timeout: Seconds to wait for records (None is until the next minute is due)
+        :return: list of Consensus for any minutes now complete
+        """
+        now_ns = time.time_ns()
+        if timeout is None:
+            timeout = self.timeout(now_ns)
+        for key, _ in self._selector.select(timeout):
+            self._drain(key.fileobj)
+        return self.complete(time.time_ns())
+
+    def timeout(self, now_ns):
+        """ timeout()
+
+        :return: Seconds until the oldest minute is due (or None if there's nothing waiting)
+        """
+        if not self._minutes:
+            return None
+        due_ns = (min(self._minutes) + 1) * MINUTE_NS + self._grace_ns
+        return max(0.0, (due_ns - now_ns) / 1000000000.0)
+
+    def _drain(self, sock):
+        """ _drain """
+        view = self._view
+        received_ns = time.time_ns()
+        while True:
+            try:
+                nbytes = sock.recv_into(self._buffer)
+            except BlockingIOError:
+                return
+            except OSError as err:
+                if err.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                self._log.warning('%s: receive failed: %s', self, err)
+                return
+            if nbytes != RECORD.size:
+                self.rejected += 1
+                continue
+            self.ingest(view, received_ns)
+
+    def ingest(self, data, received_ns=0):
+        """ ingest()
+
+        :param data: bytes (one record)
+        :param received_ns: System time when it arrived
+        """
+        try:
+            record = FleetRecord(data, received_ns)
+        except (FleetError, struct.error):
+            self.rejected += 1
+            return
+        if abs(record.offset) < MAX_OFFSET:
+            minute = record.wwvb_ns // MINUTE_NS
+        else:
+            # a misdecoded minute (hour, day ...); file it with the minute it should have been so it's flagged
+            minute = record.sys_ns // MINUTE_NS
+        if received_ns and received_ns > (minute + 1) * MINUTE_NS + self._grace_ns:
+            # that minute has been done (or this site's decode or clock is way off)
+            self.late += 1
+            self._log.debug('late record: %s', record)
+            return
+        self.received += 1
+        # one record per site per minute; the latest wins
+        self._minutes.setdefault(minute, {})[record.site] = record
+
+    def complete(self, now_ns):
+        """ complete()
+
+        :param now_ns: Current system time (nanoseconds since the epoch)
+        :return: list of Consensus for every minute that is now complete (oldest first)
+        """
+        results = []
+        for minute in sorted(self._minutes):
+            if now_ns < (minute + 1) * MINUTE_NS + self._grace_ns:
+                break
+            records = list(self._minutes.pop(minute).values())
+            consensus = Consensus(minute, records, self._threshold, self._mad_scale)
+            for site, deviation in consensus.deviating:
+                self._log.info('%s: site %s deviates by %+.6f seconds', self, site, deviation)
+            results.append(consensus)
+        return results
+
+def collect(program_name, args):
+    """ collect()
+
+    :param program_name: $0 in shell terms
+    :param args: $* in shell terms (after "collect")
+    """
+
+    addresses = []
+    grace = DEFAULT_GRACE
+    threshold = DEFAULT_THRESHOLD
+    flag_verbose = False
+
+    usage = program_name + ' collect ' + ' '.join([
+                                '[-h|--help]',
+                                '[-v|--verbose]',
+                                '[--listen=host:port|path]',
+                                '[--grace=seconds]',
+                                '[--threshold=seconds]',
+                            ])
+
+    required_format = '%(asctime)s %(name)s %(levelname)s %(message)s'
+    logging.basicConfig(format=required_format)
+
+    config = readconfig()
+    if 'fleet.listen' in config and config['fleet.listen']:
+        addresses = [config['fleet.listen']]
+
+    try:
+        opts, args = getopt.getopt(args, 'hv', ['help', 'verbose', 'listen=', 'grace=', 'threshold='])
+    except getopt.GetoptError:
+        sys.exit('usage: ' + usage)
+
+    cli_addresses = []
+    for opt, arg in opts:
+        if opt in ('-h', '--help'):
+            print("%s %s" % ('usage:', usage), file=sys.stderr)
+            sys.exit(0)
+        try:
+            if opt in ('-v', '--verbose'):
+                flag_verbose = True
+            elif opt == '--listen':
+                # can be repeated
+                cli_addresses.append(arg)
+            elif opt == '--grace':
+                grace = float(arg)
+            elif opt == '--threshold':
+                threshold = float(arg)
+        except ValueError:
+            print("%s %s %s" % (program_name, 'invalid', opt), file=sys.stderr)
+            sys.exit('usage: ' + usage)
+
+    if len(cli_addresses) > 0:
+        addresses = cli_addresses
+    if len(addresses) == 0:
+        addresses = [':%d' % (DEFAULT_FLEET_PORT)]
+
+    try:
+        collector = FleetCollector(addresses, grace=grace, threshold=threshold, verbose=flag_verbose)
+    except FleetError as err:
+        sys.exit(err)
+    print('collecting on %s' % (', '.join([str(a) for a in collector.addresses()])))
+    sys.stdout.flush()
+
+    while True:
+        for consensus in collector.poll():
+            print(consensus)
+            sys.stdout.flush()
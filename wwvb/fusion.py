@@ -0,0 +1,175 @@
+""" fusion.py
+
+Vote between several receivers; one fix per minute goes to the NTP feed
+
+Copyright (C) 2023 Martin J Levy - W6LHI/G8LHI - @mahtin - https://github.com/mahtin
+
+Receivers listening to the same WWVB minute frame all interrupt within a second or so of each other.
+Full receptions are grouped by when they arrived; once a group's window closes the offsets
+(WWVB minus system time) are voted on. The largest set of offsets that agree within the tolerance wins
+and the best (lowest precision) member of that set is published. A receiver that decoded the wrong
+minute (or hour, or day) is outvoted. A group of one is published as-is; there's nobody to disagree.
+A tie between sets that share no member is broken by what was published last time; before anything
+has been published there is no way to tell who is right, so nothing is published and every candidate
+is unresolved.
+"""
+
+import logging
+
+DEFAULT_WINDOW = 1.5        # seconds from the first reception in a group until the vote
+DEFAULT_TOLERANCE = 0.5     # seconds; offsets closer than this agree
+
+class FusionError(Exception):
+    """ raise this any Fusion error """
+
+class Candidate:
+    """ Candidate()
+
+    :param reception: Reception instance
+    :param sample: NTPSample for this reception (offset and precision already set)
+    :return: New instance of Candidate()
+    """
+
+    __slots__ = ('reception', 'sample', 'result')
+
+    def __init__(self, reception, sample):
+        """ :meta private: """
+        self.reception = reception
+        self.sample = sample
+        self.result = None
+
+    def __str__(self):
+        """ __str__ """
+        return '[%s %.6f %s]' % (self.reception.receiver, self.sample.offset, self.result)
+
+class Fusion:
+    """ Fusion()
+
+    :param window: Seconds from the first reception in a group until the vote
+    :param tolerance: Offsets closer than this (seconds) agree
+    :param debug: True to enable debug messages
+    :param verbose: True to enable verbose messages
+    :return: New instance of Fusion()
+
+    add() and ready() are called from the main loop only; there's no locking.
+    """
+
+    def __init__(self, window=DEFAULT_WINDOW, tolerance=DEFAULT_TOLERANCE, debug=False, verbose=False):
+        """ :meta private: """
+        if window <= 0 or tolerance <= 0:
+            raise FusionError('fusion window and tolerance must be positive')
+        self._window_ns = int(window * 1000000000)
+        self._tolerance = tolerance
+        self._group = []
+        self._group_end_ns = None
+        self._last_offset = None
+
+        self._log = logging.getLogger(__class__.__name__)
+        self._debug = debug
+        if self._debug:
+            self._log.setLevel(logging.DEBUG)
+        self._verbose = verbose
+        if self._verbose:
+            self._log.setLevel(logging.INFO)
+
+    def __str__(self):
+        """ __str__ """
+        return '[fusion window=%.3fs tolerance=%.3fs]' % (self._window_ns / 1000000000.0, self._tolerance)
+
+    def __len__(self):
+        """ __len__ """
+        return len(self._group)
+
+    def add(self, reception, sample):
+        """ add()
+
+        :param reception: Reception instance (full reception only)
+        :param sample: NTPSample for this reception (offset and precision already set)
+        :return: list of Candidate from a group that this reception closed (else an empty list)
+        """
+        decided = []
+        if self._group_end_ns is not None and sample.sys_received_ns >= self._group_end_ns:
+            # a late arrival from the next minute; the previous group is complete
+            decided = self._vote()
+        if self._group_end_ns is None:
+            self._group_end_ns = sample.sys_received_ns + self._window_ns
+        self._group.append(Candidate(reception, sample))
+        return decided
+
+    def timeout(self, now_ns):
+        """ timeout()
+
+        :param now_ns: Current system time (nanoseconds since the epoch)
+        :return: Seconds until the current group is voted on (or None if there's no group)
+        """
+        if self._group_end_ns is None:
+            return None
+        return max(0.0, (self._group_end_ns - now_ns) / 1000000000.0)
+
+    def ready(self, now_ns):
+        """ ready()
+
+        :param now_ns: Current system time (nanoseconds since the epoch)
+        :return: list of Candidate (the chosen one first, if any) once the window has closed (else an empty list)
+        """
+        if self._group_end_ns is None or now_ns < self._group_end_ns:
+            return []
+        return self._vote()
+
+    def _vote(self):
+        """ _vote """
+        group = self._group
+        self._group = []
+        self._group_end_ns = None
+
+        # for each candidate, who agrees with it?
+        best = None
+        tied = False
+        for candidate in group:
+            agree = [c for c in group if abs(c.sample.offset - candidate.sample.offset) < self._tolerance]
+            if best is None or self._better(agree, best):
+                best = agree
+                tied = False
+            elif self._undecided(agree, best):
+                tied = True
+
+        if tied:
+            # i.e. one vs one with nothing published yet; publishing either could be publishing the wrong minute
+            for candidate in group:
+                candidate.result = 'unresolved'
+            self._log.warning('vote unresolved: %s', ' '.join([str(c) for c in group]))
+            return group
+
+        # the most precise member of the winning set is published
+        chosen = min(best, key=lambda c: (c.sample.precision if c.sample.precision is not None else 0, c.sample.sys_received_ns))
+        for candidate in group:
+            if candidate is chosen:
+                candidate.result = 'chosen'
+            elif candidate in best:
+                candidate.result = 'agreed'
+            else:
+                candidate.result = 'outvoted'
+                self._log.warning('%s outvoted; offset %.6f vs %.6f', candidate.reception.receiver, candidate.sample.offset, chosen.sample.offset)
+        self._last_offset = chosen.sample.offset
+        self._log.debug('vote: %s', ' '.join([str(c) for c in group]))
+        return [chosen] + [c for c in group if c is not chosen]
+
+    def _better(self, agree, best):
+        """ _better """
+        if len(agree) != len(best):
+            return len(agree) > len(best)
+        if self._last_offset is None:
+            return False
+        # a tie; stay with whichever is closest to what we published last time
+        return self._distance(agree) < self._distance(best)
+
+    def _undecided(self, agree, best):
+        """ _undecided """
+        if len(agree) != len(best) or self._last_offset is not None:
+            return False
+        # overlapping sets still agree on someone; disjoint ones contradict each other
+        return not any(c in best for c in agree)
+
+    def _distance(self, candidates):
+        """ _distance """
+        return min([abs(c.sample.offset - self._last_offset) for c in candidates])
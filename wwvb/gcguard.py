@@ -0,0 +1,260 @@
+""" gcguard.py
+
+Keep Python's garbage collector out of the window between an expected ES100 IRQ and its timestamp
+
+Copyright (C) 2023 Martin J Levy - W6LHI/G8LHI - @mahtin - https://github.com/mahtin
+
+A cyclic garbage collection runs in whichever thread happens to allocate past the threshold and holds
+the GIL while it runs; if that's between the IRQ edge and the system time being read, the collection
+time is added to the timestamp and shows up as an offset outlier.
+
+With the guard started, everything alive at startup is moved out of the collector's way (gc.freeze())
+and automatic collection is disabled. Each ES100 tells the guard when its next IRQ could come at the
+earliest (expect()) and when the timestamp and registers have been read (done()). A receiver's window
+opens lead seconds before that earliest time. Collections are then run by the guard:
+
+    after each reception        the pipeline's "gc" stage; the window has just closed and the next is furthest away
+    when idle                   a (daemon) thread collects once the allocation count is past the normal threshold
+
+and never while any receiver's window is open; a collection that's due is deferred until it closes.
+A window that never closes (a receiver stuck waiting, or windows back to back) can't defer forever:
+once collections have been deferred for max_defer seconds, or the allocation count is past MAX_DEFER_THRESHOLDS
+times the generation 0 threshold, the guard collects anyway; counted as in-window.
+A window that closes with the allocation count past the threshold is a collection pause avoided.
+Every collection (and how long it took) is counted via gc.callbacks.
+"""
+
+import gc
+import time
+import logging
+import threading
+
+DEFAULT_LEAD = 2.0                  # seconds before the earliest IRQ a window opens
+DEFAULT_IDLE_INTERVAL = 1.0         # seconds between idle checks
+DEFAULT_MAX_DEFER = 60.0            # seconds collections can be deferred before one runs in a window anyway
+MAX_DEFER_THRESHOLDS = 10           # ... or this many times the generation 0 threshold allocated
+
+# seconds
+GC_PAUSE_BUCKETS = [0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25]
+
+class GCGuardError(Exception):
+    """ raise this any GCGuard error """
+
+class GCGuard:
+    """ GCGuard()
+
+    :param lead: Seconds before the earliest IRQ that collections stop
+    :param idle_interval: Seconds between checks for an idle collection
+    :param max_defer: Seconds collections can be deferred before one runs in a window anyway
+    :param debug: True to enable debug messages
+    :param verbose: True to enable verbose messages
+    :return: New instance of GCGuard()
+
+    Pass it to each ES100 (ES100(guard=...)) and start() it once everything is set up
+    """
+
+    def __init__(self, lead=DEFAULT_LEAD, idle_interval=DEFAULT_IDLE_INTERVAL, max_defer=DEFAULT_MAX_DEFER, debug=False, verbose=False):
+        """ :meta private: """
+        if lead < 0:
+            raise GCGuardError('lead must not be negative: %s' % (lead))
+        if max_defer <= 0:
+            raise GCGuardError('max_defer must be positive: %s' % (max_defer))
+        self._lead_ns = int(lead * 1000000000)
+        self._idle_interval = idle_interval
+        self._max_defer_ns = int(max_defer * 1000000000)
+        self._deferred_since_ns = None
+        self._windows = {}
+        self._lock = threading.Lock()
+        self._collect_lock = threading.Lock()
+        self._thread = None
+        self._stop = threading.Event()
+        self._started = False
+        self._pause_start_ns = 0
+        self._in_window = False
+
+        # counters; read by metrics (at scrape time) and report()
+        self.avoided = 0
+        self.deferred = 0
+        self.collections = [0, 0, 0]
+        self.in_window = 0
+        self.pause_max_ns = 0
+        self.pause_total_ns = 0
+        self.pause_last_ns = 0
+        self._pause_buckets = list(GC_PAUSE_BUCKETS) + [float('inf')]
+        self._pause_counts = [0] * len(self._pause_buckets)
+
+        self._log = logging.getLogger(__class__.__name__)
+        self._debug = debug
+        if self._debug:
+            self._log.setLevel(logging.DEBUG)
+        self._verbose = verbose
+        if self._verbose:
+            self._log.setLevel(logging.INFO)
+
+    def __str__(self):
+        """ __str__ """
+        return '[gc guard lead=%.1fs]' % (self._lead_ns / 1000000000.0)
+
+    def start(self):
+        """ start()
+
+        Freeze what's alive now, disable automatic collection and start the idle thread
+        """
+        if self._started:
+            return
+        gc.collect()
+        if hasattr(gc, 'freeze'):
+            # startup objects are never garbage; hence never scanned again
+            gc.freeze()
+        gc.callbacks.append(self._callback)
+        gc.disable()
+        self._started = True
+        self._thread = threading.Thread(target=self._run, name='gc-guard', daemon=True)
+        self._thread.start()
+        self._log.info('%s: automatic collection disabled (%d objects frozen)', self, gc.get_freeze_count() if hasattr(gc, 'get_freeze_count') else 0)
+
+    def stop(self):
+        """ stop()
+
+        Back to automatic collection
+        """
+        if not self._started:
+            return
+        self._started = False
+        self._stop.set()
+        self._thread.join()
+        if self._callback in gc.callbacks:
+            gc.callbacks.remove(self._callback)
+        gc.enable()
+
+    def expect(self, key, earliest_ns):
+        """ expect()
+
+        :param key: Whatever identifies the receiver (the ES100 instance)
+        :param earliest_ns: Earliest system time (nanoseconds since the epoch) the IRQ can come
+        """
+        with self._lock:
+            self._windows[id(key)] = earliest_ns - self._lead_ns
+
+    def done(self, key):
+        """ done()
+
+        :param key: Whatever identifies the receiver (the ES100 instance)
+
+        The timestamp and registers have been read; the window is closed
+        """
+        with self._lock:
+            opened_ns = self._windows.pop(id(key), None)
+        if opened_ns is None or not self._started:
+            return
+        if self._due() is not None and time.time_ns() >= opened_ns:
+            # an automatic collection would have run by now; quite possibly in the window
+            self.avoided += 1
+            self._log.debug('collection pause avoided (%d so far)', self.avoided)
+
+    def hot(self, now_ns=None):
+        """ hot()
+
+        :param now_ns: System time (default is now)
+        :return: True if any receiver's window is open
+        """
+        if now_ns is None:
+            now_ns = time.time_ns()
+        # no lock; this is also called from within a collection (which can be on any thread)
+        return any([now_ns >= opens_ns for opens_ns in list(self._windows.values())])
+
+    def collect(self, reason='reception'):
+        """ collect()
+
+        :param reason: Why now ('reception' or 'idle'); for messages
+        :return: Generation collected (None if nothing was due or it was deferred)
+
+        After a reception something is always collected (at least generation 0)
+        """
+        if not self._started:
+            return None
+        generation = self._due()
+        if generation is None:
+            if reason != 'reception':
+                return None
+            generation = 0
+        if self.hot():
+            now_ns = time.monotonic_ns()
+            if self._deferred_since_ns is None:
+                self._deferred_since_ns = now_ns
+            if not self._overdue(now_ns):
+                self.deferred += 1
+                self._log.debug('collection (%s) deferred; a receiver window is open', reason)
+                return None
+            # memory can't grow without bound because a window never closes; the callback counts this one as in-window
+            self._log.warning('collection (%s) deferred for %.1fs; collecting in a receiver window', reason, (now_ns - self._deferred_since_ns) / 1000000000.0)
+        with self._collect_lock:
+            gc.collect(generation)
+        self._deferred_since_ns = None
+        return generation
+
+    def _overdue(self, now_ns):
+        """ _overdue """
+        if now_ns - self._deferred_since_ns >= self._max_defer_ns:
+            return True
+        threshold = gc.get_threshold()[0]
+        return bool(threshold) and gc.get_count()[0] > MAX_DEFER_THRESHOLDS * threshold
+
+    def pause_counts(self):
+        """ pause_counts()
+
+        :return: Collection pause bucket counts (non-cumulative) followed by the sum in seconds; as metrics.Histogram keeps them
+        """
+        return list(self._pause_counts) + [self.pause_total_ns / 1000000000.0]
+
+    def report(self):
+        """ report()
+
+        Log what the guard has done
+        """
+        count = sum(self.collections)
+        self._log.info('%s collections=%s avoided=%d deferred=%d in-window=%d pause mean=%.1fus max=%.1fus',
+                            self,
+                            '/'.join([str(n) for n in self.collections]),
+                            self.avoided,
+                            self.deferred,
+                            self.in_window,
+                            self.pause_total_ns / count / 1000.0 if count else 0.0,
+                            self.pause_max_ns / 1000.0)
+
+    def _due(self):
+        """ _due - the generation an automatic collection would do now (None if nothing is due) """
+        counts = gc.get_count()
+        thresholds = gc.get_threshold()
+        due = None
+        for generation in range(min(len(counts), len(thresholds))):
+            if thresholds[generation] and counts[generation] > thresholds[generation]:
+                due = generation
+        return due
+
+    def _callback(self, phase, info):
+        """ _callback - every collection (ours or not) """
+        if phase == 'start':
+            self._in_window = self.hot()
+            self._pause_start_ns = time.perf_counter_ns()
+            return
+        pause_ns = time.perf_counter_ns() - self._pause_start_ns
+        generation = info.get('generation', 0)
+        if 0 <= generation < len(self.collections):
+            self.collections[generation] += 1
+        if self._in_window:
+            # an overdue collection (see collect()) or someone called gc.collect() directly
+            self.in_window += 1
+        self.pause_last_ns = pause_ns
+        self.pause_total_ns += pause_ns
+        self.pause_max_ns = max(self.pause_max_ns, pause_ns)
+        seconds = pause_ns / 1000000000.0
+        for n, bound in enumerate(self._pause_buckets):
+            if seconds <= bound:
+                self._pause_counts[n] += 1
+                break
+
+    def _run(self):
+        """ _run """
+        while not self._stop.wait(self._idle_interval):
+            self.collect('idle')
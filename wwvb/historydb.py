@@ -0,0 +1,370 @@
+""" historydb.py
+
+SQLite history of every reception attempt; plus the queries behind "wwvb stats"
+
+Copyright (C) 2023 Martin J Levy - W6LHI/G8LHI - @mahtin - https://github.com/mahtin
+
+One row per attempt; the columns are the journal keys (see journal.py).
+"""
+
+import os
+import math
+import time
+import logging
+import sqlite3
+import threading
+from urllib.request import pathname2url
+
+from .config import DEFAULT_RECEIVER_NAME
+from .journal import read_journal
+
+DEFAULT_COMMIT_INTERVAL = 10.0      # seconds between batched inserts
+DEFAULT_COMMIT_BATCH = 64           # ... or sooner if this many rows are waiting
+
+COLUMNS = [
+    ('receiver', 'TEXT'),
+    ('start_ns', 'INTEGER'),
+    ('irq_ns', 'INTEGER'),
+    ('duration_ns', 'INTEGER'),
+    ('mode', 'TEXT'),
+    ('antenna', 'TEXT'),
+    ('irq_status', 'INTEGER'),
+    ('status0', 'INTEGER'),
+    ('outcome', 'TEXT'),
+    ('cycles', 'INTEGER'),
+    ('timeouts', 'INTEGER'),
+    ('clock_step_ns', 'INTEGER'),
+    ('wwvb_time', 'TEXT'),
+    ('delta_seconds', 'REAL'),
+    ('offset', 'REAL'),
+    ('precision', 'INTEGER'),
+    ('leap', 'INTEGER'),
+    ('sinks', 'TEXT'),
+]
+
+SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS attempts (%s)' % (', '.join(['%s %s' % (name, kind) for name, kind in COLUMNS])),
+    'CREATE INDEX IF NOT EXISTS attempts_time ON attempts (start_ns)',
+    'CREATE INDEX IF NOT EXISTS attempts_mode_antenna ON attempts (mode, antenna, start_ns)',
+]
+
+INSERT = 'INSERT INTO attempts (%s) VALUES (%s)' % (
+                ', '.join([name for name, _ in COLUMNS]),
+                ', '.join(['?'] * len(COLUMNS))
+            )
+
+# Every query takes the same filter; so one prepared (and cached) statement each.
+# A NULL parameter means no filter on that column.
+# Hours are UTC and half open; 2 thru 5 is 02:00:00 to 04:59:59 and 22 thru 3 wraps past midnight.
+HOUR = '(((start_ns / 1000000000) % 86400) / 3600)'
+FILTER = ' '.join([
+    'WHERE start_ns >= :since AND start_ns < :until',
+    'AND (:mode IS NULL OR mode = :mode)',
+    'AND (:antenna IS NULL OR antenna = :antenna)',
+    'AND (:hour_from IS NULL',
+    'OR (:hour_from < :hour_to AND %s >= :hour_from AND %s < :hour_to)' % (HOUR, HOUR),
+    'OR (:hour_from >= :hour_to AND (%s >= :hour_from OR %s < :hour_to)))' % (HOUR, HOUR),
+])
+
+QUERY_SUCCESS_BY_HOUR = ' '.join([
+    'SELECT %s AS hour, antenna,' % (HOUR),
+    'COUNT(*), SUM(outcome = \'RX_OK\')',
+    'FROM attempts', FILTER,
+    'GROUP BY hour, antenna ORDER BY hour, antenna',
+])
+
+QUERY_TIME_TO_FIX = ' '.join([
+    'SELECT mode, duration_ns FROM attempts', FILTER,
+    'AND outcome = \'RX_OK\' AND duration_ns IS NOT NULL',
+    'ORDER BY mode, duration_ns',
+])
+
+QUERY_DELTA = ' '.join([
+    'SELECT antenna, delta_seconds FROM attempts', FILTER,
+    'AND outcome = \'RX_OK\' AND delta_seconds IS NOT NULL',
+    'ORDER BY antenna, delta_seconds',
+])
+
+QUERY_FIXES = ' '.join([
+    'SELECT mode, irq_ns FROM attempts', FILTER,
+    'AND outcome = \'RX_OK\' AND irq_ns IS NOT NULL',
+    'ORDER BY mode, irq_ns',
+])
+
+# fix gap buckets (upper bounds in seconds)
+GAP_BUCKETS = [
+    (5 * 60, '< 5m'),
+    (15 * 60, '5m-15m'),
+    (60 * 60, '15m-1h'),
+    (3 * 3600, '1h-3h'),
+    (6 * 3600, '3h-6h'),
+    (12 * 3600, '6h-12h'),
+    (None, '> 12h'),
+]
+
+class HistoryDBError(Exception):
+    """ raise this any HistoryDB error """
+
+def percentiles(values, points=(50, 90, 99)):
+    """ percentiles()
+
+    :param values: Sorted list of numbers
+    :param points: Percentiles wanted
+    :return: list of values (nearest rank) or None's if values is empty
+    """
+    if len(values) == 0:
+        return [None] * len(points)
+    n = len(values)
+    return [values[min(n - 1, max(0, math.ceil(p / 100.0 * n) - 1))] for p in points]
+
+def _row(entry):
+    """ _row """
+    values = []
+    for name, _ in COLUMNS:
+        value = entry.get(name)
+        if name == 'receiver' and value is None:
+            value = DEFAULT_RECEIVER_NAME
+        if name == 'sinks':
+            value = ','.join(value) if value else ''
+        values.append(value)
+    return values
+
+class HistoryDB:
+    """ HistoryDB()
+
+    :param path: SQLite database file name
+    :param commit_interval: Seconds between batched inserts
+    :param commit_batch: Insert sooner if this many rows are waiting
+    :param debug: True to enable debug messages
+    :param verbose: True to enable verbose messages
+    :return: New instance of HistoryDB()
+
+    write() only appends to a list; a background thread owns the connection and does the inserts.
+    Hence database i/o never touches the reception loop. The database is in WAL mode so "wwvb stats"
+    can read while the daemon writes.
+    """
+
+    def __init__(self, path=None, commit_interval=DEFAULT_COMMIT_INTERVAL, commit_batch=DEFAULT_COMMIT_BATCH, debug=False, verbose=False):
+        """ :meta private: """
+
+        self._thread = None
+
+        if not isinstance(path, str) or len(path) == 0:
+            raise HistoryDBError('history database path invalid "%s"' % (path))
+        self._path = path
+        self._commit_interval = commit_interval
+        self._commit_batch = commit_batch
+
+        self._log = logging.getLogger(__class__.__name__)
+        self._debug = debug
+        if self._debug:
+            self._log.setLevel(logging.DEBUG)
+        self._verbose = verbose
+        if self._verbose:
+            self._log.setLevel(logging.INFO)
+
+        self._pending = []
+        self._wakeup = threading.Condition()
+        self._closing = False
+
+        # create/check the schema here; so errors are reported to the caller
+        connection = open_db(self._path)
+        connection.close()
+
+        self._thread = threading.Thread(target=self._writer, name='historydb', daemon=True)
+        self._thread.start()
+        self._log.info('history ready: %s', self)
+
+    def __del__(self):
+        """ __del__ """
+        self.close()
+
+    def __str__(self):
+        """ __str__ """
+        return '[sqlite %s]' % (self._path)
+
+    def write(self, entry):
+        """ write()
+
+        :param entry: dict (see journal.journal_entry())
+        """
+        row = _row(entry)
+        with self._wakeup:
+            if self._closing:
+                return
+            self._pending.append(row)
+            if len(self._pending) >= self._commit_batch:
+                self._wakeup.notify()
+
+    def close(self):
+        """ close()
+
+        Insert anything waiting and close the database
+        """
+        if self._thread is None:
+            return
+        with self._wakeup:
+            self._closing = True
+            self._wakeup.notify()
+        self._thread.join()
+        self._thread = None
+
+    def _writer(self):
+        """ _writer """
+        try:
+            connection = open_db(self._path)
+        except HistoryDBError as err:
+            self._log.error('%s', err)
+            with self._wakeup:
+                # nothing more is queued
+                self._closing = True
+                self._pending = []
+            return
+        while True:
+            with self._wakeup:
+                if not self._closing and len(self._pending) < self._commit_batch:
+                    self._wakeup.wait(self._commit_interval)
+                rows = self._pending
+                self._pending = []
+                closing = self._closing
+            if len(rows) > 0:
+                try:
+                    with connection:
+                        connection.executemany(INSERT, rows)
+                    self._log.debug('%s: %d rows inserted', self, len(rows))
+                except sqlite3.Error as err:
+                    # history is not allowed to stop reception
+                    self._log.warning('%s: insert failed (%d rows lost): %s', self, len(rows), err)
+            if closing:
+                break
+        connection.close()
+
+def open_db(path, readonly=False):
+    """ open_db()
+
+    :param path: SQLite database file name
+    :param readonly: True to only query an existing database (i.e. stats and report)
+    :return: sqlite3 connection (schema created if needed)
+    """
+    if readonly:
+        return _open_db_readonly(path)
+    try:
+        connection = sqlite3.connect(path)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        with connection:
+            connection.execute(SCHEMA[0])
+            # databases from before multi-receiver support; add any missing columns before indexing
+            present = [row[1] for row in connection.execute('PRAGMA table_info(attempts)')]
+            for name, kind in COLUMNS:
+                if name not in present:
+                    connection.execute('ALTER TABLE attempts ADD COLUMN %s %s' % (name, kind))
+                    if name == 'receiver':
+                        connection.execute('UPDATE attempts SET receiver = ?', (DEFAULT_RECEIVER_NAME,))
+            for statement in SCHEMA[1:]:
+                connection.execute(statement)
+    except sqlite3.Error as err:
+        raise HistoryDBError('%s: %s' % (path, err)) from err
+    return connection
+
+def _open_db_readonly(path):
+    """ _open_db_readonly """
+    # never create (or upgrade) a database just to report on it
+    if not os.path.isfile(path):
+        raise HistoryDBError('%s: no such history database' % (path))
+    try:
+        connection = sqlite3.connect('file:%s?mode=ro' % (pathname2url(os.path.abspath(path))), uri=True)
+        present = [row[1] for row in connection.execute('PRAGMA table_info(attempts)')]
+    except sqlite3.Error as err:
+        raise HistoryDBError('%s: %s' % (path, err)) from err
+    missing = [name for name, _ in COLUMNS if name not in present]
+    if len(present) == 0:
+        connection.close()
+        raise HistoryDBError('%s: not a history database' % (path))
+    if len(missing) > 0:
+        connection.close()
+        raise HistoryDBError('%s: not a current history database (missing %s); run wwvb once to upgrade it' % (path, ', '.join(missing)))
+    return connection
+
+def import_journal(connection, filename):
+    """ import_journal()
+
+    :param connection: sqlite3 connection from open_db()
+    :param filename: Journal file (see journal.py)
+    :return: number of rows inserted
+    """
+    rows = [_row(entry) for entry in read_journal(filename)]
+    with connection:
+        connection.executemany(INSERT, rows)
+    return len(rows)
+
+def query_params(since_ns=None, until_ns=None, mode=None, antenna=None, hours=None):
+    """ query_params()
+
+    :param since_ns: Earliest start time (nanoseconds since the epoch) or None
+    :param until_ns: Latest start time (nanoseconds since the epoch) or None
+    :param mode: 'reception', 'tracking' or None
+    :param antenna: 'Antenna1', 'Antenna2' or None
+    :param hours: (from, to) UTC hours (half open) or None
+    :return: dict of parameters for the QUERY_* statements
+    """
+    return {
+        'since': since_ns if since_ns is not None else 0,
+        'until': until_ns if until_ns is not None else time.time_ns() + 1,
+        'mode': mode,
+        'antenna': antenna,
+        'hour_from': hours[0] if hours else None,
+        'hour_to': hours[1] if hours else None,
+    }
+
+def success_by_hour(connection, params):
+    """ success_by_hour()
+
+    :return: list of (hour, antenna, attempts, successes)
+    """
+    return connection.execute(QUERY_SUCCESS_BY_HOUR, params).fetchall()
+
+def _grouped(connection, query, params):
+    """ _grouped """
+    groups = {}
+    for key, value in connection.execute(query, params):
+        groups.setdefault(key, []).append(value)
+    return groups
+
+def time_to_fix(connection, params):
+    """ time_to_fix()
+
+    :return: dict of mode -> sorted list of seconds
+    """
+    groups = _grouped(connection, QUERY_TIME_TO_FIX, params)
+    return {mode: [v / 1000000000.0 for v in values] for mode, values in groups.items()}
+
+def delta_seconds(connection, params):
+    """ delta_seconds()
+
+    :return: dict of antenna -> sorted list of delta seconds
+    """
+    return _grouped(connection, QUERY_DELTA, params)
+
+def fix_gaps(connection, params):
+    """ fix_gaps()
+
+    :return: dict of mode -> sorted list of seconds between successive fixes
+    """
+    gaps = {}
+    for mode, values in _grouped(connection, QUERY_FIXES, params).items():
+        gaps[mode] = sorted([(b - a) / 1000000000.0 for a, b in zip(values, values[1:])])
+    return gaps
+
+def gap_distribution(gaps):
+    """ gap_distribution()
+
+    :param gaps: Sorted list of seconds
+    :return: list of (label, count) using GAP_BUCKETS
+    """
+    counts = []
+    lower = 0
+    for upper, label in GAP_BUCKETS:
+        counts.append((label, len([g for g in gaps if g >= lower and (upper is None or g < upper)])))
+        lower = upper
+    return counts
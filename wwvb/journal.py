@@ -0,0 +1,273 @@
+""" journal.py
+
+Append-only JSON-lines journal of every reception attempt
+
+Copyright (C) 2023 Martin J Levy - W6LHI/G8LHI - @mahtin - https://github.com/mahtin
+
+One JSON object per line; version 1 keys are:
+
+    v               1
+    receiver        receiver name ("es100" unless [WWVB] receivers is set)
+    start_ns        system time (nanoseconds since the epoch) the reception was started
+    irq_ns          system time of the final IRQ (or null if there wasn't one)
+    duration_ns     START to final IRQ (monotonic clock)
+    mode            "reception" or "tracking"
+    antenna         "Antenna1" or "Antenna2"
+    irq_status      raw IRQSTATUS register
+    status0         raw STATUS0 register
+    outcome         "RX_OK", "RX_FAIL", "CYCLE_COMPLETE" or "I2C_ERROR"
+    cycles          CYCLE_COMPLETE interrupts seen
+    timeouts        IRQ waits that timed out
+    clock_step_ns   system clock step between START and the final IRQ (0 if none)
+    wwvb_time       decoded time (ISO 8601) or null; tracking only has a valid second
+    delta_seconds   WWVB time minus system time (full reception only) or null
+    offset          offset published to the sinks (seconds) or null
+    precision       precision published to the sinks (log2 seconds) or null
+    leap            leap indicator published to the sinks or null
+    sinks           list of sinks successfully published to
+
+Older version 1 entries have no receiver key; treat them as "es100". Nor do they have clock_step_ns.
+"""
+
+import os
+import time
+import json
+import logging
+import threading
+
+from .config import DEFAULT_RECEIVER_NAME
+
+JOURNAL_VERSION = 1
+
+DEFAULT_MAX_BYTES = 10 * 1024 * 1024    # rotate when the journal reaches this size
+DEFAULT_MAX_AGE = 24 * 3600             # ... or this many seconds old
+DEFAULT_BACKUPS = 7                     # journal.1 thru journal.7 are kept
+DEFAULT_FSYNC_INTERVAL = 10.0           # seconds between group commits
+DEFAULT_FSYNC_BATCH = 64                # ... or sooner if this many entries are waiting
+
+class JournalError(Exception):
+    """ raise this any Journal error """
+
+def journal_entry(attempt, sample=None, sinks=None):
+    """ journal_entry()
+
+    :param attempt: dict from ES100.attempt()
+    :param sample: NTPSample published (or None)
+    :param sinks: list of sinks successfully published to (or None)
+    :return: dict ready for Journal.write()
+    """
+    wwvb_time = attempt['wwvb_time']
+    return {
+        'v': JOURNAL_VERSION,
+        'receiver': attempt.get('receiver', DEFAULT_RECEIVER_NAME),
+        'start_ns': attempt['start_ns'],
+        'irq_ns': attempt['irq_ns'],
+        'duration_ns': attempt['duration_ns'],
+        'mode': 'tracking' if attempt['tracking'] else 'reception',
+        'antenna': attempt['antenna'],
+        'irq_status': attempt['irq_status'],
+        'status0': attempt['status0'],
+        'outcome': attempt['outcome'],
+        'cycles': attempt['cycles'],
+        'timeouts': attempt['timeouts'],
+        'clock_step_ns': attempt.get('clock_step_ns', 0),
+        'wwvb_time': wwvb_time.isoformat() if wwvb_time else None,
+        'delta_seconds': attempt['delta_seconds'],
+        'offset': sample.offset if sample else None,
+        'precision': sample.precision if sample else None,
+        'leap': sample.leap if sample else None,
+        'sinks': [str(sink) for sink in sinks] if sinks else [],
+    }
+
+def read_journal(path):
+    """ read_journal()
+
+    :param path: Journal file name
+    :return: generator of dicts (one per entry)
+
+    A partly written last line (i.e. after a crash) is skipped
+    """
+    with open(path, 'r', encoding='utf-8') as fd:
+        for line in fd:
+            if not line.endswith('\n'):
+                break
+            try:
+                yield json.loads(line)
+            except ValueError:
+                continue
+
+class Journal:
+    """ Journal()
+
+    :param path: Journal file name
+    :param max_bytes: Rotate once the file is this big (0 to disable)
+    :param max_age: Rotate once the file is this many seconds old (0 to disable)
+    :param backups: Number of rotated files kept
+    :param fsync_interval: Seconds between group commits
+    :param fsync_batch: Commit sooner if this many entries are waiting
+    :param debug: True to enable debug messages
+    :param verbose: True to enable verbose messages
+    :return: New instance of Journal()
+
+    write() only appends to a list; a background thread writes, fsyncs and rotates.
+    Hence disk i/o never delays reception or publishing.
+    """
+
+    def __init__(self, path=None, max_bytes=DEFAULT_MAX_BYTES, max_age=DEFAULT_MAX_AGE, backups=DEFAULT_BACKUPS,
+                        fsync_interval=DEFAULT_FSYNC_INTERVAL, fsync_batch=DEFAULT_FSYNC_BATCH,
+                        debug=False, verbose=False):
+        """ :meta private: """
+
+        self._fd = None
+        self._thread = None
+
+        if not isinstance(path, str) or len(path) == 0:
+            raise JournalError('journal path invalid "%s"' % (path))
+        self._path = path
+        self._max_bytes = max_bytes
+        self._max_age = max_age
+        self._backups = backups
+        self._fsync_interval = fsync_interval
+        self._fsync_batch = fsync_batch
+
+        self._log = logging.getLogger(__class__.__name__)
+        self._debug = debug
+        if self._debug:
+            self._log.setLevel(logging.DEBUG)
+        self._verbose = verbose
+        if self._verbose:
+            self._log.setLevel(logging.INFO)
+
+        self._pending = []
+        self._wakeup = threading.Condition()
+        self._closing = False
+        self._opened = None
+
+        self._open()
+
+        self._thread = threading.Thread(target=self._writer, name='journal', daemon=True)
+        self._thread.start()
+        self._log.info('journal ready: %s', self)
+
+    def __del__(self):
+        """ __del__ """
+        self.close()
+
+    def __str__(self):
+        """ __str__ """
+        return '[journal %s]' % (self._path)
+
+    def write(self, entry):
+        """ write()
+
+        :param entry: dict (see journal_entry())
+
+        Queue one entry; it is on disk after the next group commit
+        """
+        line = json.dumps(entry, separators=(',', ':')) + '\n'
+        with self._wakeup:
+            self._pending.append(line)
+            if len(self._pending) >= self._fsync_batch:
+                self._wakeup.notify()
+
+    def close(self):
+        """ close()
+
+        Commit anything waiting and close the file
+        """
+        if self._thread is None:
+            return
+        with self._wakeup:
+            self._closing = True
+            self._wakeup.notify()
+        self._thread.join()
+        self._thread = None
+
+    def _open(self):
+        """ _open """
+        try:
+            self._fd = open(self._path, 'a', encoding='utf-8')
+        except OSError as err:
+            raise JournalError('%s: unable to open: %s' % (self, err)) from err
+        self._opened = time.time()
+        if self._fd.tell() > 0:
+            # appending to an existing journal (i.e. after a restart); don't restart its age
+            self._opened = min(self._opened, self._first_entry_time())
+
+    def _first_entry_time(self):
+        """ _first_entry_time """
+        # the first entry's start_ns is when the file was started; unlike st_mtime,
+        # which every commit moves forward
+        try:
+            for entry in read_journal(self._path):
+                return entry['start_ns'] / 1000000000.0
+        except (OSError, KeyError, TypeError):
+            pass
+        return time.time()
+
+    def _writer(self):
+        """ _writer """
+        while True:
+            with self._wakeup:
+                if not self._closing and len(self._pending) < self._fsync_batch:
+                    self._wakeup.wait(self._fsync_interval)
+                lines = self._pending
+                self._pending = []
+                closing = self._closing
+            if len(lines) > 0:
+                self._commit(lines)
+            if closing:
+                break
+        if self._fd:
+            self._fd.close()
+            self._fd = None
+
+    def _commit(self, lines):
+        """ _commit """
+        if self._fd is None:
+            # a previous rotate could not reopen the file
+            try:
+                self._open()
+            except JournalError as err:
+                self._log.warning('%s (%d entries lost)', err, len(lines))
+                return
+        try:
+            self._fd.write(''.join(lines))
+            self._fd.flush()
+            os.fsync(self._fd.fileno())
+        except OSError as err:
+            # the journal is not allowed to stop reception
+            self._log.warning('%s: write failed (%d entries lost): %s', self, len(lines), err)
+            return
+        self._log.debug('%s: %d entries committed', self, len(lines))
+        if self._rotate_needed():
+            self._rotate()
+
+    def _rotate_needed(self):
+        """ _rotate_needed """
+        if self._max_bytes and self._fd.tell() >= self._max_bytes:
+            return True
+        if self._max_age and time.time() - self._opened >= self._max_age:
+            return True
+        return False
+
+    def _rotate(self):
+        """ _rotate """
+        self._fd.close()
+        self._fd = None
+        try:
+            for n in range(self._backups - 1, 0, -1):
+                if os.path.exists('%s.%d' % (self._path, n)):
+                    os.replace('%s.%d' % (self._path, n), '%s.%d' % (self._path, n + 1))
+            if self._backups > 0:
+                os.replace(self._path, '%s.1' % (self._path))
+            else:
+                os.remove(self._path)
+        except OSError as err:
+            self._log.warning('%s: rotate failed: %s', self, err)
+        try:
+            self._open()
+        except JournalError as err:
+            self._log.error('%s', err)
+            return
+        self._log.info('%s: rotated', self)
@@ -0,0 +1,500 @@
+""" metrics.py
+
+Prometheus/OpenMetrics style exporter for the wwvb daemon
+
+Copyright (C) 2023 Martin J Levy - W6LHI/G8LHI - @mahtin - https://github.com/mahtin
+"""
+
+import time
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from .config import DEFAULT_RECEIVER_NAME
+from .realtime import WAKEUP_BUCKETS
+from .gcguard import GC_PAUSE_BUCKETS
+
+DEFAULT_METRICS_ADDRESS = '127.0.0.1'   # local only; change in wwvb.ini if you scrape from elsewhere
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+REFRESH_TIMEOUT = 1.0                   # seconds a scrape waits for the metrics stage to refresh the gauges
+
+# buckets are in seconds
+TIME_TO_FIX_BUCKETS = [10, 15, 20, 25, 30, 45, 60, 90, 135, 180, 270, 405, 600, 900, 1800]
+DELTA_SECONDS_BUCKETS = [-2.0, -1.0, -0.5, -0.25, -0.1, -0.05, 0.0, 0.05, 0.1, 0.25, 0.5, 1.0, 2.0]
+PUBLISH_BUCKETS = [0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1]
+I2C_BUCKETS = [0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05]
+START_SLACK_BUCKETS = [-30.0, -10.0, -1.0, 0.0, 1.0, 5.0, 10.0, 20.0, 30.0, 40.0]
+
+class MetricsError(Exception):
+    """ raise this any Metrics error """
+
+def _labels(names, values):
+    """ _labels """
+    if len(names) == 0:
+        return ''
+    return '{%s}' % (','.join(['%s="%s"' % (name, _escape(value)) for name, value in zip(names, values)]))
+
+def _escape(value):
+    """ _escape """
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _number(value):
+    """ _number """
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, int):
+        return '%d' % (value)
+    return repr(float(value))
+
+class Counter:
+    """ Counter()
+
+    :param name: Metric name
+    :param text: Help text
+    :param labelnames: Label names (values are passed as a tuple in the same order)
+    :return: New instance of Counter()
+    """
+
+    kind = 'counter'
+
+    def __init__(self, name, text, labelnames=()):
+        """ :meta private: """
+        self.name = name
+        self.text = text
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+
+    def inc(self, labels=(), value=1):
+        """ inc() """
+        self._values[labels] = self._values.get(labels, 0) + value
+
+    def set(self, labels=(), value=0):
+        """ set() - for a counter this mirrors a count kept elsewhere """
+        self._values[labels] = value
+
+    def render(self):
+        """ render() """
+        lines = []
+        for labels, value in sorted(list(self._values.items())):
+            lines.append('%s%s %s' % (self.name, _labels(self.labelnames, labels), _number(value)))
+        return lines
+
+class Gauge(Counter):
+    """ Gauge()
+
+    :param name: Metric name
+    :param text: Help text
+    :param labelnames: Label names (values are passed as a tuple in the same order)
+    :return: New instance of Gauge()
+    """
+
+    kind = 'gauge'
+
+class Histogram:
+    """ Histogram()
+
+    :param name: Metric name
+    :param text: Help text
+    :param buckets: Upper bounds (sorted); +Inf is added
+    :param labelnames: Label names (values are passed as a tuple in the same order)
+    :return: New instance of Histogram()
+
+    Bucket counts are kept non-cumulative and summed at scrape time; hence _count always equals the +Inf bucket
+    """
+
+    kind = 'histogram'
+
+    def __init__(self, name, text, buckets, labelnames=()):
+        """ :meta private: """
+        self.name = name
+        self.text = text
+        self.labelnames = tuple(labelnames)
+        self._buckets = list(buckets) + [float('inf')]
+        self._values = {}
+
+    def observe(self, value, labels=()):
+        """ observe() """
+        counts = self._values.get(labels)
+        if counts is None:
+            # the last entry is the sum
+            counts = [0] * len(self._buckets) + [0.0]
+            self._values[labels] = counts
+        for n, bound in enumerate(self._buckets):
+            if value <= bound:
+                counts[n] += 1
+                break
+        counts[-1] += value
+
+    def load(self, counts, labels=()):
+        """ load()
+
+        :param counts: Bucket counts (non-cumulative) followed by the sum; as kept by observe()
+        :param labels: Label values
+
+        For a histogram kept elsewhere (i.e. by the wake-up probe); copied at scrape time
+        """
+        if len(counts) != len(self._buckets) + 1:
+            raise MetricsError('%s: %d buckets expected' % (self.name, len(self._buckets)))
+        self._values[labels] = list(counts)
+
+    def render(self):
+        """ render() """
+        lines = []
+        labelnames = self.labelnames + ('le',)
+        for labels, counts in sorted(list(self._values.items())):
+            counts = list(counts)
+            total = 0
+            for bound, count in zip(self._buckets, counts):
+                total += count
+                lines.append('%s_bucket%s %d' % (self.name, _labels(labelnames, labels + (_number(bound),)), total))
+            lines.append('%s_sum%s %s' % (self.name, _labels(self.labelnames, labels), _number(counts[-1])))
+            lines.append('%s_count%s %d' % (self.name, _labels(self.labelnames, labels), total))
+        return lines
+
+class Metrics:
+    """ Metrics()
+
+    :param sinks: Sinks instance (for the per-sink state) or None
+    :param pipeline: Pipeline instance (for the per-stage state) or None
+    :param realtime: RealtimeProfile instance (for the wake-up latency and what was applied) or None
+    :param gcguard: GCGuard instance (for the collections and pauses) or None
+    :param debug: True to enable debug messages
+    :param verbose: True to enable verbose messages
+    :return: New instance of Metrics()
+
+    All updates come from one thread (the metrics pipeline stage, a single writer) and are plain dict/list updates; no locks.
+    The HTTP server thread only ever copies what it reads, so a scrape can never hold up a reception.
+    """
+
+    def __init__(self, sinks=None, pipeline=None, realtime=None, gcguard=None, debug=False, verbose=False):
+        """ :meta private: """
+        self._sinks = sinks
+        self._pipeline = pipeline
+        self._realtime = realtime
+        self._gcguard = gcguard
+        self._server = None
+        self._thread = None
+        self._last_attempt = None
+        self._last_fix_ns = {}
+
+        self._log = logging.getLogger(__class__.__name__)
+        self._debug = debug
+        if self._debug:
+            self._log.setLevel(logging.DEBUG)
+        self._verbose = verbose
+        if self._verbose:
+            self._log.setLevel(logging.INFO)
+
+        self.attempts = Counter('wwvb_attempts_total',
+                                'Reception attempts by outcome (RX_OK, RX_FAIL, CYCLE_COMPLETE, I2C_ERROR)',
+                                ('receiver', 'mode', 'antenna', 'outcome'))
+        self.events = Counter('wwvb_events_total',
+                                'ES100 events seen during reception attempts (CYCLE_COMPLETE, timeout)',
+                                ('receiver', 'mode', 'antenna', 'event'))
+        self.time_to_fix = Histogram('wwvb_time_to_fix_seconds',
+                                'Time from START to a successful RX_COMPLETE',
+                                TIME_TO_FIX_BUCKETS,
+                                ('receiver', 'mode', 'antenna'))
+        self.delta_seconds = Histogram('wwvb_delta_seconds',
+                                'WWVB time minus system time for each full reception',
+                                DELTA_SECONDS_BUCKETS,
+                                ('receiver', 'antenna'))
+        self.fusion = Counter('wwvb_fusion_total',
+                                'Full receptions offered to the fusion vote (chosen, agreed, outvoted or unresolved)',
+                                ('receiver', 'result'))
+        self.publish_latency = Histogram('wwvb_irq_to_publish_seconds',
+                                'Time from the ES100 IRQ to the fix being published to every sink',
+                                PUBLISH_BUCKETS)
+        self.fix_votes = Gauge('wwvb_fix_votes',
+                                'Receivers that agreed with the last fix published (agreed) and that had a fix that minute (candidates)',
+                                ('count',))
+        self.i2c_latency = Histogram('wwvb_i2c_transaction_seconds',
+                                'Time taken by each i2c register read or write',
+                                I2C_BUCKETS)
+        self.last_fix_age = Gauge('wwvb_last_fix_age_seconds',
+                                'Seconds since the last successful reception (or tracking)',
+                                ('mode',))
+        self.sink_up = Gauge('wwvb_sink_up',
+                                'One if the last publish to this sink succeeded',
+                                ('sink',))
+        self.sink_published = Counter('wwvb_sink_published_total',
+                                'Samples published to this sink',
+                                ('sink',))
+        self.sink_errors = Counter('wwvb_sink_errors_total',
+                                'Failed publishes to this sink',
+                                ('sink',))
+        self.sink_latency = Gauge('wwvb_sink_publish_seconds',
+                                'Time taken by the last publish to this sink',
+                                ('sink',))
+        self.start_missed = Counter('wwvb_tracking_start_missed_total',
+                                'Tracking STARTs missed because the receiver was re-armed after HH:MM:55',
+                                ('receiver',))
+        self.start_slack = Histogram('wwvb_tracking_start_slack_seconds',
+                                'Time left before HH:MM:55 when the receiver was re-armed for tracking (negative is late)',
+                                START_SLACK_BUCKETS,
+                                ('receiver',))
+        self.clock_steps = Counter('wwvb_clock_steps_total',
+                                'System clock steps noticed by the receiver (during an attempt) or before publishing',
+                                ('receiver', 'seen'))
+        self.clock_stepped = Counter('wwvb_clock_stepped_attempts_total',
+                                'Attempts with a system clock step between START and the final IRQ',
+                                ('receiver', 'mode'))
+        self.clock_step_last = Gauge('wwvb_clock_step_last_seconds',
+                                'The last system clock step noticed (positive is forward)',
+                                ('receiver',))
+        self.stage_handled = Counter('wwvb_stage_handled_total',
+                                'Work handled by this pipeline stage',
+                                ('stage',))
+        self.stage_dropped = Counter('wwvb_stage_dropped_total',
+                                'Work dropped because this pipeline stage was full',
+                                ('stage',))
+        self.stage_errors = Counter('wwvb_stage_errors_total',
+                                'Work that failed in this pipeline stage',
+                                ('stage',))
+        self.stage_latency = Gauge('wwvb_stage_seconds',
+                                'Time taken by the last work in this pipeline stage',
+                                ('stage',))
+
+        self.wakeup_latency = Histogram('wwvb_wakeup_latency_seconds',
+                                'How late the wake-up probe thread woke (the scheduling latency an IRQ wait also sees)',
+                                WAKEUP_BUCKETS)
+        self.realtime_applied = Gauge('wwvb_realtime_applied',
+                                'One if this part of the real-time profile was applied',
+                                ('setting',))
+        self.gc_collections = Counter('wwvb_gc_collections_total',
+                                'Garbage collections by generation (with the gc guard, all run outside the IRQ windows)',
+                                ('generation',))
+        self.gc_avoided = Counter('wwvb_gc_pauses_avoided_total',
+                                'IRQ windows that closed with an automatic garbage collection due; i.e. a pause kept out of the timestamp')
+        self.gc_deferred = Counter('wwvb_gc_deferred_total',
+                                'Garbage collections put off because an IRQ window was open')
+        self.gc_pause = Histogram('wwvb_gc_pause_seconds',
+                                'Time taken by each garbage collection',
+                                GC_PAUSE_BUCKETS)
+
+        self._metrics = [
+            self.attempts,
+            self.events,
+            self.time_to_fix,
+            self.delta_seconds,
+            self.fusion,
+            self.publish_latency,
+            self.fix_votes,
+            self.i2c_latency,
+            self.last_fix_age,
+            self.sink_up,
+            self.sink_published,
+            self.sink_errors,
+            self.sink_latency,
+            self.start_missed,
+            self.start_slack,
+            self.clock_steps,
+            self.clock_stepped,
+            self.clock_step_last,
+            self.stage_handled,
+            self.stage_dropped,
+            self.stage_errors,
+            self.stage_latency,
+            self.wakeup_latency,
+            self.realtime_applied,
+            self.gc_collections,
+            self.gc_avoided,
+            self.gc_deferred,
+            self.gc_pause,
+        ]
+
+    def __del__(self):
+        """ __del__ """
+        self.stop()
+
+    def __str__(self):
+        """ __str__ """
+        if self._server is None:
+            return '[metrics]'
+        return '[metrics http://%s:%d/metrics]' % self._server.server_address[:2]
+
+    def attempt(self, attempt):
+        """ attempt()
+
+        :param attempt: dict from ES100.attempt()
+
+        Record one reception attempt; calling again with the same attempt does nothing
+        """
+        if not attempt or attempt is self._last_attempt:
+            return
+        self._last_attempt = attempt
+
+        receiver = attempt.get('receiver', DEFAULT_RECEIVER_NAME)
+        mode = 'tracking' if attempt['tracking'] else 'reception'
+        antenna = attempt['antenna']
+        self.attempts.inc((receiver, mode, antenna, attempt['outcome']))
+        if attempt['cycles'] > 0:
+            self.events.inc((receiver, mode, antenna, 'CYCLE_COMPLETE'), attempt['cycles'])
+        if attempt['timeouts'] > 0:
+            self.events.inc((receiver, mode, antenna, 'timeout'), attempt['timeouts'])
+        for i2c_ns in attempt['i2c_ns']:
+            self.i2c_latency.observe(i2c_ns / 1000000000.0)
+        if attempt.get('clock_steps'):
+            self.clock_steps.inc((receiver, 'receiver'), attempt['clock_steps'])
+        if attempt.get('clock_step_ns'):
+            self.clock_stepped.inc((receiver, mode))
+            self.clock_step_last.set((receiver,), attempt['clock_step_ns'] / 1000000000.0)
+
+        if attempt['outcome'] != 'RX_OK':
+            return
+        if attempt['duration_ns'] is not None:
+            self.time_to_fix.observe(attempt['duration_ns'] / 1000000000.0, (receiver, mode, antenna))
+        if attempt['delta_seconds'] is not None:
+            self.delta_seconds.observe(attempt['delta_seconds'], (receiver, antenna))
+        if attempt['irq_ns'] is not None:
+            self._last_fix_ns[mode] = attempt['irq_ns']
+
+    def published(self, latency_ns, votes=1, candidates=1):
+        """ published()
+
+        :param latency_ns: Nanoseconds from the IRQ to the end of publishing to every sink
+        :param votes: Receivers that agreed with the sample published
+        :param candidates: Receivers that had a fix for this minute
+        """
+        self.publish_latency.observe(latency_ns / 1000000000.0)
+        self.fix_votes.set(('agreed',), votes)
+        self.fix_votes.set(('candidates',), candidates)
+
+    def fused(self, receiver, result):
+        """ fused()
+
+        :param receiver: Receiver name
+        :param result: 'chosen', 'agreed', 'outvoted' or 'unresolved'
+        """
+        self.fusion.inc((receiver, result))
+
+    def deadline(self, receiver, late_ns):
+        """ deadline()
+
+        :param receiver: Receiver name
+        :param late_ns: Nanoseconds late for the tracking START (negative is the slack left)
+        """
+        if late_ns > 0:
+            self.start_missed.inc((receiver,))
+        self.start_slack.observe(-late_ns / 1000000000.0, (receiver,))
+
+    def clock_step(self, receiver, step_ns):
+        """ clock_step()
+
+        :param receiver: Receiver name
+        :param step_ns: Nanoseconds the system clock was stepped between the IRQ and publishing
+        """
+        self.clock_steps.inc((receiver, 'publish'))
+        self.clock_step_last.set((receiver,), step_ns / 1000000000.0)
+
+    def refresh(self, done=None):
+        """ refresh()
+
+        :param done: threading.Event set once refreshed (or None)
+
+        Copy in the gauges that only make sense at scrape time; run in the metrics pipeline stage (the one writer)
+        """
+        # gauges that only make sense at scrape time
+        now_ns = time.time_ns()
+        for mode, last_fix_ns in list(self._last_fix_ns.items()):
+            self.last_fix_age.set((mode,), (now_ns - last_fix_ns) / 1000000000.0)
+        if self._sinks is not None:
+            for stats in self._sinks.stats():
+                sink = (str(stats.sink),)
+                self.sink_up.set(sink, 1 if stats.last_ok else 0)
+                self.sink_published.set(sink, stats.published)
+                self.sink_errors.set(sink, stats.errors)
+                self.sink_latency.set(sink, stats.last_ns / 1000000000.0)
+        if self._pipeline is not None:
+            for stats in self._pipeline.stats():
+                stage = (stats.name,)
+                self.stage_handled.set(stage, stats.handled)
+                self.stage_dropped.set(stage, stats.dropped)
+                self.stage_errors.set(stage, stats.errors)
+                self.stage_latency.set(stage, stats.last_ns / 1000000000.0)
+        if self._realtime is not None:
+            histogram = self._realtime.histogram()
+            if histogram is not None:
+                self.wakeup_latency.load(histogram.counts())
+            for setting, result in self._realtime.status().items():
+                self.realtime_applied.set((setting,), 1 if result is True else 0)
+        if self._gcguard is not None:
+            for generation, count in enumerate(self._gcguard.collections):
+                self.gc_collections.set((str(generation),), count)
+            self.gc_avoided.set((), self._gcguard.avoided)
+            self.gc_deferred.set((), self._gcguard.deferred)
+            self.gc_pause.load(self._gcguard.pause_counts())
+        if done is not None:
+            done.set()
+
+    def render(self):
+        """ render()
+
+        :return: All metrics in Prometheus text exposition format (version 0.0.4)
+
+        Called from the HTTP server thread; the metrics stage is asked to refresh the scrape time gauges first
+        """
+        if self._pipeline is not None and 'metrics' in self._pipeline:
+            done = threading.Event()
+            if self._pipeline.submit('metrics', 'refresh', done):
+                # a full (or stuck) stage means a stale scrape; never a second writer
+                done.wait(REFRESH_TIMEOUT)
+        else:
+            # no metrics stage; hence no other writer
+            self.refresh()
+
+        lines = []
+        for metric in self._metrics:
+            lines.append('# HELP %s %s' % (metric.name, metric.text))
+            lines.append('# TYPE %s %s' % (metric.name, metric.kind))
+            lines += metric.render()
+        return '\n'.join(lines) + '\n'
+
+    def start(self, port, address=DEFAULT_METRICS_ADDRESS):
+        """ start()
+
+        :param port: TCP port to listen on
+        :param address: Address to listen on (Default is 127.0.0.1)
+
+        Serve /metrics from a background (daemon) thread
+        """
+        metrics = self
+        log = self._log
+
+        class Handler(BaseHTTPRequestHandler):
+            """ Handler """
+
+            def do_GET(self):
+                """ do_GET """
+                # pylint: disable=invalid-name
+                if self.path.split('?')[0] not in ['/metrics', '/']:
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', CONTENT_TYPE)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                """ log_message """
+                # pylint: disable=redefined-builtin
+                log.debug('%s %s', self.address_string(), format % args)
+
+        try:
+            self._server = ThreadingHTTPServer((address, port), Handler)
+        except OSError as err:
+            raise MetricsError('unable to listen on %s:%s: %s' % (address, port, err)) from err
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, name='metrics', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """ stop() """
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+            self._thread = None
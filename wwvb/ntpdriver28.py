@@ -8,19 +8,23 @@ Copyright (C) 2023 Martin J Levy - W6LHI/G8LHI - @mahtin - https://github.com/ma
 import os
 import pwd
 import grp
+import struct
 import logging
 import datetime
+import threading
 
 try:
     import sysv_ipc
 except ImportError:
     sysv_ipc = None
 
+from es100 import trace
+
 # https://github.com/ntp-project/ntp/blob/master-no-authorname/ntpd/refclock_shm.c
 NTPD_DEFAULT_KEY = 0x4E545030
 
-# Unclear how to code this up cleanly.
-# We guess the received clock precision to around -5 or 31.25 milliseconds
+# The precision advertised is estimated from measured jitter (see precision.py)
+# Until there's enough data, we guess the received clock precision to around -5 or 31.25 milliseconds
 # Note that a positive number reflects a very poor clock accuracy
 NTPD_PRECISION = {
     -10: pow(2, -10),   # 0.9765625 milliseconds
@@ -90,6 +94,119 @@ SHM_LAYOUT64 = {
     'dummy':                (64, 32, 'int[8]')   # size 4 * 8 # int[8]
 }
 
+# struct format characters for each (ctype, size) found in the layouts above
+# all supported arch's are little endian; which matches the previous int.to_bytes() code
+SHM_CTYPE_FORMAT = {
+    ('int', 4):         'i',
+    ('unsigned', 4):    'I',
+    ('time_t', 4):      'I',
+    ('time_t', 8):      'Q',
+}
+
+# the timestamp part of a sample - these are contiguous (with padding) in both layouts
+SHM_SAMPLE_FIELDS = (
+    'clockTimeStampSec',
+    'clockTimeStampUSec',
+    'receiveTimeStampSec',
+    'receiveTimeStampUSec',
+    'leap',
+    'precision',
+)
+
+SHM_NSEC_FIELDS = (
+    'clockTimeStampNSec',
+    'receiveTimeStampNSec',
+)
+
+def compile_layout(layout, names):
+    """ compile_layout()
+
+    :param layout: SHM_LAYOUT32 or SHM_LAYOUT64
+    :param names: list of contiguous field names (in offset order)
+    :return: (offset, struct.Struct) covering those fields, padding included
+
+    Build a precompiled struct.Struct for a run of shmTime fields.
+    """
+    start = layout[names[0]][0]
+    position = start
+    fmt = '<'
+    for name in names:
+        offset, size, ctype = layout[name]
+        if offset < position:
+            raise NTPDriver28Error('%s: fields out of order' % (name))
+        fmt += 'x' * (offset - position)
+        fmt += SHM_CTYPE_FORMAT[(ctype, size)]
+        position = offset + size
+    return (start, struct.Struct(fmt))
+
+UNIX_EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+
+def datetime_to_ns(dt):
+    """ datetime_to_ns()
+
+    :param dt: datetime (naive values are taken as UTC)
+    :return: integer nanoseconds since the Unix epoch
+
+    Exact conversion - no float timestamp() round trip.
+    """
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=datetime.timezone.utc)
+    delta = dt - UNIX_EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1000000000 + delta.microseconds * 1000
+
+def leap_indicator(leap_second):
+    """ leap_indicator()
+
+    :param leap_second: None, 'positive' or 'negative' (as returned by ES100.leap_second())
+    :return: NTP leap indicator value
+    """
+    # values taken from include/ntp.h
+    if leap_second is None:
+        return 0                                # LEAP_NOWARNING
+    if leap_second == 'positive':
+        return 1                                # LEAP_ADDSECOND
+    if leap_second == 'negative':
+        return 2                                # LEAP_DELSECOND
+    return 3                                    # LEAP_NOTINSYNC
+
+class NTPSample:
+    """ NTPSample()
+
+    :param received_ns: WWVB received time in nanoseconds since the epoch
+    :param sys_received_ns: System time when received in nanoseconds since the epoch
+    :param leap_second: leap second indication
+    :param precision: log2 precision to advertise (see NTPD_PRECISION)
+    :return: New instance of NTPSample()
+
+    One fix; split into the values every sink needs. Computed once, published to many.
+    """
+
+    __slots__ = (
+        'received_ns', 'sys_received_ns', 'leap_second', 'leap', 'offset', 'precision',
+        'clock_sec', 'clock_nsec', 'receive_sec', 'receive_nsec',
+    )
+
+    def __init__(self, received_ns, sys_received_ns, leap_second=None, precision=-5):
+        """ :meta private: """
+        self.received_ns = received_ns
+        self.sys_received_ns = sys_received_ns
+        self.leap_second = leap_second
+        self.leap = leap_indicator(leap_second)
+        self.precision = precision
+        # offset is true time minus system time
+        self.offset = (received_ns - sys_received_ns) / 1000000000.0
+        (self.clock_sec, self.clock_nsec) = divmod(received_ns, 1000000000)
+        (self.receive_sec, self.receive_nsec) = divmod(sys_received_ns, 1000000000)
+
+    def __str__(self):
+        """ __str__ """
+        return '[%d.%09d at %d.%09d leap=%d precision=%d]' % (
+                    self.clock_sec, self.clock_nsec,
+                    self.receive_sec, self.receive_nsec,
+                    self.leap,
+                    self.precision,
+                )
+
 class NTPDriver28Error(Exception):
     """ raise this any NTPDriver28 error """
 
@@ -99,6 +216,8 @@ class NTPDriver28:
     :param unit: The unit number of this clock source (0 thru 255)
     :param debug: True to enable debug messages
     :param verbose: True to enable verbose messages
+    :param mode: refclock_shm mode 0 or 1 (default is 1)
+    :param read_only: True to attach read-only (monitoring only; nothing can be published)
     :return: New instance of NTPDriver28()
 
     Implements driver28 - allows a Shared Memory segment to be used to talk between NTPv4 and clock
@@ -109,10 +228,12 @@ class NTPDriver28:
     See http://semanchuk.com/philip/sysv_ipc/#shared_memory & https://github.com/osvenskan/sysv_ipc
     """
 
-    def __init__(self, unit=0, debug=False, verbose=False):
+    def __init__(self, unit=0, debug=False, verbose=False, mode=1, read_only=False):
         """ :meta private: """
 
         self._shm = None
+        self._view = None
+        self._read_only = read_only
 
         if not sysv_ipc:
             raise NTPDriver28Error('sysv_ipc package not installed - no shared memory access')
@@ -120,8 +241,8 @@ class NTPDriver28:
         if isinstance(unit, str) and len(unit) > 0:
             try:
                 unit = int(unit)
-            except ValueError:
-                raise NTPDriver28Error('ntp shared memory unit invalid: "%s"' % (unit))
+            except ValueError as err:
+                raise NTPDriver28Error('ntp shared memory unit invalid: "%s"' % (unit)) from err
         elif isinstance(unit, int):
             if not 0 <= unit < 256:
                 raise NTPDriver28Error('ntp shared memory unit invalid: %d' % (unit))
@@ -129,6 +250,17 @@ class NTPDriver28:
             raise NTPDriver28Error('ntp shared memory unit invalid "%s"' % (unit))
         self._unit = unit
 
+        try:
+            mode = int(mode)
+        except (ValueError, TypeError) as err:
+            raise NTPDriver28Error('ntp shared memory mode invalid: "%s"' % (mode)) from err
+        if mode not in [0, 1]:
+            raise NTPDriver28Error('ntp shared memory mode invalid: %d' % (mode))
+        self._mode = mode
+
+        # keeps this thread's steps in order (see _fence()); it is not a cross-process memory barrier
+        self._barrier = threading.Lock()
+
         self._log = logging.getLogger(__class__.__name__)
 
         self._debug = debug
@@ -160,6 +292,24 @@ class NTPDriver28:
             self._shm = None
             raise NTPDriver28Error('arch and size mismatch/unknown')
 
+        # precompile the structs used on every update() - no per-field lookups or allocations later
+        self._fields = {}
+        for name, offset_size_ctype in self._mapping.items():
+            offset, size, ctype = offset_size_ctype
+            if (ctype, size) in SHM_CTYPE_FORMAT:
+                self._fields[name] = (offset, struct.Struct('<' + SHM_CTYPE_FORMAT[(ctype, size)]))
+        self._sample = compile_layout(self._mapping, SHM_SAMPLE_FIELDS)
+        self._nsec = compile_layout(self._mapping, SHM_NSEC_FIELDS)
+
+        # newer sysv_ipc releases support the buffer protocol; hence we can write in-place
+        try:
+            self._view = memoryview(self._shm)
+            if self._read_only:
+                # the attach is read-only; however, the buffer doesn't know that - writing would crash
+                self._view = self._view.toreadonly()
+        except TypeError:
+            self._view = None
+
         self._log.info('SHM connected: %r', self)
 
         # starting thing off by reading the shared memory - we don't do anything with it yet
@@ -167,6 +317,9 @@ class NTPDriver28:
 
     def __del__(self):
         """ __del__ """
+        if self._view is not None:
+            self._view.release()
+            self._view = None
         self._detach()
         self._shm = None
 
@@ -211,6 +364,8 @@ class NTPDriver28:
 
         :return: The number of bytes written
         """
+        if self._read_only:
+            raise NTPDriver28Error('%s: attached read-only' % (self))
         return self._shm.write(some_bytes, offset)
 
     def load(self):
@@ -274,50 +429,159 @@ class NTPDriver28:
 
         :param received_dt: WWVB received date and time
         :param sys_received_dt: System time when received
+        :param leap_second: leap second indication
 
         Do the nitty-gritty NTP update via shared memory
         """
 
-        self._log.info('update(%s, %s, %s)', received_dt, sys_received_dt, leap_second)
+        self.update_ns(datetime_to_ns(received_dt), datetime_to_ns(sys_received_dt), leap_second)
 
-        wwvb_time = received_dt.timestamp()
-        sys_time = sys_received_dt.timestamp()
+    def update_ns(self, received_ns, sys_received_ns, leap_second=None):
+        """ update_ns()
 
-        self.load()
-        self._store_value('mode', 1)            # 1 == operational mode 1
-
-        self._store_value('clockTimeStampSec', int(wwvb_time))
-        self._store_value('clockTimeStampUSec', int(1000000 * (wwvb_time%1)))
-        self._store_value('clockTimeStampNSec', 0)
-
-        self._store_value('receiveTimeStampSec', int(sys_time))
-        self._store_value('receiveTimeStampUSec', int(1000000 * (sys_time%1)))
-        self._store_value('receiveTimeStampNSec', 0)
-
-        # values taken from include/ntp.h
-        if leap_second is None:
-            self._store_value('leap', 0)        # LEAP_NOWARNING
-        elif leap_second == 'positive':
-            self._store_value('leap', 1)        # LEAP_ADDSECOND
-        elif leap_second == 'negative':
-            self._store_value('leap', 2)        # LEAP_DELSECOND
+        :param received_ns: WWVB received time in nanoseconds since the epoch
+        :param sys_received_ns: System time when received in nanoseconds since the epoch
+        :param leap_second: leap second indication
+
+        Same as update(); however the Sec, USec and NSec fields are filled exactly
+        """
+
+        self.publish(NTPSample(received_ns, sys_received_ns, leap_second))
+
+    def publish(self, sample):
+        """ publish()
+
+        :param sample: NTPSample instance
+
+        Write a precomputed sample into shared memory
+        """
+
+        self._log.debug('publish(%s)', sample)
+
+        if self._read_only:
+            raise NTPDriver28Error('%s: attached read-only' % (self))
+
+        start_ns = trace.begin()
+
+        # refclock_shm handshake. Readers (ntpd or chronyd) ignore the segment while valid is 0
+        # and, in mode 1, reject any copy where count moved underneath them.
+        # count is bumped in mode 0 too; ntpd ignores it there, but pollers of count (util/sht.py) don't.
+        # Each step should land in memory before the next. Python has no memory barrier; the fences only keep
+        # this thread's steps in order. On x86 that's also the order ntpd/chronyd see; on a weakly ordered CPU
+        # (i.e. ARM) nothing here promises it. The shmTime layout belongs to ntpd (no room for a check like
+        # fixshm.py and ring.py have); ntpd and chronyd's own checks of valid and count are all there is.
+
+        self._put_field('valid', 0)
+        self._fence()
+
+        if self._get_field('mode') != self._mode:
+            self._put_field('mode', self._mode)
+
+        count = self._bump_count()
+        self._fence()
+
+        offset, compiled = self._sample
+        self._put(compiled, offset,
+                    sample.clock_sec, sample.clock_nsec // 1000,
+                    sample.receive_sec, sample.receive_nsec // 1000,
+                    sample.leap,
+                    sample.precision,           # See NTPD_PRECISION above
+                )
+        offset, compiled = self._nsec
+        self._put(compiled, offset, sample.clock_nsec, sample.receive_nsec)
+        self._fence()
+
+        count = self._bump_count()
+        self._fence()
+
+        self._put_field('valid', 1) # go!
+
+        if start_ns:
+            trace.end('ntpd28.publish', start_ns, {'unit': self._unit, 'mode': self._mode, 'count': count})
+
+        if self._log.getEffectiveLevel() <= logging.DEBUG:
+            self.load()
+            self.dump('Sending time to NTP mode=%d count=%s ' % (self._mode, count))
+
+    def count(self):
+        """ count()
+
+        :return: The present count value
+
+        A cheap check for a new sample - only four bytes are read
+        """
+        return self._get_field('count')
+
+    def snapshot(self):
+        """ snapshot()
+
+        :return: dict of shmTime values or None if the segment changed while being read (a torn read)
+
+        Copy the segment the way ntpd does in mode 1; count, copy, then recheck count.
+        The writer clears valid before the sample and bumps count either side of it; hence a copy
+        with valid clear is part way through a write (or already taken by ntpd) and is never a sample.
+        """
+        before = self._get_field('count')
+        if self._view is not None:
+            copy = bytes(self._view)
         else:
-            self._store_value('leap', 3)        # LEAP_NOTINSYNC
+            copy = self.read(self._size, 0)
+        if self._get_field('count') != before:
+            return None
+        values = {}
+        for name, offset_compiled in self._fields.items():
+            offset, compiled = offset_compiled
+            values[name] = compiled.unpack_from(copy, offset)[0]
+        if not values['valid']:
+            return None
+        return values
 
-        self._store_value('precision', -5)      # 1/32'nd of a second. See NTPD_PRECISION above
+    def _bump_count(self):
+        """ _bump_count() """
+        # we are the only writer of count; ntpd only ever reads it
+        count = (self._get_field('count') + 1) & 0x7fffffff
+        self._put_field('count', count)
+        return count
+
+    def _fence(self):
+        """ _fence() """
+        # a process-private threading.Lock; it orders nothing as seen from another process
+        with self._barrier:
+            pass
+
+    def _put(self, compiled, offset, *values):
+        """ _put()
+
+        :param compiled: precompiled struct.Struct
+        :param offset: Number of bytes from start of shared memory
+        :param values: Values to pack
+
+        Pack values straight into the shared memory
+        """
+        if self._view is not None:
+            compiled.pack_into(self._view, offset, *values)
+        else:
+            self._shm.write(compiled.pack(*values), offset)
 
-        count = self._read_value('count')
-        count += 1
-        self._store_value('count', count)
+    def _put_field(self, name, value):
+        """ _put_field() """
+        offset, compiled = self._fields[name]
+        self._put(compiled, offset, value)
 
-        self._store_value('valid', 1) # go!
-        self.dump('Sending time to NTP count=%d ' % (count))
-        self.unload()
+    def _get_field(self, name):
+        """ _get_field() """
+        offset, compiled = self._fields[name]
+        if self._view is not None:
+            return compiled.unpack_from(self._view, offset)[0]
+        return compiled.unpack(self._shm.read(compiled.size, offset))[0]
 
     def _attach(self):
         """ _attach """
         try:
             self._shm = sysv_ipc.SharedMemory(NTPD_DEFAULT_KEY + self._unit)
+            if self._read_only:
+                self._shm.detach()
+                self._shm.attach(None, sysv_ipc.SHM_RDONLY)
         except Exception as err:
             raise NTPDriver28Error('unable to attach to shared memory: %s' % (err)) from err
         self._log.debug('SHM attached')
@@ -0,0 +1,228 @@
+""" pipeline.py
+
+Hand each fix (and everything else done after a reception) to stages that run on their own threads
+
+Copyright (C) 2023 Martin J Levy - W6LHI/G8LHI - @mahtin - https://github.com/mahtin
+
+A stage is a name, a handler and a bounded queue serviced by one (daemon) thread. The reception loop
+only ever queues; it's back to receiving straight away no matter how slow a stage is. A stage that
+falls behind by a whole queue has new work dropped (and counted) rather than holding up the loop.
+Stages are independent; a slow or failing one never affects another.
+
+Stages added with fix=True get every publish(reception, sample, votes, candidates); any stage can be
+sent work directly with submit(name, ...). Work for a stage is handled in the order it was queued.
+"""
+
+import time
+import queue
+import logging
+import threading
+
+DEFAULT_QUEUE_SIZE = 64         # per stage
+DEFAULT_STOP_TIMEOUT = 5.0      # seconds to finish what's queued on exit
+
+class PipelineError(Exception):
+    """ raise this any Pipeline error """
+
+class StageStats:
+    """ StageStats()
+
+    :param name: Stage name
+    :return: New instance of StageStats()
+
+    Per-stage counters and handler time (in nanoseconds)
+    """
+
+    __slots__ = ('name', 'handled', 'dropped', 'errors', 'last_ns', 'total_ns', 'max_ns', 'last_error')
+
+    def __init__(self, name):
+        """ :meta private: """
+        self.name = name
+        self.handled = 0
+        self.dropped = 0
+        self.errors = 0
+        self.last_ns = 0
+        self.total_ns = 0
+        self.max_ns = 0
+        self.last_error = None
+
+    def __str__(self):
+        """ __str__ """
+        mean_ns = self.total_ns / self.handled if self.handled else 0
+        return '%s handled=%d dropped=%d errors=%d time last=%.1fus mean=%.1fus max=%.1fus' % (
+                    self.name,
+                    self.handled,
+                    self.dropped,
+                    self.errors,
+                    self.last_ns / 1000.0,
+                    mean_ns / 1000.0,
+                    self.max_ns / 1000.0,
+                )
+
+class _Stage:
+    """ _Stage """
+
+    __slots__ = ('name', 'handler', 'fix', 'queue', 'thread', 'stats')
+
+    def __init__(self, name, handler, fix, maxsize):
+        """ :meta private: """
+        self.name = name
+        self.handler = handler
+        self.fix = fix
+        self.queue = queue.Queue(maxsize)
+        self.thread = None
+        self.stats = StageStats(name)
+
+class Pipeline:
+    """ Pipeline()
+
+    :param debug: True to enable debug messages
+    :param verbose: True to enable verbose messages
+    :return: New instance of Pipeline()
+
+    add() every stage, then start(); publish() and submit() never block.
+    """
+
+    def __init__(self, debug=False, verbose=False):
+        """ :meta private: """
+        self._stages = {}
+        self._started = False
+
+        self._log = logging.getLogger(__class__.__name__)
+        self._debug = debug
+        if self._debug:
+            self._log.setLevel(logging.DEBUG)
+        self._verbose = verbose
+        if self._verbose:
+            self._log.setLevel(logging.INFO)
+
+    def __len__(self):
+        """ __len__ """
+        return len(self._stages)
+
+    def __contains__(self, name):
+        """ __contains__ """
+        return name in self._stages
+
+    def __str__(self):
+        """ __str__ """
+        return '[pipeline %s]' % (', '.join(self._stages))
+
+    def add(self, name, handler, fix=False, maxsize=DEFAULT_QUEUE_SIZE):
+        """ add()
+
+        :param name: Stage name (unique)
+        :param handler: Called (on the stage's thread) with whatever was queued
+        :param fix: True if the stage gets every publish(reception, sample, votes, candidates)
+        :param maxsize: Work queued before more is dropped
+        """
+        if name in self._stages:
+            raise PipelineError('stage "%s" already added' % (name))
+        if self._started:
+            raise PipelineError('stage "%s" added after start()' % (name))
+        self._stages[name] = _Stage(name, handler, fix, maxsize)
+        self._log.info('stage added: %s', name)
+
+    def start(self):
+        """ start()
+
+        One (daemon) thread per stage
+        """
+        for stage in self._stages.values():
+            stage.thread = threading.Thread(target=self._run, args=(stage,), name='stage-' + stage.name, daemon=True)
+            stage.thread.start()
+        self._started = True
+
+    def stop(self, timeout=DEFAULT_STOP_TIMEOUT):
+        """ stop()
+
+        :param timeout: Seconds (in total) to finish what's already queued
+
+        Called on exit (before the recorders are closed); anything not done by then is lost
+        """
+        if not self._started:
+            return
+        self._started = False
+        deadline = time.monotonic() + timeout
+        for stage in self._stages.values():
+            try:
+                stage.queue.put(None, timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Full:
+                continue
+        for stage in self._stages.values():
+            stage.thread.join(max(0.0, deadline - time.monotonic()))
+            if stage.thread.is_alive():
+                self._log.warning('stage %s: did not finish (%d queued)', stage.name, stage.queue.qsize())
+
+    def publish(self, reception, sample, votes=1, candidates=1):
+        """ publish()
+
+        :param reception: Reception instance (full reception)
+        :param sample: NTPSample for this reception
+        :param votes: Receivers that agreed with this sample
+        :param candidates: Receivers that had a fix for this minute
+        :return: Number of stages the fix was queued for
+        """
+        count = 0
+        for stage in self._stages.values():
+            if stage.fix and self._queue(stage, (reception, sample, votes, candidates)):
+                count += 1
+        return count
+
+    def submit(self, name, *args):
+        """ submit()
+
+        :param name: Stage name
+        :param args: Passed to the stage's handler
+        :return: True if queued (False if there's no such stage or it's full)
+        """
+        stage = self._stages.get(name)
+        if stage is None:
+            return False
+        return self._queue(stage, args)
+
+    def stats(self):
+        """ stats()
+
+        :return: list of StageStats (one per stage, in the order added)
+        """
+        return [stage.stats for stage in self._stages.values()]
+
+    def report(self):
+        """ report()
+
+        Log the per-stage counters and handler time
+        """
+        for stage in self._stages.values():
+            self._log.info('%s', stage.stats)
+
+    def _queue(self, stage, args):
+        """ _queue """
+        try:
+            stage.queue.put_nowait(args)
+        except queue.Full:
+            # never wait for a stage; the reception loop is more important
+            stage.stats.dropped += 1
+            self._log.warning('stage %s: queue full; dropped (%d so far)', stage.name, stage.stats.dropped)
+            return False
+        return True
+
+    def _run(self, stage):
+        """ _run """
+        stats = stage.stats
+        while True:
+            args = stage.queue.get()
+            if args is None:
+                return
+            start_ns = time.perf_counter_ns()
+            try:
+                stage.handler(*args)
+            except Exception as err:            # pylint: disable=broad-except
+                # same rule as the sinks; a failing stage must not take the others (or itself) down
+                stats.errors += 1
+                stats.last_error = err
+                self._log.warning('stage %s: failed: %s', stage.name, err)
+            stats.last_ns = time.perf_counter_ns() - start_ns
+            stats.handled += 1
+            stats.total_ns += stats.last_ns
+            stats.max_ns = max(stats.max_ns, stats.last_ns)
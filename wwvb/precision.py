@@ -0,0 +1,119 @@
+""" precision.py
+
+Estimate the precision to advertise to ntpd from measured offset jitter
+
+Copyright (C) 2023 Martin J Levy - W6LHI/G8LHI - @mahtin - https://github.com/mahtin
+"""
+
+import math
+import logging
+from collections import deque
+
+from .ntpdriver28 import NTPD_PRECISION
+
+DEFAULT_PRECISION = -5          # 31.25 milliseconds - what we always used to advertise
+DEFAULT_WINDOW = 16             # offsets remembered per key
+MINIMUM_SAMPLES = 4             # below this we stick with the default
+HYSTERESIS = 0.5                # in log2 units; stops precision flapping between two values
+
+class PrecisionEstimator:
+    """ PrecisionEstimator()
+
+    :param window: Number of offsets kept (per key)
+    :param default: Precision used until there's enough data
+    :param debug: True to enable debug messages
+    :param verbose: True to enable verbose messages
+    :return: New instance of PrecisionEstimator()
+
+    Jitter is kept separately for each key; where a key is (mode, antenna).
+    i.e. ('reception', 'Antenna1') vs ('tracking', 'Antenna2').
+    Every IRQ is timestamped the same way (time_ns() in userspace); hence that's not part of the key.
+    Jitter is the RMS of successive offset differences (as ntpd computes it); hence a constant
+    offset (like an unknown system clock error) cancels out.
+    A key without enough offsets of its own can borrow another's precision; i.e. the first full
+    receptions after a day of tracking are published with the tracking precision.
+    """
+
+    def __init__(self, window=DEFAULT_WINDOW, default=DEFAULT_PRECISION, debug=False, verbose=False):
+        """ :meta private: """
+        self._window = window
+        self._default = default
+        self._minimum = min(NTPD_PRECISION)
+        self._maximum = max(NTPD_PRECISION)
+        self._offsets = {}
+        self._precision = {}
+
+        self._log = logging.getLogger(__class__.__name__)
+        self._debug = debug
+        if self._debug:
+            self._log.setLevel(logging.DEBUG)
+        self._verbose = verbose
+        if self._verbose:
+            self._log.setLevel(logging.INFO)
+
+    def add(self, key, offset):
+        """ add()
+
+        :param key: (mode, antenna) tuple
+        :param offset: Offset in seconds (WWVB time minus system time)
+        """
+        if key not in self._offsets:
+            self._offsets[key] = deque(maxlen=self._window)
+        self._offsets[key].append(offset)
+        self._update(key)
+
+    def jitter(self, key):
+        """ jitter()
+
+        :param key: (mode, antenna) tuple
+        :return: jitter in seconds or None if not enough offsets yet
+        """
+        offsets = self._offsets.get(key)
+        if offsets is None or len(offsets) < MINIMUM_SAMPLES:
+            return None
+        previous = None
+        total = 0.0
+        for offset in offsets:
+            if previous is not None:
+                total += (offset - previous) ** 2
+            previous = offset
+        return math.sqrt(total / (len(offsets) - 1))
+
+    def precision(self, key, fallback=None):
+        """ precision()
+
+        :param key: (mode, antenna) tuple
+        :param fallback: Key used until key has enough offsets of its own (or None)
+        :return: log2 precision (see NTPD_PRECISION) for this key
+        """
+        if fallback is not None and len(self._offsets.get(key, ())) < MINIMUM_SAMPLES:
+            key = fallback
+        return self._precision.get(key, self._default)
+
+    def _update(self, key):
+        """ _update """
+        jitter = self.jitter(key)
+        if jitter is None:
+            return
+
+        current = self.precision(key)
+        # a precision of p means the jitter is at or below 2^p seconds
+        log2_jitter = math.log2(max(jitter, pow(2, self._minimum - 1)))
+        if log2_jitter > current + HYSTERESIS:
+            # worse
+            new = math.ceil(log2_jitter)
+        elif log2_jitter < current - 1 - HYSTERESIS:
+            # better
+            new = math.ceil(log2_jitter)
+        else:
+            return
+        new = min(max(new, self._minimum), self._maximum)
+        if new != current:
+            self._precision[key] = new
+            self._log.info('%s: jitter %.6f seconds; precision %d -> %d (%s seconds)',
+                                key,
+                                jitter,
+                                current,
+                                new,
+                                NTPD_PRECISION[new],
+                            )
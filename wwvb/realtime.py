@@ -0,0 +1,412 @@
+""" realtime.py
+
+An opt-in real-time profile for the thread(s) that wait on the ES100 IRQ; plus a wake-up latency probe
+
+Copyright (C) 2023 Martin J Levy - W6LHI/G8LHI - @mahtin - https://github.com/mahtin
+
+The system time taken after the IRQ is only as good as how quickly our thread gets the CPU back.
+On a busy host that's milliseconds and varies with load. The profile (Linux only) applies:
+
+    SCHED_FIFO      each receiver thread runs ahead of every normal (SCHED_OTHER) process
+    affinity        each receiver thread is pinned to the given CPU(s); i.e. one kept free with isolcpus=
+    mlockall()      current and future pages are locked in memory; no page faults (or swap) on the way back
+    prefault        the malloc heap is grown (and touched) once and is never given back
+
+Each is tried on its own; whatever can't be applied (no CAP_SYS_NICE, RLIMIT_MEMLOCK too small, not Linux)
+is logged and reported by status(). Nothing fails because of it.
+
+The GPIO libraries don't timestamp the IRQ edge; hence the latency after it can't be seen directly.
+The WakeupProbe thread measures the same thing the way cyclictest does: it sleeps until an absolute
+time (with the same profile, one priority below the receivers) and records how late it woke up.
+The histogram shows what the profile buys (run with and without it) and when it stops working.
+
+SCHED_FIFO only gets a thread the CPU; in Python it still needs the GIL. Without --processes the receiver
+thread(s) share the GIL with publishing, metrics, recording and so on; a woken receiver waits for whichever
+thread holds it to give it up (up to sys.getswitchinterval(), 5ms by default, or longer in C code that doesn't
+release it). shared_gil() logs that and lowers the switch interval; it narrows the wait, it doesn't remove it.
+Only with --processes (the profile applied in the hardware process) is the GIL the receivers' alone.
+"""
+
+import os
+import sys
+import time
+import logging
+import threading
+
+try:
+    import ctypes
+    import ctypes.util
+except ImportError:
+    ctypes = None
+
+from .config import config_list
+
+DEFAULT_PRIORITY = 40               # SCHED_FIFO priority (1-99); below the kernel's irq threads (50)
+DEFAULT_PREFAULT = 8                # megabytes
+DEFAULT_PROBE_INTERVAL = 0.1        # seconds between wake-up latency samples
+PROBE_CHECK = 100                   # probe samples between checks that the profile is still applied
+REPORT_INTERVAL = 3600.0            # seconds between wake-up latency summaries in the log
+GIL_SWITCH_INTERVAL = 0.0005        # seconds; sys.setswitchinterval() when the receivers share the GIL
+
+# sys/mman.h
+MCL_CURRENT = 1
+MCL_FUTURE = 2
+# malloc.h
+M_TRIM_THRESHOLD = -1
+M_MMAP_MAX = -4
+
+# seconds
+WAKEUP_BUCKETS = [0.00001, 0.00002, 0.00005, 0.0001, 0.0002, 0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05]
+
+class RealtimeError(Exception):
+    """ raise this any realtime error """
+
+def parse_cpus(value):
+    """ parse_cpus()
+
+    :param value: CPU list; i.e. "3" or "2,3" or "2-3"
+    :return: set of CPU numbers
+    :raises RealtimeError: If the list can't be parsed
+    """
+    cpus = set()
+    try:
+        for item in config_list(value):
+            if '-' in str(item):
+                (first, last) = str(item).split('-', 1)
+                cpus.update(range(int(first), int(last) + 1))
+            else:
+                cpus.add(int(item))
+    except ValueError as err:
+        raise RealtimeError('invalid cpu list: %s' % (value)) from err
+    if len(cpus) == 0:
+        raise RealtimeError('empty cpu list: %s' % (value))
+    return cpus
+
+class WakeupHistogram:
+    """ WakeupHistogram()
+
+    :param buckets: Upper bounds in seconds (sorted); +Inf is added
+    :return: New instance of WakeupHistogram()
+
+    Counts are kept non-cumulative (like metrics.Histogram); one writer (the probe thread)
+    """
+
+    def __init__(self, buckets=None):
+        """ :meta private: """
+        self.buckets = list(buckets or WAKEUP_BUCKETS) + [float('inf')]
+        self._counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def __str__(self):
+        """ __str__ """
+        if self.count == 0:
+            return 'wake-up latency: no samples'
+        return 'wake-up latency: n=%d mean=%.1fus p50<=%s p99<=%s max=%.1fus' % (
+                    self.count,
+                    self.sum / self.count * 1000000.0,
+                    self._bound(self.percentile(0.50)),
+                    self._bound(self.percentile(0.99)),
+                    self.max * 1000000.0,
+                )
+
+    @staticmethod
+    def _bound(value):
+        """ _bound """
+        if value == float('inf'):
+            return '+Inf'
+        return '%.0fus' % (value * 1000000.0)
+
+    def observe(self, value):
+        """ observe()
+
+        :param value: Seconds late
+        """
+        for n, bound in enumerate(self.buckets):
+            if value <= bound:
+                self._counts[n] += 1
+                break
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def counts(self):
+        """ counts()
+
+        :return: Copy of the bucket counts followed by the sum (the metrics.Histogram layout)
+        """
+        return list(self._counts) + [self.sum]
+
+    def percentile(self, fraction):
+        """ percentile()
+
+        :param fraction: 0.0 - 1.0
+        :return: Upper bound of the bucket the percentile falls in (None with no samples)
+        """
+        if self.count == 0:
+            return None
+        wanted = fraction * self.count
+        total = 0
+        for bound, count in zip(self.buckets, self._counts):
+            total += count
+            if total >= wanted:
+                return bound
+        return self.buckets[-1]
+
+class RealtimeProfile:
+    """ RealtimeProfile()
+
+    :param priority: SCHED_FIFO priority (1-99)
+    :param cpus: set of CPU numbers for the receiver thread(s) (None leaves affinity alone)
+    :param lock_memory: True to mlockall()
+    :param prefault: Megabytes of malloc heap to prefault (0 for none)
+    :param debug: True to enable debug messages
+    :param verbose: True to enable verbose messages
+    :return: New instance of RealtimeProfile()
+
+    apply_process() once (in the process that talks to the ES100s) then apply_thread() from each receiver thread.
+    Only plain values are kept until then; hence it can be handed to the hardware process.
+    """
+
+    def __init__(self, priority=DEFAULT_PRIORITY, cpus=None, lock_memory=True, prefault=DEFAULT_PREFAULT, debug=False, verbose=False):
+        """ :meta private: """
+        if not 1 <= priority <= 99:
+            raise RealtimeError('priority must be 1-99: %d' % (priority))
+        if prefault < 0:
+            raise RealtimeError('prefault must not be negative: %d' % (prefault))
+        self._priority = priority
+        self._cpus = set(cpus) if cpus else None
+        self._lock_memory = lock_memory
+        self._prefault = prefault
+        self._debug = debug
+        self._verbose = verbose
+        self._status = {}
+        self._probe = None
+        self._log = None
+
+    def __str__(self):
+        """ __str__ """
+        return '[realtime SCHED_FIFO:%d cpus=%s mlockall=%s prefault=%dMB]' % (
+                    self._priority,
+                    ','.join([str(cpu) for cpu in sorted(self._cpus)]) if self._cpus else 'any',
+                    self._lock_memory,
+                    self._prefault,
+                )
+
+    def _logger(self):
+        """ _logger """
+        if self._log is None:
+            self._log = logging.getLogger(__class__.__name__)
+            if self._debug:
+                self._log.setLevel(logging.DEBUG)
+            if self._verbose:
+                self._log.setLevel(logging.INFO)
+        return self._log
+
+    def __getstate__(self):
+        """ __getstate__ - only the settings cross to another process """
+        state = dict(self.__dict__)
+        state['_status'] = {}
+        state['_probe'] = None
+        state['_log'] = None
+        return state
+
+    def priority(self):
+        """ priority()
+
+        :return: SCHED_FIFO priority of the receiver thread(s)
+        """
+        return self._priority
+
+    def status(self):
+        """ status()
+
+        :return: dict of setting name to True (applied) or an error string
+        """
+        return dict(self._status)
+
+    def histogram(self):
+        """ histogram()
+
+        :return: WakeupHistogram (None if the probe isn't running)
+        """
+        return self._probe.histogram if self._probe else None
+
+    def _result(self, name, err=None):
+        """ _result """
+        log = self._logger()
+        if err is None:
+            self._status[name] = True
+            log.info('realtime: %s applied', name)
+            return True
+        self._status[name] = str(err)
+        log.warning('realtime: %s not applied: %s', name, err)
+        return False
+
+    def _libc(self):
+        """ _libc """
+        if ctypes is None:
+            raise RealtimeError('no ctypes')
+        try:
+            return ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        except OSError as err:
+            raise RealtimeError('no libc: %s' % (err)) from err
+
+    def apply_process(self):
+        """ apply_process()
+
+        mlockall() and heap prefault; once per process
+        :return: True if everything asked for was applied
+        """
+        ok = True
+        if self._lock_memory:
+            try:
+                libc = self._libc()
+                if libc.mlockall(MCL_CURRENT | MCL_FUTURE) != 0:
+                    errno = ctypes.get_errno()
+                    raise RealtimeError('mlockall: %s' % (os.strerror(errno)))
+                ok &= self._result('mlockall')
+            except (RealtimeError, AttributeError) as err:
+                ok &= self._result('mlockall', err)
+        if self._prefault > 0:
+            try:
+                self._prefault_heap(self._prefault * 1024 * 1024)
+                ok &= self._result('prefault')
+            except (RealtimeError, MemoryError, AttributeError) as err:
+                ok &= self._result('prefault', err)
+        return ok
+
+    def _prefault_heap(self, size):
+        """ _prefault_heap """
+        libc = self._libc()
+        # glibc only; keep big allocations on the heap and never trim it; hence what's touched now stays mapped
+        if libc.mallopt(M_MMAP_MAX, 0) != 1 or libc.mallopt(M_TRIM_THRESHOLD, -1) != 1:
+            raise RealtimeError('mallopt failed')
+        buffer = bytearray(size)
+        page = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+        # calloc()'ed pages may be untouched; write one byte per page
+        for offset in range(0, size, page):
+            buffer[offset] = 1
+        del buffer
+
+    def apply_thread(self, name=None, priority=None):
+        """ apply_thread()
+
+        :param name: Thread name (for messages)
+        :param priority: SCHED_FIFO priority (default is the profile's)
+        :return: True if everything asked for was applied
+
+        SCHED_FIFO and affinity for the calling thread (Linux applies both per thread)
+        """
+        ok = True
+        name = name or threading.current_thread().name
+        if self._cpus:
+            try:
+                os.sched_setaffinity(0, self._cpus)
+                ok &= self._result('affinity.' + name)
+            except (OSError, AttributeError, ValueError) as err:
+                ok &= self._result('affinity.' + name, err)
+        try:
+            os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(priority or self._priority))
+            ok &= self._result('fifo.' + name)
+        except (OSError, AttributeError) as err:
+            ok &= self._result('fifo.' + name, err)
+        return ok
+
+    def shared_gil(self, interval=GIL_SWITCH_INTERVAL):
+        """ shared_gil()
+
+        :param interval: Seconds for sys.setswitchinterval() (only ever lowered)
+
+        The receiver thread(s) share this process (and its GIL) with everything else; see above
+        """
+        log = self._logger()
+        log.warning('realtime: receivers share the GIL with every other thread; use --processes for the full profile')
+        if sys.getswitchinterval() > interval:
+            sys.setswitchinterval(interval)
+            log.info('realtime: GIL switch interval lowered to %.6fs', interval)
+
+    def start(self, interval=DEFAULT_PROBE_INTERVAL):
+        """ start()
+
+        :param interval: Seconds between wake-up latency samples
+
+        apply_process() and start the wake-up latency probe; call before the receiver threads start
+        """
+        self.apply_process()
+        self._probe = WakeupProbe(self, interval)
+        self._probe.start()
+
+    def report(self):
+        """ report()
+
+        Log the wake-up latency and anything not applied
+        """
+        log = self._logger()
+        if self._probe:
+            log.info('%s %s', self, self._probe.histogram)
+        for name, result in sorted(self._status.items()):
+            if result is not True:
+                log.warning('realtime: %s not applied: %s', name, result)
+
+class WakeupProbe:
+    """ WakeupProbe()
+
+    :param profile: RealtimeProfile (None to measure without one)
+    :param interval: Seconds between samples
+    :return: New instance of WakeupProbe()
+
+    A (daemon) thread that sleeps to an absolute monotonic time and records how late it woke
+    """
+
+    def __init__(self, profile=None, interval=DEFAULT_PROBE_INTERVAL):
+        """ :meta private: """
+        self._profile = profile
+        self._interval_ns = int(interval * 1000000000)
+        self._thread = None
+        self._stop = threading.Event()
+        self.histogram = WakeupHistogram()
+        # True once the probe found itself not running SCHED_FIFO (after the profile said it was)
+        self.degraded = False
+
+        self._log = logging.getLogger(__class__.__name__)
+
+    def start(self):
+        """ start() """
+        self._thread = threading.Thread(target=self._run, name='wakeup-probe', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """ stop() """
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+
+    def _run(self):
+        """ _run """
+        fifo = False
+        if self._profile:
+            # one below the receivers; it must never be what delays them
+            fifo = self._profile.apply_thread('wakeup-probe', max(1, self._profile.priority() - 1))
+        histogram = self.histogram
+        next_report = time.monotonic() + REPORT_INTERVAL
+        samples = 0
+        target_ns = time.monotonic_ns() + self._interval_ns
+        while not self._stop.is_set():
+            remaining_ns = target_ns - time.monotonic_ns()
+            if remaining_ns > 0:
+                time.sleep(remaining_ns / 1000000000.0)
+            histogram.observe(max(0, time.monotonic_ns() - target_ns) / 1000000000.0)
+            target_ns += self._interval_ns
+            if target_ns < time.monotonic_ns():
+                # fell behind (i.e. suspended); don't count a burst of catch up samples
+                target_ns = time.monotonic_ns() + self._interval_ns
+            samples += 1
+            if fifo and samples % PROBE_CHECK == 0 and not self.degraded:
+                if os.sched_getscheduler(0) != os.SCHED_FIFO:
+                    self.degraded = True
+                    self._log.warning('realtime: SCHED_FIFO was removed from this thread; the profile no longer applies')
+            if time.monotonic() >= next_report:
+                next_report += REPORT_INTERVAL
+                self._log.info('%s', histogram)
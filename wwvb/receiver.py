@@ -0,0 +1,196 @@
+""" receiver.py
+
+One ES100 per thread; each reception is handed to the main loop via a queue
+
+Copyright (C) 2023 Martin J Levy - W6LHI/G8LHI - @mahtin - https://github.com/mahtin
+"""
+
+import time
+import logging
+import threading
+from datetime import timedelta
+
+from es100 import ES100Error
+
+from .misc import is_it_nighttime
+from .deadline import DeadlineGuard
+
+class Reception:
+    """ Reception()
+
+    :param receiver: Receiver name
+    :param attempt: dict from ES100.attempt() (or None if no new attempt was started)
+    :param received_dt: The received date and time (or None for an unsuccessful attempt)
+    :return: New instance of Reception()
+
+    Everything the main loop needs; copied out of ES100 before the next attempt starts
+    """
+
+    __slots__ = ('receiver', 'attempt', 'received_dt', 'wwvb_time', 'system_time', 'system_time_ns', 'rx_antenna', 'delta_seconds', 'leap_second', 'start_late_ns')
+
+    def __init__(self, receiver, attempt, received_dt):
+        """ :meta private: """
+        self.receiver = receiver
+        self.attempt = attempt
+        self.received_dt = received_dt
+        self.wwvb_time = None
+        self.system_time = None
+        self.system_time_ns = None
+        self.rx_antenna = None
+        self.delta_seconds = None
+        self.leap_second = None
+        # how late this attempt's tracking START was (negative is slack); None if it had no deadline
+        self.start_late_ns = None
+
+    def __str__(self):
+        """ __str__ """
+        return '[%s %s at %s via %s]' % (self.receiver, self.received_dt, self.system_time, self.rx_antenna)
+
+    def tracking(self):
+        """ tracking() - True if this is a tracking result (only the second is valid) """
+        received_dt = self.received_dt
+        return received_dt.year == 1 and received_dt.month == 1 and received_dt.day == 1
+
+    def restate(self, step_ns):
+        """ restate()
+
+        :param step_ns: Nanoseconds the system clock was stepped since the IRQ
+
+        The system time (and delta) of the IRQ on the clock as it is now
+        """
+        self.system_time_ns += step_ns
+        self.system_time += timedelta(milliseconds=step_ns // 1000000)
+        if self.delta_seconds is not None:
+            self.delta_seconds -= step_ns / 1000000000.0
+
+class Receiver:
+    """ Receiver()
+
+    :param name: Receiver name (from wwvb.ini)
+    :param es100: ES100 instance
+    :param results: queue.Queue() each Reception is put on
+    :param flag_force_tracking: Run in tracking mode all the time
+    :param flag_enable_nighttime: Swap between daytime tracking and nighttime reception
+    :param our_location: [lat, lon] of the receiver
+    :param our_masl: Receivers MASL (Meters Above Sea Level)
+    :param realtime: RealtimeProfile applied to the receiver thread (or None)
+    :param debug: True to enable debug messages
+    :param verbose: True to enable verbose messages
+    :return: New instance of Receiver()
+
+    The thread only talks to its own ES100; all publishing is done by whoever reads the queue.
+    """
+
+    def __init__(self, name, es100, results, flag_force_tracking=False, flag_enable_nighttime=False, our_location=None, our_masl=0, realtime=None, debug=False, verbose=False):
+        """ :meta private: """
+        self.name = name
+        self.es100 = es100
+        self._results = results
+        self._flag_force_tracking = flag_force_tracking
+        self._flag_enable_nighttime = flag_enable_nighttime
+        self._our_location = our_location
+        self._our_masl = our_masl
+        self._realtime = realtime
+        self._previous_nighttime = None
+        self._last_attempt = None
+        self._start_late_ns = None
+        self._thread = None
+
+        self._log = logging.getLogger('%s.%s' % (__class__.__name__, name))
+        self._debug = debug
+        if self._debug:
+            self._log.setLevel(logging.DEBUG)
+        self._verbose = verbose
+        if self._verbose:
+            self._log.setLevel(logging.INFO)
+
+        self.deadline = DeadlineGuard(name, debug=debug, verbose=verbose)
+
+    def __str__(self):
+        """ __str__ """
+        return '[%s %s]' % (self.name, self.es100)
+
+    def start(self):
+        """ start()
+
+        Receive forever in a (daemon) thread
+        """
+        self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        """ _run """
+        if self._realtime:
+            self._realtime.apply_thread(self.name)
+        while True:
+            self._results.put(self.receive_once())
+
+    def receive_once(self):
+        """ receive_once()
+
+        :return: Reception instance
+        """
+        es100 = self.es100
+        self._start_late_ns = None
+        received_dt = self.receive()
+
+        # successful or not; every attempt is counted (unless receive() failed before it started one)
+        attempt = es100.attempt()
+        if attempt is self._last_attempt:
+            attempt = None
+        else:
+            self._last_attempt = attempt
+            attempt = dict(attempt, receiver=self.name)
+        self.deadline.done(attempt)
+
+        reception = Reception(self.name, attempt, received_dt)
+        reception.start_late_ns = self._start_late_ns
+        if received_dt:
+            reception.wwvb_time = es100.wwvb_time()
+            reception.system_time = es100.system_time()
+            reception.system_time_ns = es100.system_time_ns()
+            reception.rx_antenna = es100.rx_antenna()
+            reception.delta_seconds = es100.delta_seconds()
+            reception.leap_second = es100.leap_second()
+        return reception
+
+    def receive(self):
+        """ receive()
+
+        :return: The received date and time as datetime.datetime
+
+        Setup everything to receive the date and time.
+        """
+
+        log = self._log
+
+        if self._flag_force_tracking:
+            # Always do tracking (ignore nighttime flag)
+            new_tracking_flag = True
+            log.info('Reception starting (tracking forced on)')
+        else:
+            if self._flag_enable_nighttime:
+                if is_it_nighttime(self._our_location[0], self._our_location[1], self._our_masl):
+                    # nighttime
+                    new_tracking_flag = False
+                    if self._previous_nighttime is not True:
+                        log.info('Nighttime in-progress (Reception starting)')
+                    self._previous_nighttime = True
+                else:
+                    # daytime
+                    new_tracking_flag = True
+                    if self._previous_nighttime is not False:
+                        log.info('Daytime in-progress (Tracking starting)')
+                    self._previous_nighttime = False
+            else:
+                # Don't care about nighttime/daytime; always receive
+                new_tracking_flag = False
+                log.info('Reception starting')
+
+        self._start_late_ns = self.deadline.rearm(time.time_ns(), new_tracking_flag)
+        try:
+            received_dt = self.es100.time(tracking=new_tracking_flag)
+        except (ES100Error, OSError):
+            return None
+
+        return received_dt
@@ -0,0 +1,360 @@
+""" report.py
+
+"wwvb report" - antenna vs time-of-day reception heatmaps from the journal or history
+
+Copyright (C) 2023 Martin J Levy - W6LHI/G8LHI - @mahtin - https://github.com/mahtin
+
+numpy is optional (but a year of per-minute tracking is slow without it).
+matplotlib is optional and only needed for --png.
+"""
+
+import sys
+import time
+import getopt
+from datetime import datetime, timezone
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from .config import readconfig
+from .journal import read_journal
+from .historydb import HistoryDBError, open_db, query_params
+from .stats import parse_when
+
+ANTENNAS = [1, 2]
+
+QUERY_ATTEMPTS = ' '.join([
+    'SELECT start_ns, antenna, outcome FROM attempts',
+    'WHERE start_ns >= :since AND start_ns < :until',
+    'AND (:mode IS NULL OR mode = :mode)',
+])
+
+class Bins:
+    """ Bins()
+
+    :param first_day: Day number (days since the epoch) of row 0
+    :param attempts: {antenna: days x 24 counts}
+    :param fixes: {antenna: days x 24 counts}
+    :return: New instance of Bins()
+
+    Attempts and successful fixes binned by day, hour and antenna
+    """
+
+    def __init__(self, first_day, attempts, fixes):
+        """ :meta private: """
+        self.first_day = first_day
+        self.attempts = attempts
+        self.fixes = fixes
+
+    def days(self):
+        """ days() - number of day rows """
+        for antenna in ANTENNAS:
+            return len(self.attempts[antenna])
+        return 0
+
+    def day(self, n):
+        """ day() - date of day row n """
+        return datetime.fromtimestamp((self.first_day + n) * 86400, tz=timezone.utc).date()
+
+    def by_hour(self, antenna):
+        """ by_hour() - (attempts, fixes) lists of 24 summed over every day """
+        if np is not None and isinstance(self.attempts[antenna], np.ndarray):
+            return (
+                [int(v) for v in self.attempts[antenna].sum(axis=0)],
+                [int(v) for v in self.fixes[antenna].sum(axis=0)]
+            )
+        attempts = [0] * 24
+        fixes = [0] * 24
+        for row_attempts, row_fixes in zip(self.attempts[antenna], self.fixes[antenna]):
+            for hour in range(24):
+                attempts[hour] += int(row_attempts[hour])
+                fixes[hour] += int(row_fixes[hour])
+        return (attempts, fixes)
+
+def load_history(db_path, since_ns=None, until_ns=None, mode=None):
+    """ load_history()
+
+    :return: (start_ns, antenna, ok) lists
+    """
+    connection = open_db(db_path, readonly=True)
+    params = query_params(since_ns, until_ns, mode)
+    rows = connection.execute(QUERY_ATTEMPTS, params).fetchall()
+    connection.close()
+    return _columns(rows)
+
+def load_journal(filenames, since_ns=None, until_ns=None, mode=None):
+    """ load_journal()
+
+    :return: (start_ns, antenna, ok) lists
+    """
+    since_ns = since_ns if since_ns is not None else 0
+    until_ns = until_ns if until_ns is not None else time.time_ns() + 1
+    rows = []
+    for filename in filenames:
+        for entry in read_journal(filename):
+            if entry['start_ns'] is None or not since_ns <= entry['start_ns'] < until_ns:
+                continue
+            if mode and entry['mode'] != mode:
+                continue
+            rows.append((entry['start_ns'], entry['antenna'], entry['outcome']))
+    return _columns(rows)
+
+def _columns(rows):
+    """ _columns """
+    start_ns = []
+    antenna = []
+    ok = []
+    for (row_start_ns, row_antenna, row_outcome) in rows:
+        if row_start_ns is None or not row_antenna:
+            continue
+        start_ns.append(row_start_ns)
+        antenna.append(2 if row_antenna.endswith('2') else 1)
+        ok.append(row_outcome == 'RX_OK')
+    return (start_ns, antenna, ok)
+
+def _utc_offset(hour_number):
+    """ _utc_offset - local time offset in seconds at this hour (hours since the epoch) """
+    return time.localtime(hour_number * 3600).tm_gmtoff
+
+def bin_attempts(start_ns, antenna, ok, use_localtime=True):
+    """ bin_attempts()
+
+    :param start_ns: list of attempt start times (nanoseconds since the epoch)
+    :param antenna: list of antenna numbers (1 or 2)
+    :param ok: list of True/False (RX_OK)
+    :param use_localtime: bin by local (vs UTC) day and hour
+    :return: Bins instance
+    """
+    if np is not None:
+        return _bin_numpy(start_ns, antenna, ok, use_localtime)
+    return _bin_python(start_ns, antenna, ok, use_localtime)
+
+def _bin_numpy(start_ns, antenna, ok, use_localtime):
+    """ _bin_numpy """
+    seconds = np.asarray(start_ns, dtype=np.int64) // 1000000000
+    antenna = np.asarray(antenna, dtype=np.int8)
+    ok = np.asarray(ok, dtype=np.float64)
+    if len(seconds) == 0:
+        return Bins(0, {a: np.zeros((0, 24), dtype=np.int64) for a in ANTENNAS}, {a: np.zeros((0, 24)) for a in ANTENNAS})
+
+    if use_localtime:
+        # the UTC offset only changes on the hour; so look it up once per distinct hour (~9000 a year)
+        hours, inverse = np.unique(seconds // 3600, return_inverse=True)
+        offsets = np.array([_utc_offset(int(hour)) for hour in hours], dtype=np.int64)
+        seconds = seconds + offsets[inverse]
+
+    day = seconds // 86400
+    hour = (seconds % 86400) // 3600
+    first_day = int(day.min())
+    n_days = int(day.max()) - first_day + 1
+    cell = (day - first_day) * 24 + hour
+
+    attempts = {}
+    fixes = {}
+    for a in ANTENNAS:
+        mask = antenna == a
+        attempts[a] = np.bincount(cell[mask], minlength=n_days * 24).reshape(n_days, 24)
+        fixes[a] = np.bincount(cell[mask], weights=ok[mask], minlength=n_days * 24).reshape(n_days, 24)
+    return Bins(first_day, attempts, fixes)
+
+def _bin_python(start_ns, antenna, ok, use_localtime):
+    """ _bin_python """
+    offsets = {}
+    cells = []
+    for row_start_ns, row_antenna, row_ok in zip(start_ns, antenna, ok):
+        seconds = row_start_ns // 1000000000
+        if use_localtime:
+            hour_number = seconds // 3600
+            if hour_number not in offsets:
+                offsets[hour_number] = _utc_offset(hour_number)
+            seconds += offsets[hour_number]
+        cells.append((seconds // 86400, (seconds % 86400) // 3600, row_antenna, row_ok))
+    if len(cells) == 0:
+        return Bins(0, {a: [] for a in ANTENNAS}, {a: [] for a in ANTENNAS})
+
+    first_day = min([c[0] for c in cells])
+    n_days = max([c[0] for c in cells]) - first_day + 1
+    attempts = {a: [[0] * 24 for _ in range(n_days)] for a in ANTENNAS}
+    fixes = {a: [[0] * 24 for _ in range(n_days)] for a in ANTENNAS}
+    for (day, hour, row_antenna, row_ok) in cells:
+        attempts[row_antenna][day - first_day][hour] += 1
+        if row_ok:
+            fixes[row_antenna][day - first_day][hour] += 1
+    return Bins(first_day, attempts, fixes)
+
+def write_csv(bins, filename):
+    """ write_csv()
+
+    One row per antenna, day and hour (empty cells skipped)
+    """
+    with open(filename, 'w', encoding='utf-8') as fd:
+        fd.write('antenna,day,hour,attempts,fixes,rate\n')
+        for a in ANTENNAS:
+            for n in range(bins.days()):
+                day = bins.day(n).isoformat()
+                for hour in range(24):
+                    attempts = int(bins.attempts[a][n][hour])
+                    if attempts == 0:
+                        continue
+                    fixes = int(bins.fixes[a][n][hour])
+                    fd.write('Antenna%d,%s,%02d,%d,%d,%.3f\n' % (a, day, hour, attempts, fixes, fixes / attempts))
+
+def write_png(bins, prefix, use_localtime=True):
+    """ write_png()
+
+    One heatmap (day vs hour; colour is success rate) per antenna; i.e. prefix-Antenna1.png
+    """
+    # only needed here; and only if asked for
+    import matplotlib                               # pylint: disable=import-outside-toplevel
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt                 # pylint: disable=import-outside-toplevel
+
+    filenames = []
+    for a in ANTENNAS:
+        attempts = np.asarray(bins.attempts[a], dtype=np.float64)
+        fixes = np.asarray(bins.fixes[a], dtype=np.float64)
+        rate = np.full(attempts.shape, np.nan)
+        np.divide(fixes, attempts, out=rate, where=attempts > 0)
+
+        fig, ax = plt.subplots(figsize=(10, max(3, bins.days() / 12.0)))
+        image = ax.imshow(rate, aspect='auto', cmap='viridis', vmin=0.0, vmax=1.0, interpolation='nearest',
+                            extent=(0, 24, bins.days(), 0))
+        ax.set_title('WWVB reception success - Antenna%d' % (a))
+        ax.set_xlabel('hour (%s)' % ('local time' if use_localtime else 'UTC'))
+        ax.set_xticks(range(0, 25, 3))
+        ax.set_ylabel('day (from %s)' % (bins.day(0).isoformat()))
+        fig.colorbar(image, ax=ax, label='success rate')
+        filename = '%s-Antenna%d.png' % (prefix, a)
+        fig.savefig(filename, dpi=100, bbox_inches='tight')
+        plt.close(fig)
+        filenames.append(filename)
+    return filenames
+
+def print_summary(bins, use_localtime=True):
+    """ print_summary() """
+    by_hour = {a: bins.by_hour(a) for a in ANTENNAS}
+    print('Success rate by %s hour and antenna over %d days' % ('local' if use_localtime else 'UTC', bins.days()))
+    print('    hour   Antenna1 (fixes/attempts)   Antenna2 (fixes/attempts)   best')
+    totals = {a: [0, 0] for a in ANTENNAS}
+    for hour in range(24):
+        line = '    %02d' % (hour)
+        rates = {}
+        for a in ANTENNAS:
+            attempts = by_hour[a][0][hour]
+            fixes = by_hour[a][1][hour]
+            totals[a][0] += attempts
+            totals[a][1] += fixes
+            rates[a] = fixes / attempts if attempts else None
+            line += '     %6s (%6d/%6d)' % ('%5.1f%%' % (100.0 * rates[a]) if attempts else '-', fixes, attempts)
+        best = [a for a in ANTENNAS if rates[a] is not None]
+        best = 'Antenna%d' % (max(best, key=rates.get)) if best else '-'
+        print(line + '   ' + best)
+    for a in ANTENNAS:
+        (attempts, fixes) = totals[a]
+        print('    Antenna%d: %d attempts, %d fixes, %s' % (a, attempts, fixes, '%.1f%%' % (100.0 * fixes / attempts) if attempts else '-'))
+
+def report(program_name, args):
+    """ report()
+
+    :param program_name: $0 in shell terms
+    :param args: $* in shell terms (after "report")
+    """
+
+    db_path = None
+    journal_filenames = []
+    since_ns = None
+    until_ns = None
+    mode = None
+    use_localtime = True
+    csv_filename = None
+    png_prefix = None
+
+    usage = program_name + ' report ' + ' '.join([
+                                '[-h|--help]',
+                                '[--db=path]',
+                                '[--journal=file ...]',
+                                '[--since=YYYY-MM-DD|30d]',
+                                '[--until=YYYY-MM-DD|1d]',
+                                '[--mode=reception|tracking]',
+                                '[--utc]',
+                                '[--csv=file]',
+                                '[--png=prefix]',
+                            ])
+
+    config = readconfig()
+    if 'history.path' in config:
+        db_path = config['history.path']
+
+    try:
+        opts, args = getopt.getopt(args, 'h', ['help', 'db=', 'journal=', 'since=', 'until=', 'mode=', 'utc', 'csv=', 'png='])
+    except getopt.GetoptError:
+        sys.exit('usage: ' + usage)
+
+    for opt, arg in opts:
+        if opt in ('-h', '--help'):
+            print("%s %s" % ('usage:', usage), file=sys.stderr)
+            sys.exit(0)
+        try:
+            if opt == '--db':
+                db_path = arg
+            elif opt == '--journal':
+                # can be repeated (i.e. rotated journals)
+                journal_filenames.append(arg)
+            elif opt == '--since':
+                since_ns = parse_when(arg)
+            elif opt == '--until':
+                until_ns = parse_when(arg)
+            elif opt == '--mode':
+                if arg not in ['reception', 'tracking']:
+                    raise ValueError
+                mode = arg
+            elif opt == '--utc':
+                use_localtime = False
+            elif opt == '--csv':
+                csv_filename = arg
+            elif opt == '--png':
+                png_prefix = arg
+        except ValueError:
+            print("%s %s %s" % (program_name, 'invalid', opt), file=sys.stderr)
+            sys.exit('usage: ' + usage)
+
+    if png_prefix and np is None:
+        sys.exit('%s: --png needs numpy and matplotlib installed' % (program_name))
+
+    start = time.monotonic()
+    try:
+        if len(journal_filenames) > 0:
+            # the journal takes priority over the history database
+            (start_ns, antenna, ok) = load_journal(journal_filenames, since_ns, until_ns, mode)
+        elif db_path:
+            (start_ns, antenna, ok) = load_history(db_path, since_ns, until_ns, mode)
+        else:
+            print("%s %s" % (program_name, 'no journal or history (use --journal, --db or [HISTORY] in wwvb.ini)'), file=sys.stderr)
+            sys.exit('usage: ' + usage)
+    except (OSError, HistoryDBError) as err:
+        sys.exit(err)
+    loaded = time.monotonic()
+
+    bins = bin_attempts(start_ns, antenna, ok, use_localtime)
+    binned = time.monotonic()
+
+    print('%d attempts loaded in %.2f seconds and binned in %.2f seconds%s' % (
+                len(start_ns),
+                loaded - start,
+                binned - loaded,
+                '' if np is not None else ' (numpy not installed)'
+            ))
+    print_summary(bins, use_localtime)
+
+    if csv_filename:
+        write_csv(bins, csv_filename)
+        print('CSV written to %s' % (csv_filename))
+
+    if png_prefix:
+        try:
+            filenames = write_png(bins, png_prefix, use_localtime)
+        except ImportError as err:
+            sys.exit('%s: --png needs matplotlib: %s' % (program_name, err))
+        print('heatmaps written to %s' % (', '.join(filenames)))
@@ -0,0 +1,437 @@
+""" ring.py
+
+Fixed-size reception records in a multiprocessing.shared_memory ring; from the hardware process to the rest
+
+Copyright (C) 2023 Martin J Levy - W6LHI/G8LHI - @mahtin - https://github.com/mahtin
+
+One writer (the hardware process) and one reader (the main process). Writing a record is a struct pack
+into shared memory plus a one byte wakeup; it never waits for the reader. If the reader falls a whole
+ring behind, the oldest records are lost (and counted) rather than the writer being held up.
+
+The shared memory is native byte order (both ends are on the same host):
+
+    offset  type    name
+    0       4s      magic           b'WWVR'
+    4       H       version         3
+    6       H       slot size       bytes per slot
+    8       I       slots           number of slots
+    12      I       (padding)
+    16      Q       count           records completely written so far
+    24      40x     (padding)
+    64              slots
+
+Each slot is a Q sequence number, an I check and a RECORD. Record n goes in slot n % slots; the slot
+sequence is 2n+1 while it's being written and 2n+2 once it's complete (a per slot seqlock). The check is
+a CRC-32 (zlib.crc32) of the complete sequence (8 bytes) then the RECORD.
+
+Python has no memory barrier; on a weakly ordered CPU (i.e. the ARM in a Raspberry Pi) the reader can
+see the writer's stores in any order, and the sequence alone can't promise a consistent copy. The check
+can: a copy with sequence 2n+2 either side and a matching check is one complete write.
+"""
+
+import os
+import time
+import zlib
+import queue
+import struct
+import logging
+import threading
+from datetime import datetime, timezone
+from multiprocessing.connection import wait
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    # python 3.7
+    shared_memory = None
+
+from .receiver import Reception
+
+DEFAULT_RING_SLOTS = 64
+
+RING_MAGIC = b'WWVR'
+RING_VERSION = 3
+
+HEADER = struct.Struct('=4sHHI4x')
+COUNT = struct.Struct('=Q')
+COUNT_OFFSET = 16
+SLOTS_OFFSET = 64
+SEQ = struct.Struct('=Q')
+CHECK = struct.Struct('=I')
+
+I2C_MAX = 40                # i2c timings kept per attempt; any more are counted but not copied
+
+# start_ns irq_ns irq_monotonic_ns duration_ns received system_time_ns system_time_ms delta_seconds start_late_ns clock_step_ns
+# irq_status status0 cycles timeouts i2c_total clock_steps receiver kind tracking antenna rx_antenna outcome leap (pad)
+# i2c_ns[I2C_MAX]
+RECORD = struct.Struct('=qqqqqqqdqqHHHHHHBBBBBBBx%dI' % (I2C_MAX))
+FIXED = 23                  # fields before i2c_ns
+RECORD_OFFSET = SEQ.size + CHECK.size
+SLOT_SIZE = (RECORD_OFFSET + RECORD.size + 7) & ~7
+
+NONE_NS = -(2 ** 63)        # None in a q field
+NONE_H = 0xffff             # None in an H field
+
+KIND_NONE = 0               # unsuccessful (or no) reception
+KIND_FULL = 1               # received is seconds since the epoch
+KIND_TRACKING = 2           # received is only the second
+
+OUTCOMES = ('RX_OK', 'RX_FAIL', 'CYCLE_COMPLETE', 'I2C_ERROR')
+LEAPS = (None, 'positive', 'negative')
+NO_ATTEMPT = 0xff           # outcome when the reception has no (new) attempt
+
+class RingError(Exception):
+    """ raise this any Ring error """
+
+def _fence(barrier):
+    """ _fence() """
+    # A process-private threading.Lock; it orders nothing as seen from another process (see check above).
+    # It keeps this thread's steps in order and, on x86, that's also the order other processes see.
+    with barrier:
+        pass
+
+def _check(seq, record):
+    """ _check() """
+    return zlib.crc32(record, zlib.crc32(SEQ.pack(seq)))
+
+def _ns(value):
+    """ _ns """
+    return NONE_NS if value is None else value
+
+def _from_ns(value):
+    """ _from_ns """
+    return None if value == NONE_NS else value
+
+def _antenna(value):
+    """ _antenna """
+    # 'Antenna1' or 'Antenna2'
+    return int(value[-1]) if value else 0
+
+def pack_reception(view, offset, reception, index):
+    """ pack_reception()
+
+    :param view: memoryview to pack into
+    :param offset: Where in the view
+    :param reception: Reception instance
+    :param index: Receiver number (position in the list of names)
+    """
+    attempt = reception.attempt
+    received_dt = reception.received_dt
+    if not received_dt:
+        kind = KIND_NONE
+        received = 0
+        system_time_ms = 0
+    else:
+        if reception.tracking():
+            kind = KIND_TRACKING
+            received = received_dt.second
+        else:
+            kind = KIND_FULL
+            received = int(received_dt.timestamp())
+        system_time = reception.system_time
+        system_time_ms = int(system_time.replace(microsecond=0).timestamp()) * 1000 + system_time.microsecond // 1000
+    delta_seconds = reception.delta_seconds if reception.delta_seconds is not None else float('nan')
+
+    if attempt:
+        i2c_ns = attempt['i2c_ns']
+        i2c = [min(v, 0xffffffff) for v in i2c_ns[:I2C_MAX]]
+        RECORD.pack_into(view, offset,
+                        _ns(attempt['start_ns']), _ns(attempt['irq_ns']), _ns(attempt['irq_monotonic_ns']), _ns(attempt['duration_ns']),
+                        received, _ns(reception.system_time_ns), system_time_ms, delta_seconds, _ns(reception.start_late_ns),
+                        attempt.get('clock_step_ns', 0),
+                        NONE_H if attempt['irq_status'] is None else attempt['irq_status'],
+                        NONE_H if attempt['status0'] is None else attempt['status0'],
+                        min(attempt['cycles'], 0xffff), min(attempt['timeouts'], 0xffff), min(len(i2c_ns), 0xffff),
+                        min(attempt.get('clock_steps', 0), 0xffff),
+                        index, kind, int(attempt['tracking']), _antenna(attempt['antenna']), _antenna(reception.rx_antenna),
+                        OUTCOMES.index(attempt['outcome']), LEAPS.index(reception.leap_second),
+                        *(i2c + [0] * (I2C_MAX - len(i2c))))
+    else:
+        RECORD.pack_into(view, offset,
+                        NONE_NS, NONE_NS, NONE_NS, NONE_NS,
+                        received, _ns(reception.system_time_ns), system_time_ms, delta_seconds, _ns(reception.start_late_ns),
+                        0,
+                        NONE_H, NONE_H, 0, 0, 0, 0,
+                        index, kind, 0, 0, _antenna(reception.rx_antenna),
+                        NO_ATTEMPT, LEAPS.index(reception.leap_second),
+                        *([0] * I2C_MAX))
+
+def unpack_reception(values, names):
+    """ unpack_reception()
+
+    :param values: tuple from RECORD.unpack()
+    :param names: Receiver names (as used by pack_reception())
+    :return: Reception instance (as Receiver.receive_once() made it)
+    """
+    (start_ns, irq_ns, irq_monotonic_ns, duration_ns, received, system_time_ns, system_time_ms, delta_seconds, start_late_ns, clock_step_ns,
+        irq_status, status0, cycles, timeouts, i2c_total, clock_steps,
+        index, kind, tracking, antenna, rx_antenna, outcome, leap) = values[:FIXED]
+    name = names[index]
+
+    received_dt = None
+    if kind == KIND_FULL:
+        received_dt = datetime.fromtimestamp(received, timezone.utc)
+    elif kind == KIND_TRACKING:
+        received_dt = datetime(1, 1, 1, 0, 0, received, microsecond=0, tzinfo=timezone.utc)
+    delta_seconds = None if delta_seconds != delta_seconds else delta_seconds
+
+    attempt = None
+    if outcome != NO_ATTEMPT:
+        outcome = OUTCOMES[outcome]
+        attempt = {
+            'start_ns': _from_ns(start_ns),
+            'irq_ns': _from_ns(irq_ns),
+            'irq_monotonic_ns': _from_ns(irq_monotonic_ns),
+            'duration_ns': _from_ns(duration_ns),
+            'tracking': bool(tracking),
+            'antenna': 'Antenna%d' % (antenna),
+            'irq_status': None if irq_status == NONE_H else irq_status,
+            'status0': None if status0 == NONE_H else status0,
+            'cycles': cycles,
+            'timeouts': timeouts,
+            'outcome': outcome,
+            'wwvb_time': received_dt if outcome == 'RX_OK' else None,
+            'delta_seconds': delta_seconds if outcome == 'RX_OK' else None,
+            'i2c_ns': list(values[FIXED:FIXED + min(i2c_total, I2C_MAX)]),
+            'clock_steps': clock_steps,
+            'clock_step_ns': clock_step_ns,
+            'receiver': name,
+        }
+
+    reception = Reception(name, attempt, received_dt)
+    reception.start_late_ns = _from_ns(start_late_ns)
+    if received_dt:
+        reception.wwvb_time = received_dt
+        reception.system_time = datetime.fromtimestamp(system_time_ms // 1000, timezone.utc).replace(microsecond=(system_time_ms % 1000) * 1000)
+        reception.system_time_ns = _from_ns(system_time_ns)
+        reception.rx_antenna = 'Antenna%d' % (rx_antenna) if rx_antenna else None
+        reception.delta_seconds = delta_seconds
+        reception.leap_second = LEAPS[leap]
+    return reception
+
+class Ring:
+    """ Ring()
+
+    :param names: Receiver names (records carry an index into this list)
+    :param wake: Connection (read end of a multiprocessing.Pipe) the writer pokes after each record
+    :param slots: Number of records held
+    :param debug: True to enable debug messages
+    :param verbose: True to enable verbose messages
+    :return: New instance of Ring()
+
+    The reader; it creates (and in the end unlinks) the shared memory. Pass name() to RingWriter().
+    """
+
+    def __init__(self, names, wake, slots=DEFAULT_RING_SLOTS, debug=False, verbose=False):
+        """ :meta private: """
+
+        self._shm = None
+        self._view = None
+
+        if shared_memory is None:
+            raise RingError('multiprocessing.shared_memory needs python 3.8 or later')
+        if slots < 2:
+            raise RingError('ring needs at least two slots')
+
+        self._names = list(names)
+        self._wake = wake
+        self._slots = slots
+        self._cursor = 0
+        self._lost = 0
+
+        self._log = logging.getLogger(__class__.__name__)
+        self._debug = debug
+        if self._debug:
+            self._log.setLevel(logging.DEBUG)
+        self._verbose = verbose
+        if self._verbose:
+            self._log.setLevel(logging.INFO)
+
+        try:
+            self._shm = shared_memory.SharedMemory(create=True, size=SLOTS_OFFSET + slots * SLOT_SIZE)
+        except OSError as err:
+            raise RingError('shared memory: %s' % (err)) from err
+        self._view = self._shm.buf
+        self._barrier = threading.Lock()
+
+        COUNT.pack_into(self._view, COUNT_OFFSET, 0)
+        for slot in range(slots):
+            SEQ.pack_into(self._view, SLOTS_OFFSET + slot * SLOT_SIZE, 0)
+        _fence(self._barrier)
+        HEADER.pack_into(self._view, 0, RING_MAGIC, RING_VERSION, SLOT_SIZE, slots)
+
+        self._log.info('ring ready: %s', self)
+
+    def __del__(self):
+        """ __del__ """
+        self.close()
+
+    def __str__(self):
+        """ __str__ """
+        return '[ring %s %d slots]' % (self.name(), self._slots)
+
+    def name(self):
+        """ name() - the shared memory name (for RingWriter) """
+        return self._shm.name if self._shm else None
+
+    def lost(self):
+        """ lost() - records overwritten before they were read """
+        return self._lost
+
+    def close(self):
+        """ close() """
+        self._view = None
+        if self._shm is not None:
+            self._shm.close()
+            try:
+                self._shm.unlink()
+            except FileNotFoundError:
+                pass
+            self._shm = None
+
+    def get(self, timeout=None, sentinel=None):
+        """ get()
+
+        :param timeout: Seconds to wait (None waits forever)
+        :param sentinel: Also stop waiting when this is ready (i.e. the writer's Process.sentinel)
+        :return: Reception instance
+        :raises queue.Empty: If there's nothing within the timeout (same as queue.Queue)
+        :raises RingError: If the sentinel is ready and there's nothing left to read
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        waitables = [self._wake] if sentinel is None else [self._wake, sentinel]
+        while True:
+            reception = self._read()
+            if reception is not None:
+                return reception
+            remaining = None if deadline is None else max(0.0, deadline - time.monotonic())
+            ready = wait(waitables, remaining)
+            if not ready:
+                raise queue.Empty
+            writer_gone = sentinel is not None and sentinel in ready
+            if self._wake in ready and not self._drain():
+                writer_gone = True
+            if writer_gone and self._read_count() == self._cursor:
+                raise RingError('ring writer has gone away')
+
+    def _drain(self):
+        """ _drain
+
+        :return: False if the pipe is closed (the writer has gone)
+        """
+        try:
+            while self._wake.poll():
+                self._wake.recv_bytes()
+        except (EOFError, OSError):
+            return False
+        return True
+
+    def _read_count(self):
+        """ _read_count """
+        return COUNT.unpack_from(self._view, COUNT_OFFSET)[0]
+
+    def _read(self):
+        """ _read """
+        view = self._view
+        barrier = self._barrier
+        while True:
+            count = self._read_count()
+            if self._cursor >= count:
+                return None
+            if count - self._cursor > self._slots:
+                # lapped; skip to the oldest record still there
+                self._lost += count - self._slots - self._cursor
+                self._log.warning('%s: reader fell behind; %d records lost', self, count - self._slots - self._cursor)
+                self._cursor = count - self._slots
+            n = self._cursor
+            offset = SLOTS_OFFSET + (n % self._slots) * SLOT_SIZE
+            _fence(barrier)
+            before = SEQ.unpack_from(view, offset)[0]
+            _fence(barrier)
+            copy = bytes(view[offset + SEQ.size:offset + RECORD_OFFSET + RECORD.size])
+            _fence(barrier)
+            after = SEQ.unpack_from(view, offset)[0]
+            record = copy[CHECK.size:]
+            if before == after == 2 * n + 2 and CHECK.unpack_from(copy, 0)[0] == _check(before, record):
+                self._cursor += 1
+                return unpack_reception(RECORD.unpack(record), self._names)
+            # not there yet (the count was seen first), or the writer has lapped us and is (or was)
+            # rewriting this slot; the lap check moves us on
+            time.sleep(0)
+
+class RingWriter:
+    """ RingWriter()
+
+    :param name: Shared memory name (from Ring.name())
+    :param wake: Connection (write end of a multiprocessing.Pipe) to poke after each record
+    :param names: Receiver names (same list as the Ring)
+    :return: New instance of RingWriter()
+
+    put() has the same signature as queue.Queue.put(); hence Receiver() threads can write straight into it.
+    """
+
+    def __init__(self, name, wake, names):
+        """ :meta private: """
+
+        self._shm = None
+        self._view = None
+
+        if shared_memory is None:
+            raise RingError('multiprocessing.shared_memory needs python 3.8 or later')
+        try:
+            self._shm = shared_memory.SharedMemory(name=name)
+        except (OSError, ValueError) as err:
+            raise RingError('%s: %s' % (name, err)) from err
+        self._view = self._shm.buf
+
+        (magic, version, slot_size, slots) = HEADER.unpack_from(self._view, 0)
+        if magic != RING_MAGIC or version != RING_VERSION or slot_size != SLOT_SIZE:
+            self.close()
+            raise RingError('%s: not a version %d ring' % (name, RING_VERSION))
+        self._slots = slots
+        self._count = COUNT.unpack_from(self._view, COUNT_OFFSET)[0]
+        self._indexes = {name: index for (index, name) in enumerate(names)}
+        # the wakeup must never block the writer; a full pipe already means the reader has plenty to do
+        self._wake = wake
+        os.set_blocking(self._wake.fileno(), False)
+        self._barrier = threading.Lock()
+        # receiver threads share the writer
+        self._lock = threading.Lock()
+
+    def __del__(self):
+        """ __del__ """
+        self.close()
+
+    def close(self):
+        """ close() """
+        self._view = None
+        if self._shm is not None:
+            self._shm.close()
+            self._shm = None
+
+    def put(self, reception):
+        """ put()
+
+        :param reception: Reception instance
+
+        Never blocks (other than for another receiver thread's put())
+        """
+        with self._lock:
+            view = self._view
+            barrier = self._barrier
+            n = self._count
+            offset = SLOTS_OFFSET + (n % self._slots) * SLOT_SIZE
+            SEQ.pack_into(view, offset, 2 * n + 1)
+            _fence(barrier)
+            pack_reception(view, offset + RECORD_OFFSET, reception, self._indexes[reception.receiver])
+            CHECK.pack_into(view, offset + SEQ.size, _check(2 * n + 2, view[offset + RECORD_OFFSET:offset + RECORD_OFFSET + RECORD.size]))
+            _fence(barrier)
+            SEQ.pack_into(view, offset, 2 * n + 2)
+            _fence(barrier)
+            self._count = n + 1
+            COUNT.pack_into(view, COUNT_OFFSET, self._count)
+        try:
+            self._wake.send_bytes(b'\0')
+        except OSError:
+            # pipe full (the reader will find the record anyway) or the reader has gone (our parent will stop us)
+            pass
@@ -0,0 +1,292 @@
+""" scan.py
+
+Find which i2c bus (and address) each ES100-MOD is on; "wwvb scan" (or "wwvb --scan")
+
+Copyright (C) 2023 Martin J Levy - W6LHI/G8LHI - @mahtin - https://github.com/mahtin
+
+Every /dev/i2c-* bus is probed at once (one thread per bus) for the ES100's DEVICE_ID register (0x10).
+On Linux the probe is done directly via the i2c-dev ioctl()'s with no retries and a short adapter
+timeout; an empty address costs one NACK. Elsewhere ES100I2C is used (and the bus must be given).
+Nothing is powered up by an ES100() instance; hence no disable/enable cycle and no one second probe.
+
+An ES100 only answers with EN high. Given --en (and --irq) pins, each pair is raised in turn and the
+buses scanned; hence which EN/IRQ pair goes with which bus is found too.
+
+The result is printed as a wwvb.ini section (or sections) ready to paste.
+"""
+
+import os
+import sys
+import glob
+import time
+import getopt
+import platform
+import threading
+
+from es100.i2c_control import ES100I2C, ES100I2CError
+from es100.gpio_control import ES100GPIO, ES100GPIOError
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from .config import readconfig, config_list
+
+ES100_ADDRESSES = [0x32]            # the ES100-MOD has one (fixed) address
+ES100_DEVICE_ID_REGISTER = 0x0d
+ES100_DEVICE_ID = 0x10
+
+DEFAULT_TIMEOUT_MS = 10             # i2c adapter timeout per transaction (10ms resolution)
+ENABLE_DELAY = 0.002                # seconds for the ES100 to wake after EN goes high
+
+# linux/i2c-dev.h
+I2C_RETRIES = 0x0701
+I2C_TIMEOUT = 0x0702
+I2C_SLAVE = 0x0703
+
+class ScanError(Exception):
+    """ raise this any scan error """
+
+def i2c_buses():
+    """ i2c_buses()
+
+    :return: Sorted list of i2c bus numbers (from /dev/i2c-*)
+    """
+    buses = []
+    for path in glob.glob('/dev/i2c-*'):
+        try:
+            buses.append(int(path[len('/dev/i2c-'):]))
+        except ValueError:
+            continue
+    return sorted(buses)
+
+def _probe_linux(bus, addresses, timeout_ms):
+    """ _probe_linux """
+    found = []
+    try:
+        fd = os.open('/dev/i2c-%d' % (bus), os.O_RDWR)
+    except OSError as err:
+        raise ScanError('i2c bus %d: %s' % (bus, err)) from err
+    try:
+        try:
+            fcntl.ioctl(fd, I2C_RETRIES, 0)
+            # in units of 10ms
+            fcntl.ioctl(fd, I2C_TIMEOUT, max(1, (timeout_ms + 9) // 10))
+        except OSError:
+            # not every adapter allows these; the defaults are still fine
+            pass
+        for address in addresses:
+            try:
+                fcntl.ioctl(fd, I2C_SLAVE, address)
+            except OSError:
+                # EBUSY; a kernel driver owns this address; hence not an ES100
+                continue
+            try:
+                os.write(fd, bytes([ES100_DEVICE_ID_REGISTER]))
+                device_id = os.read(fd, 1)[0]
+            except (OSError, IndexError):
+                # NACK (ENXIO/EREMOTEIO) or timeout; nothing there
+                continue
+            found.append((bus, address, device_id))
+    finally:
+        os.close(fd)
+    return found
+
+def _probe_es100i2c(bus, addresses):
+    """ _probe_es100i2c """
+    found = []
+    for address in addresses:
+        try:
+            i2c = ES100I2C(bus, address)
+            i2c.write(ES100_DEVICE_ID_REGISTER)
+            device_id = i2c.read(ES100_DEVICE_ID_REGISTER)
+            i2c.close()
+        except ES100I2CError:
+            continue
+        found.append((bus, address, device_id))
+    return found
+
+def scan_buses(buses, addresses=None, timeout_ms=DEFAULT_TIMEOUT_MS):
+    """ scan_buses()
+
+    :param buses: list of i2c bus numbers
+    :param addresses: list of i2c addresses (default is the ES100's)
+    :param timeout_ms: i2c adapter timeout (Linux only)
+    :return: (found, errors) where found is a sorted list of (bus, address, device_id) and errors a list of strings
+    """
+    if addresses is None:
+        addresses = ES100_ADDRESSES
+    use_ioctl = fcntl is not None and platform.system() == 'Linux'
+    results = {}
+    errors = []
+
+    def _scan(bus):
+        try:
+            if use_ioctl:
+                results[bus] = _probe_linux(bus, addresses, timeout_ms)
+            else:
+                results[bus] = _probe_es100i2c(bus, addresses)
+        except ScanError as err:
+            errors.append(str(err))
+
+    # one thread per bus; transactions on a bus are serialized by its adapter anyway
+    threads = [threading.Thread(target=_scan, args=(bus,), name='scan-i2c-%d' % (bus), daemon=True) for bus in buses]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    found = []
+    for bus in sorted(results):
+        found += results[bus]
+    return (found, errors)
+
+def _receiver_name(bus, address, en):
+    """ _receiver_name """
+    name = 'bus%d' % (bus)
+    if address not in ES100_ADDRESSES:
+        name += '_%d' % (address)
+    if en is not None:
+        name += '_en%d' % (en)
+    return name
+
+def ini_sections(found):
+    """ ini_sections()
+
+    :param found: list of (bus, address, en, irq) for each ES100 found
+    :return: wwvb.ini text
+    """
+    lines = []
+    if len(found) == 1:
+        (bus, address, en, irq) = found[0]
+        lines.append('[WWVB]')
+        lines.append('    bus = %d' % (bus))
+        lines.append('    address = %d' % (address))
+        if en is not None:
+            lines.append('    irq = %d' % (irq))
+            lines.append('    en = %d' % (en))
+        return '\n'.join(lines)
+
+    names = [_receiver_name(bus, address, en) for (bus, address, en, irq) in found]
+    lines.append('[WWVB]')
+    lines.append('    receivers = %s' % (', '.join(names)))
+    for (name, (bus, address, en, irq)) in zip(names, found):
+        lines.append('')
+        lines.append('[%s]' % (name))
+        lines.append('    bus = %d' % (bus))
+        lines.append('    address = %d' % (address))
+        if en is not None:
+            lines.append('    irq = %d' % (irq))
+            lines.append('    en = %d' % (en))
+    return '\n'.join(lines)
+
+def scan(program_name, args):
+    """ scan()
+
+    :param program_name: $0 in shell terms
+    :param args: $* in shell terms (after "scan")
+    """
+
+    buses = None
+    addresses = list(ES100_ADDRESSES)
+    en_pins = []
+    irq_pins = []
+    timeout_ms = DEFAULT_TIMEOUT_MS
+    flag_gpiod = False
+
+    usage = program_name + ' scan ' + ' '.join([
+                                '[-h|--help]',
+                                '[-b|--bus={0-N}[,...]]',
+                                '[-a|--address={8-127}[,...]]',
+                                '[-e|--en={1-40}[,...]]',
+                                '[-i|--irq={1-40}[,...]]',
+                                '[-G|--gpiod]',
+                                '[-t|--timeout=ms]',
+                            ])
+
+    config = readconfig()
+    if 'wwvb.en' in config and config['wwvb.en'] is not None and 'wwvb.irq' in config and config['wwvb.irq'] is not None:
+        en_pins = [config['wwvb.en']]
+        irq_pins = [config['wwvb.irq']]
+
+    try:
+        opts, args = getopt.getopt(args, 'hb:a:e:i:Gt:', ['help', 'bus=', 'address=', 'en=', 'irq=', 'gpiod', 'timeout='])
+    except getopt.GetoptError:
+        sys.exit('usage: ' + usage)
+
+    try:
+        for opt, arg in opts:
+            if opt in ('-h', '--help'):
+                print("%s %s" % ('usage:', usage), file=sys.stderr)
+                sys.exit(0)
+            if opt in ('-b', '--bus'):
+                buses = [int(v) for v in config_list(arg)]
+            elif opt in ('-a', '--address'):
+                addresses = [int(v, 0) for v in config_list(arg)]
+            elif opt in ('-e', '--en'):
+                en_pins = [int(v) for v in config_list(arg)]
+            elif opt in ('-i', '--irq'):
+                irq_pins = [int(v) for v in config_list(arg)]
+            elif opt in ('-G', '--gpiod'):
+                flag_gpiod = True
+            elif opt in ('-t', '--timeout'):
+                timeout_ms = int(arg)
+    except ValueError:
+        sys.exit('usage: ' + usage)
+
+    if len(en_pins) != len(irq_pins):
+        print("%s %s" % (program_name, 'scan: --en and --irq need the same number of pins'), file=sys.stderr)
+        sys.exit('usage: ' + usage)
+    if not all([0x08 <= address <= 0x77 for address in addresses]):
+        print("%s %s" % (program_name, 'scan: i2c address must be 8-127'), file=sys.stderr)
+        sys.exit('usage: ' + usage)
+
+    if buses is None:
+        buses = i2c_buses()
+        if len(buses) == 0:
+            sys.exit('%s scan: no /dev/i2c-* buses found (use --bus)' % (program_name))
+
+    start = time.monotonic()
+    found = []
+    others = []
+    errors = []
+    # with no pins, assume the ES100(s) are already enabled
+    for (en, irq) in list(zip(en_pins, irq_pins)) or [(None, None)]:
+        gpio = None
+        if en is not None:
+            try:
+                gpio = ES100GPIO(en, irq, use_gpiod=flag_gpiod)
+            except ES100GPIOError as err:
+                errors.append('gpio en=%d irq=%d: %s' % (en, irq, err))
+                continue
+            gpio.en_high()
+            time.sleep(ENABLE_DELAY)
+        (devices, round_errors) = scan_buses(buses, addresses, timeout_ms)
+        if gpio is not None:
+            gpio.en_low()
+            del gpio
+        for error in round_errors:
+            if error not in errors:
+                errors.append(error)
+        for (bus, address, device_id) in devices:
+            if device_id == ES100_DEVICE_ID:
+                found.append((bus, address, en, irq))
+            else:
+                others.append((bus, address, device_id))
+    elapsed = time.monotonic() - start
+
+    print('# %s scan: %d bus%s (%s) in %.0f ms; %d ES100 found' % (
+                    program_name,
+                    len(buses),
+                    '' if len(buses) == 1 else 'es',
+                    ','.join([str(bus) for bus in buses]),
+                    elapsed * 1000.0,
+                    len(found)
+            ))
+    for error in sorted(errors):
+        print('# %s' % (error))
+    for (bus, address, device_id) in sorted(set(others)):
+        print('# bus %d address %d: not an ES100 (device id 0x%02x)' % (bus, address, device_id))
+    if len(found) == 0:
+        sys.exit(1)
+    print(ini_sections(found))
@@ -0,0 +1,212 @@
+""" shmconsumer.py
+
+A pure Python emulation of ntpd's refclock_shm consumer
+
+Attach this to a (test) shared memory unit while wwvb writes to it and it will
+compute the offset and jitter ntpd would see; without running ntpd.
+
+Copyright (C) 2023 Martin J Levy - W6LHI/G8LHI - @mahtin - https://github.com/mahtin
+"""
+
+import time
+import math
+import logging
+
+try:
+    import sysv_ipc
+except ImportError:
+    sysv_ipc = None
+
+from .ntpdriver28 import NTPD_DEFAULT_KEY, SHM_LAYOUT32, SHM_LAYOUT64, SHM_SAMPLE_FIELDS, SHM_NSEC_FIELDS
+from .ntpdriver28 import compile_layout
+
+# https://github.com/ntp-project/ntp/blob/master-no-authorname/ntpd/refclock_shm.c
+SHM_OK = 'OK'
+SHM_NOTREADY = 'NOTREADY'       # valid not set - nothing new
+SHM_BADMODE = 'BADMODE'         # mode not 0 or 1
+SHM_COUNTFAIL = 'COUNTFAIL'     # mode 1: count changed while copying (writer active)
+SHM_STALE = 'STALE'             # receive timestamp too old (max_delay)
+SHM_CLOCKERR = 'CLOCKERR'       # clock vs receive timestamps too far apart (max_delta)
+
+DEFAULT_MAX_DELAY = 5           # seconds; ntpd's default for stale samples
+DEFAULT_MAX_DELTA = 4 * 3600    # seconds; ntpd's default (fudge time2)
+DEFAULT_NSAMPLES = 60           # ntpd's MAXSTAGE - size of the refclock sample buffer
+DEFAULT_SYS_PRECISION = -20     # log2 seconds; a typical modern host
+
+class SHMConsumerError(Exception):
+    """ raise this any SHMConsumer error """
+
+class SHMConsumer:
+    """ SHMConsumer()
+
+    :param unit: The unit number of the clock source (0 thru 255)
+    :param nsamples: Size of the sample buffer used by the median filter
+    :param max_delay: Seconds before a sample is considered stale
+    :param max_delta: Maximum seconds between clock and receive timestamps
+    :param debug: True to enable debug messages
+    :param verbose: True to enable verbose messages
+    :return: New instance of SHMConsumer()
+
+    poll() does what ntpd's shm_timer() does every second.
+    sample() does what ntpd's refclock_sample() does every poll interval.
+    """
+
+    def __init__(self, unit=0, nsamples=DEFAULT_NSAMPLES, max_delay=DEFAULT_MAX_DELAY, max_delta=DEFAULT_MAX_DELTA, debug=False, verbose=False):
+        """ :meta private: """
+
+        self._shm = None
+        self._view = None
+
+        if not sysv_ipc:
+            raise SHMConsumerError('sysv_ipc package not installed - no shared memory access')
+
+        self._unit = unit
+        self._nsamples = nsamples
+        self._max_delay_ns = int(max_delay * 1000000000)
+        self._max_delta_ns = int(max_delta * 1000000000)
+
+        self._log = logging.getLogger(__class__.__name__)
+        self._debug = debug
+        if self._debug:
+            self._log.setLevel(logging.DEBUG)
+        self._verbose = verbose
+        if self._verbose:
+            self._log.setLevel(logging.INFO)
+
+        try:
+            self._shm = sysv_ipc.SharedMemory(NTPD_DEFAULT_KEY + self._unit)
+        except Exception as err:
+            raise SHMConsumerError('unable to attach to shared memory: %s' % (err)) from err
+        self._view = memoryview(self._shm)
+
+        if self._shm.size == 96:
+            layout = SHM_LAYOUT64
+        elif self._shm.size == 80:
+            layout = SHM_LAYOUT32
+        else:
+            raise SHMConsumerError('size %d unknown' % (self._shm.size))
+        self._layout = layout
+
+        self._word = compile_layout(layout, ['mode'])[1]
+        self._sample = compile_layout(layout, SHM_SAMPLE_FIELDS)
+        self._nsec = compile_layout(layout, SHM_NSEC_FIELDS)
+
+        self._offsets = []
+        self.status = {}
+        self.latency_ns = []
+
+    def __del__(self):
+        """ __del__ """
+        if self._view is not None:
+            self._view.release()
+            self._view = None
+        if self._shm:
+            self._shm.detach()
+            self._shm = None
+
+    def __str__(self):
+        """ __str__ """
+        return '[0x%08X+%d]' % (NTPD_DEFAULT_KEY, self._unit)
+
+    def _word_at(self, buf, name):
+        """ _word_at """
+        return self._word.unpack_from(buf, self._layout[name][0])[0]
+
+    def poll(self, now_ns=None):
+        """ poll()
+
+        :param now_ns: Present system time in nanoseconds (default is now)
+        :return: (status, offset) - offset in seconds is only valid if status is SHM_OK
+
+        One pass of ntpd's shm_timer()/shm_query()
+        """
+
+        if now_ns is None:
+            now_ns = time.time_ns()
+
+        view = self._view
+        mode = self._word_at(view, 'mode')
+        if mode not in [0, 1]:
+            return self._count(SHM_BADMODE)
+
+        if not self._word_at(view, 'valid'):
+            return self._count(SHM_NOTREADY)
+
+        if mode == 1:
+            count = self._word_at(view, 'count')
+            copy = bytes(view)
+            if count != self._word_at(view, 'count'):
+                return self._count(SHM_COUNTFAIL)
+        else:
+            copy = bytes(view)
+
+        # ntpd now owns the sample; writer can go again
+        self._word.pack_into(view, self._layout['valid'][0], 0)
+
+        offset, compiled = self._sample
+        (c_sec, c_usec, r_sec, r_usec, _, _) = compiled.unpack_from(copy, offset)
+        offset, compiled = self._nsec
+        (c_nsec, r_nsec) = compiled.unpack_from(copy, offset)
+
+        # ntpd only trusts the NSec fields if they agree with the USec fields
+        if c_nsec // 1000 == c_usec and r_nsec // 1000 == r_usec:
+            clock_ns = c_sec * 1000000000 + c_nsec
+            receive_ns = r_sec * 1000000000 + r_nsec
+        else:
+            clock_ns = c_sec * 1000000000 + c_usec * 1000
+            receive_ns = r_sec * 1000000000 + r_usec * 1000
+
+        if abs(now_ns - receive_ns) > self._max_delay_ns:
+            return self._count(SHM_STALE)
+
+        if abs(clock_ns - receive_ns) > self._max_delta_ns:
+            return self._count(SHM_CLOCKERR)
+
+        offset = (clock_ns - receive_ns) / 1000000000.0
+        self._offsets.append(offset)
+        if len(self._offsets) > self._nsamples:
+            del self._offsets[0]
+        self.latency_ns.append(now_ns - receive_ns)
+        self._log.debug('%s: sample offset %.9f', self, offset)
+        return self._count(SHM_OK, offset)
+
+    def _count(self, status, offset=None):
+        """ _count """
+        self.status[status] = self.status.get(status, 0) + 1
+        return (status, offset)
+
+    def sample(self, sys_precision=DEFAULT_SYS_PRECISION):
+        """ sample()
+
+        :param sys_precision: log2 system precision (lower bound for jitter)
+        :return: (offset, jitter, n) or None if no samples
+
+        ntpd's refclock_sample(); trim outliers furthest from the median until ~60% remain,
+        then average what's left. The buffer is emptied (as ntpd does each poll).
+        """
+        offsets = sorted(self._offsets)
+        self._offsets = []
+        n = len(offsets)
+        if n == 0:
+            return None
+
+        i = 0
+        j = n
+        m = n - (n * 4) // 10
+        while (j - i) > m:
+            median = offsets[(j + i) // 2]
+            if offsets[j - 1] - median < median - offsets[i]:
+                i += 1      # reject low end
+            else:
+                j -= 1      # reject high end
+
+        offset = 0.0
+        jitter = 0.0
+        for k in range(i, j):
+            offset += offsets[k]
+            if k > i:
+                jitter += (offsets[k] - offsets[k - 1]) ** 2
+        offset /= m
+        jitter = max(math.sqrt(jitter / m), pow(2, sys_precision))
+        self._log.info('%s: offset %.9f jitter %.9f from %d samples', self, offset, jitter, n)
+        return (offset, jitter, n)
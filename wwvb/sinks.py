@@ -0,0 +1,128 @@
+""" sinks.py
+
+Fan out each fix to every configured time consumer (ntpd SHM units, chronyd sockets)
+
+Copyright (C) 2023 Martin J Levy - W6LHI/G8LHI - @mahtin - https://github.com/mahtin
+"""
+
+import time
+import logging
+
+class SinkStats:
+    """ SinkStats()
+
+    :param sink: The sink these stats are for
+    :return: New instance of SinkStats()
+
+    Per-sink publish counters and latency (in nanoseconds)
+    """
+
+    __slots__ = ('sink', 'published', 'errors', 'last_ns', 'total_ns', 'max_ns', 'last_ok', 'last_error')
+
+    def __init__(self, sink):
+        """ :meta private: """
+        self.sink = sink
+        self.published = 0
+        self.errors = 0
+        self.last_ns = 0
+        self.total_ns = 0
+        self.max_ns = 0
+        self.last_ok = False
+        self.last_error = None
+
+    def __str__(self):
+        """ __str__ """
+        mean_ns = self.total_ns / self.published if self.published else 0
+        return '%s published=%d errors=%d latency last=%.1fus mean=%.1fus max=%.1fus' % (
+                    self.sink,
+                    self.published,
+                    self.errors,
+                    self.last_ns / 1000.0,
+                    mean_ns / 1000.0,
+                    self.max_ns / 1000.0,
+                )
+
+class Sinks:
+    """ Sinks()
+
+    :param debug: True to enable debug messages
+    :param verbose: True to enable verbose messages
+    :return: New instance of Sinks()
+
+    A sink is anything with a publish(sample) method (NTPDriver28, ChronySOCK, ...).
+    Each sink is isolated; a failure in one never stops the others from being published to.
+    """
+
+    def __init__(self, debug=False, verbose=False):
+        """ :meta private: """
+        self._stats = []
+
+        self._log = logging.getLogger(__class__.__name__)
+        self._debug = debug
+        if self._debug:
+            self._log.setLevel(logging.DEBUG)
+        self._verbose = verbose
+        if self._verbose:
+            self._log.setLevel(logging.INFO)
+
+    def __len__(self):
+        """ __len__ """
+        return len(self._stats)
+
+    def __str__(self):
+        """ __str__ """
+        return '[%s]' % (', '.join([str(stats.sink) for stats in self._stats]))
+
+    def add(self, sink):
+        """ add()
+
+        :param sink: Any instance with a publish(sample) method
+        """
+        self._stats.append(SinkStats(sink))
+        self._log.info('sink added: %s', sink)
+
+    def publish(self, sample):
+        """ publish()
+
+        :param sample: NTPSample instance
+        :return: number of sinks successfully published to
+
+        Publish one precomputed sample to every sink
+        """
+        count = 0
+        for stats in self._stats:
+            start_ns = time.perf_counter_ns()
+            try:
+                stats.sink.publish(sample)
+            except Exception as err:            # pylint: disable=broad-except
+                # anything can go wrong with a sink (detached segment, chronyd restarting, ...)
+                # it must not affect the other sinks
+                stats.errors += 1
+                stats.last_ok = False
+                stats.last_error = err
+                self._log.warning('sink %s: publish failed: %s', stats.sink, err)
+                continue
+            finally:
+                stats.last_ns = time.perf_counter_ns() - start_ns
+            stats.published += 1
+            stats.last_ok = True
+            stats.total_ns += stats.last_ns
+            stats.max_ns = max(stats.max_ns, stats.last_ns)
+            count += 1
+            self._log.info('sink %s: published in %.1f microseconds', stats.sink, stats.last_ns / 1000.0)
+        return count
+
+    def stats(self):
+        """ stats()
+
+        :return: list of SinkStats (one per sink, in the order added)
+        """
+        return list(self._stats)
+
+    def report(self):
+        """ report()
+
+        Log the per-sink counters and latency
+        """
+        for stats in self._stats:
+            self._log.info('%s', stats)
@@ -0,0 +1,151 @@
+""" stats.py
+
+"wwvb stats" - reception statistics from the SQLite history
+
+Copyright (C) 2023 Martin J Levy - W6LHI/G8LHI - @mahtin - https://github.com/mahtin
+"""
+
+import sys
+import getopt
+from datetime import datetime, timezone, timedelta
+
+from .config import readconfig
+from .historydb import HistoryDBError, open_db, import_journal, query_params
+from .historydb import success_by_hour, time_to_fix, delta_seconds, fix_gaps, gap_distribution, percentiles
+
+def parse_when(value):
+    """ parse_when()
+
+    :param value: YYYY-MM-DD[THH:MM[:SS]] (UTC) or a relative time like 30d, 12h, 90m
+    :return: nanoseconds since the epoch
+    """
+    units = {'m': 60, 'h': 3600, 'd': 86400, 'w': 7 * 86400}
+    if len(value) > 1 and value[-1] in units and value[:-1].isdigit():
+        dt = datetime.now(timezone.utc) - timedelta(seconds=int(value[:-1]) * units[value[-1]])
+    else:
+        dt = datetime.fromisoformat(value)
+        if dt.tzinfo is None:
+            dt = dt.replace(tzinfo=timezone.utc)
+    return int(dt.timestamp()) * 1000000000 + dt.microsecond * 1000
+
+def parse_hours(value):
+    """ parse_hours()
+
+    :param value: H1-H2 (UTC; half open, i.e. 2-5 is 02:00 to 04:59)
+    :return: (H1, H2)
+    """
+    (hour_from, hour_to) = [int(v) for v in value.split('-')]
+    if not (0 <= hour_from <= 23 and 0 <= hour_to <= 24):
+        raise ValueError
+    return (hour_from, hour_to % 24)
+
+def _seconds(value):
+    """ _seconds """
+    if value is None:
+        return '-'
+    return '%.3f' % (value)
+
+def stats(program_name, args):
+    """ stats()
+
+    :param program_name: $0 in shell terms
+    :param args: $* in shell terms (after "stats")
+    """
+
+    db_path = None
+    journal_filename = None
+    since_ns = None
+    until_ns = None
+    mode = None
+    antenna = None
+    hours = None
+
+    usage = program_name + ' stats ' + ' '.join([
+                                '[-h|--help]',
+                                '[--db=path]',
+                                '[--import=journal]',
+                                '[--since=YYYY-MM-DD|30d]',
+                                '[--until=YYYY-MM-DD|1d]',
+                                '[--mode=reception|tracking]',
+                                '[--antenna={1-2}]',
+                                '[--hours=H1-H2]',
+                            ])
+
+    config = readconfig()
+    if 'history.path' in config:
+        db_path = config['history.path']
+
+    try:
+        opts, args = getopt.getopt(args, 'h', ['help', 'db=', 'import=', 'since=', 'until=', 'mode=', 'antenna=', 'hours='])
+    except getopt.GetoptError:
+        sys.exit('usage: ' + usage)
+
+    for opt, arg in opts:
+        if opt in ('-h', '--help'):
+            print("%s %s" % ('usage:', usage), file=sys.stderr)
+            sys.exit(0)
+        try:
+            if opt == '--db':
+                db_path = arg
+            elif opt == '--import':
+                journal_filename = arg
+            elif opt == '--since':
+                since_ns = parse_when(arg)
+            elif opt == '--until':
+                until_ns = parse_when(arg)
+            elif opt == '--mode':
+                if arg not in ['reception', 'tracking']:
+                    raise ValueError
+                mode = arg
+            elif opt == '--antenna':
+                if int(arg) not in [1, 2]:
+                    raise ValueError
+                antenna = 'Antenna%d' % (int(arg))
+            elif opt == '--hours':
+                hours = parse_hours(arg)
+        except ValueError:
+            print("%s %s %s" % (program_name, 'invalid', opt), file=sys.stderr)
+            sys.exit('usage: ' + usage)
+
+    if not db_path:
+        print("%s %s" % (program_name, 'no history database (use --db or [HISTORY] in wwvb.ini)'), file=sys.stderr)
+        sys.exit('usage: ' + usage)
+
+    try:
+        # importing a journal is the only time stats writes to the database
+        connection = open_db(db_path, readonly=not journal_filename)
+    except HistoryDBError as err:
+        sys.exit(err)
+
+    if journal_filename:
+        try:
+            count = import_journal(connection, journal_filename)
+        except OSError as err:
+            sys.exit(err)
+        print('imported %d attempts from %s' % (count, journal_filename))
+
+    params = query_params(since_ns, until_ns, mode, antenna, hours)
+
+    print('Success rate by hour (UTC) and antenna')
+    print('    hour antenna   attempts  fixes   rate')
+    for (hour, rx_antenna, attempts, fixes) in success_by_hour(connection, params):
+        print('    %02d   %-8s  %8d %6d %5.1f%%' % (hour, rx_antenna, attempts, fixes, 100.0 * fixes / attempts))
+
+    print('Time to fix (seconds)')
+    print('    mode          fixes      p50      p90      p99')
+    for rx_mode, values in sorted(time_to_fix(connection, params).items()):
+        print('    %-10s %8d %8s %8s %8s' % ((rx_mode, len(values)) + tuple(_seconds(v) for v in percentiles(values))))
+
+    print('Delta (WWVB minus system) seconds')
+    print('    antenna       fixes      p1       p50      p99')
+    for rx_antenna, values in sorted(delta_seconds(connection, params).items()):
+        print('    %-10s %8d %8s %8s %8s' % ((rx_antenna, len(values)) + tuple(_seconds(v) for v in percentiles(values, (1, 50, 99)))))
+
+    print('Gap between fixes')
+    for rx_mode, gaps in sorted(fix_gaps(connection, params).items()):
+        (p50, p90, p99) = percentiles(gaps)
+        print('    %s: %d gaps; p50 %s p90 %s p99 %s seconds' % (rx_mode, len(gaps), _seconds(p50), _seconds(p90), _seconds(p99)))
+        for label, count in gap_distribution(gaps):
+            print('        %-8s %6d' % (label, count))
+
+    connection.close()
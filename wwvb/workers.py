@@ -0,0 +1,300 @@
+""" workers.py
+
+The hardware process (ES100 only) and the recorder process (journal and history); run via multiprocessing
+
+Copyright (C) 2023 Martin J Levy - W6LHI/G8LHI - @mahtin - https://github.com/mahtin
+
+With "wwvb --processes" the main process no longer talks to the ES100(s). A hardware process does
+nothing but receive (one thread per receiver, as before) and write each Reception into a shared memory
+ring (see ring.py). The main process reads the ring and does the filtering, the sinks, the consumers and
+the metrics; the journal and history are written by a third process. A slow sink, a full disk or a long
+garbage collection in the main process can no longer delay the next reception (or tracking) start.
+
+The processes are started with the "spawn" method; nothing (threads, sockets, locks) is inherited.
+"""
+
+import os
+import sys
+import time
+import signal
+import logging
+import multiprocessing
+
+from es100 import ES100, ES100Error
+
+from .ring import Ring, RingWriter, RingError, DEFAULT_RING_SLOTS
+from .gcguard import GCGuard, GCGuardError
+from .receiver import Receiver
+from .journal import Journal, JournalError
+from .historydb import HistoryDB, HistoryDBError
+
+PARENT_CHECK = 1.0          # seconds between checks that the main process is still there
+RECORDER_CLOSE = 10.0       # seconds the recorder process has to flush on exit
+
+class WorkerError(Exception):
+    """ raise this any worker process error """
+
+def _child_setup(log_format, debug, verbose):
+    """ _child_setup """
+    # ^C goes to the whole process group; only the main process acts on it (and then stops us)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # a normal exit on SIGTERM; hence ES100 (GPIO) and file cleanup is done
+    signal.signal(signal.SIGTERM, lambda signalnum, frame: sys.exit(0))
+    level = logging.WARNING
+    if debug:
+        level = logging.DEBUG
+    if verbose:
+        level = logging.INFO
+    logging.basicConfig(format=log_format, level=level)
+
+def _hardware_main(ring_name, wake, names, receiver_settings, receiver_options, gc_lead, parent_pid, log_format, debug, verbose):
+    """ _hardware_main """
+    _child_setup(log_format, debug, verbose)
+    log = logging.getLogger('hardware')
+
+    try:
+        writer = RingWriter(ring_name, wake, names)
+    except RingError as err:
+        sys.exit('hardware: %s' % (err))
+
+    gcguard = None
+    if gc_lead is not None:
+        try:
+            gcguard = GCGuard(lead=gc_lead, debug=debug, verbose=verbose)
+        except GCGuardError as err:
+            sys.exit('hardware: %s' % (err))
+
+    receivers = []
+    for (receiver_name, settings) in receiver_settings:
+        try:
+            es100 = ES100(guard=gcguard, debug=debug, verbose=verbose, **settings)
+        except ES100Error as err:
+            sys.exit('%s: %s' % (receiver_name, err))
+        receivers.append(Receiver(receiver_name, es100, writer, debug=debug, verbose=verbose, **receiver_options))
+    log.info('hardware process %d: %s', os.getpid(), ', '.join([str(receiver) for receiver in receivers]))
+
+    # only this process waits on the IRQ; hence it's the one the real-time profile is for
+    realtime = receiver_options.get('realtime')
+    try:
+        if gcguard:
+            gcguard.start()
+        if realtime:
+            realtime.start()
+        if len(receivers) == 1:
+            receiver = receivers[0]
+            if realtime:
+                realtime.apply_thread(receiver.name)
+            while os.getppid() == parent_pid:
+                writer.put(receiver.receive_once())
+                if gcguard:
+                    # nothing else to do till the next reception; the main process does the rest
+                    gcguard.collect('reception')
+        else:
+            for receiver in receivers:
+                receiver.start()
+            while os.getppid() == parent_pid:
+                time.sleep(PARENT_CHECK)
+    finally:
+        if gcguard:
+            gcguard.report()
+        if realtime:
+            realtime.report()
+    # main process has gone (it didn't get a chance to stop us)
+    sys.exit(0)
+
+class HardwareWorker:
+    """ HardwareWorker()
+
+    :param receiver_settings: list of (name, ES100 keyword arguments)
+    :param receiver_options: Receiver keyword arguments (tracking, nighttime, location, masl and realtime)
+    :param slots: Ring size (records)
+    :param gc_lead: Run a GCGuard (with this lead in seconds) in the hardware process; None for no guard
+    :param log_format: logging format for the hardware process
+    :param debug: True to enable debug messages
+    :param verbose: True to enable verbose messages
+    :return: New instance of HardwareWorker()
+
+    get() has the same signature as queue.Queue.get(); hence the main loop reads it like the receiver queue.
+    """
+
+    def __init__(self, receiver_settings, receiver_options, slots=DEFAULT_RING_SLOTS, gc_lead=None, log_format=None, debug=False, verbose=False):
+        """ :meta private: """
+
+        self._ring = None
+        self._process = None
+
+        self._receiver_settings = receiver_settings
+        self._receiver_options = receiver_options
+        self._names = [name for (name, _) in receiver_settings]
+        self._slots = slots
+        self._gc_lead = gc_lead
+        self._log_format = log_format
+
+        self._log = logging.getLogger(__class__.__name__)
+        self._debug = debug
+        if self._debug:
+            self._log.setLevel(logging.DEBUG)
+        self._verbose = verbose
+        if self._verbose:
+            self._log.setLevel(logging.INFO)
+
+    def __str__(self):
+        """ __str__ """
+        pid = self._process.pid if self._process else None
+        return '[hardware process %s via %s]' % (pid, self._ring)
+
+    def start(self):
+        """ start() """
+        context = multiprocessing.get_context('spawn')
+        (wake_r, wake_w) = context.Pipe(duplex=False)
+        try:
+            self._ring = Ring(self._names, wake_r, self._slots, debug=self._debug, verbose=self._verbose)
+        except RingError as err:
+            raise WorkerError(str(err)) from err
+        self._process = context.Process(
+                                target=_hardware_main,
+                                name='hardware',
+                                args=(self._ring.name(), wake_w, self._names, self._receiver_settings, self._receiver_options,
+                                        self._gc_lead, os.getpid(), self._log_format, self._debug, self._verbose),
+                                daemon=True
+                            )
+        self._process.start()
+        # only the hardware process writes
+        wake_w.close()
+        self._log.info('hardware started: %s', self)
+
+    def stop(self):
+        """ stop() """
+        if self._process is not None:
+            if self._process.is_alive():
+                self._process.terminate()
+            self._process.join(PARENT_CHECK)
+            self._process = None
+        if self._ring is not None:
+            self._ring.close()
+            self._ring = None
+
+    def lost(self):
+        """ lost() - records the main process didn't read in time """
+        return self._ring.lost() if self._ring else 0
+
+    def get(self, timeout=None):
+        """ get()
+
+        :param timeout: Seconds to wait (None waits forever)
+        :return: Reception instance
+        :raises queue.Empty: If there's nothing within the timeout
+        :raises WorkerError: If the hardware process has exited
+        """
+        try:
+            return self._ring.get(timeout, self._process.sentinel)
+        except RingError as err:
+            self._process.join(PARENT_CHECK)
+            raise WorkerError('hardware process exited (%s)' % (self._process.exitcode)) from err
+
+def _recorder_main(entries, journal_path, journal_options, history_path, log_format, debug, verbose):
+    """ _recorder_main """
+    _child_setup(log_format, debug, verbose)
+    log = logging.getLogger('recorder')
+
+    recorders = []
+    try:
+        if journal_path:
+            try:
+                recorders.append(Journal(path=journal_path, debug=debug, verbose=verbose, **journal_options))
+            except JournalError as err:
+                log.warning('failed to open journal (%s), continuing anyway', err)
+        if history_path:
+            try:
+                recorders.append(HistoryDB(path=history_path, debug=debug, verbose=verbose))
+            except HistoryDBError as err:
+                log.warning('failed to open history (%s), continuing anyway', err)
+        log.info('recorder process %d: %s', os.getpid(), ', '.join([str(recorder) for recorder in recorders]))
+
+        while True:
+            entry = entries.get()
+            if entry is None:
+                break
+            for recorder in recorders:
+                recorder.write(entry)
+    finally:
+        for recorder in recorders:
+            recorder.close()
+
+class RecorderWorker:
+    """ RecorderWorker()
+
+    :param journal_path: Journal file (or None)
+    :param journal_options: Journal keyword arguments
+    :param history_path: SQLite history file (or None)
+    :param log_format: logging format for the recorder process
+    :param debug: True to enable debug messages
+    :param verbose: True to enable verbose messages
+    :return: New instance of RecorderWorker()
+
+    Looks like a Journal or HistoryDB to record_attempt(); entries are pickled over to the recorder process.
+    """
+
+    def __init__(self, journal_path=None, journal_options=None, history_path=None, log_format=None, debug=False, verbose=False):
+        """ :meta private: """
+
+        self._process = None
+        self._entries = None
+
+        self._journal_path = journal_path
+        self._journal_options = journal_options or {}
+        self._history_path = history_path
+        self._log_format = log_format
+
+        self._log = logging.getLogger(__class__.__name__)
+        self._debug = debug
+        if self._debug:
+            self._log.setLevel(logging.DEBUG)
+        self._verbose = verbose
+        if self._verbose:
+            self._log.setLevel(logging.INFO)
+
+    def __str__(self):
+        """ __str__ """
+        pid = self._process.pid if self._process else None
+        return '[recorder process %s %s %s]' % (pid, self._journal_path, self._history_path)
+
+    def start(self):
+        """ start() """
+        context = multiprocessing.get_context('spawn')
+        self._entries = context.Queue()
+        self._process = context.Process(
+                                target=_recorder_main,
+                                name='recorder',
+                                args=(self._entries, self._journal_path, self._journal_options, self._history_path,
+                                        self._log_format, self._debug, self._verbose),
+                                daemon=True
+                            )
+        self._process.start()
+        self._log.info('recorder started: %s', self)
+
+    def write(self, entry):
+        """ write()
+
+        :param entry: dict from journal_entry()
+
+        Never blocks; the queue's feeder thread does the pipe writes
+        """
+        if self._process is None:
+            return
+        self._entries.put(entry)
+
+    def close(self):
+        """ close()
+
+        Whatever is queued is written (and the files closed) before the recorder process exits
+        """
+        if self._process is None:
+            return
+        self._entries.put(None)
+        self._entries.close()
+        self._process.join(RECORDER_CLOSE)
+        if self._process.is_alive():
+            self._log.warning('%s: did not exit; stopping it', self)
+            self._process.terminate()
+        self._process = None
@@ -12,17 +12,40 @@ Copyright (C) 2023 Martin J Levy - W6LHI/G8LHI - @mahtin - https://github.com/ma
 import os
 import sys
 import time
+import atexit
 import logging
 import signal
 import getopt
+import queue
 import platform
+import functools
 from datetime import timedelta
 
 from es100 import ES100, ES100Error, __version__
-from .misc import convert_location, caculate_latency, is_it_nighttime
-from .config import readconfig
+from es100 import trace
+from es100.clockstep import ClockStep, DEFAULT_CLOCK_STEP
+from .misc import convert_location, caculate_latency
+from .config import readconfig, config_list, DEFAULT_RECEIVER_NAME
 
-from .ntpdriver28 import NTPDriver28, NTPDriver28Error
+from .ntpdriver28 import NTPDriver28, NTPDriver28Error, NTPSample, datetime_to_ns
+from .chronysock import ChronySOCK, ChronySOCKError
+from .sinks import Sinks
+from .pipeline import Pipeline
+from .precision import PrecisionEstimator
+from .receiver import Receiver
+from .fusion import Fusion
+from .fixserver import FixServer, FixServerError, query
+from .fixshm import FixSHM, FixSHMError
+from .fleet import FleetSender, FleetError, collect
+from .workers import HardwareWorker, RecorderWorker, WorkerError
+from .realtime import RealtimeProfile, RealtimeError, parse_cpus, DEFAULT_PRIORITY, DEFAULT_PREFAULT
+from .gcguard import GCGuard, GCGuardError, DEFAULT_LEAD
+from .metrics import Metrics, MetricsError, DEFAULT_METRICS_ADDRESS
+from .journal import Journal, JournalError, journal_entry
+from .historydb import HistoryDB, HistoryDBError
+from .stats import stats
+from .report import report
+from .scan import scan
 
 # ES100's pins as connected to Raspberry Pi GPIO pins
 
@@ -57,8 +80,33 @@ def doit(program_name, args):
     flag_enable_nighttime = False
     flag_force_tracking = False
     antenna_choice = None
-    ntpd_unit_number = None
+    ntpd_units = []
+    ntpd_mode = 1
+    chrony_sockets = []
+    cli_ntpd_units = []
+    cli_chrony_sockets = []
+    chrony_time_bits = None
     flag_gpiod = False
+    metrics_port = None
+    metrics_address = DEFAULT_METRICS_ADDRESS
+    journal_path = None
+    journal_options = {}
+    history_path = None
+    trace_filename = None
+    receiver_names = []
+    socket_path = None
+    fixshm_path = None
+    fleet_address = None
+    fleet_site = None
+    flag_processes = False
+    flag_realtime = False
+    realtime_priority = DEFAULT_PRIORITY
+    realtime_cpus = None
+    realtime_lock_memory = True
+    realtime_prefault = DEFAULT_PREFAULT
+    flag_gc_guard = False
+    gc_lead = DEFAULT_LEAD
+    clock_step = DEFAULT_CLOCK_STEP
 
     # needed within this and other modules
     required_format = '%(asctime)s %(name)s %(levelname)s %(message)s'
@@ -79,7 +127,18 @@ def doit(program_name, args):
                                 '[-t|--tracking]',
                                 '[-A|--antenna={0-1}]',
                                 '[-N|--ntpd={0-255}]',
+                                '[-C|--chrony=socket-path]',
                                 '[-G|--gpiod]',
+                                '[-M|--metrics=port]',
+                                '[-J|--journal=path]',
+                                '[-H|--history=path]',
+                                '[-T|--trace=filename]',
+                                '[-S|--socket=path]',
+                                '[-F|--fixshm=path]',
+                                '[-R|--fleet=host:port]',
+                                '[-P|--processes]',
+                                '[-r|--realtime]',
+                                '[-g|--gcguard]',
                             ])
 
     # we set defaults from config file - so that command line can override
@@ -105,18 +164,65 @@ def doit(program_name, args):
         flag_enable_nighttime = config['wwvb.nighttime']
     if 'wwvb.tracking' in config:
         flag_enable_nighttime = config['wwvb.tracking']
+    if 'wwvb.clock_step' in config and config['wwvb.clock_step'] is not None:
+        clock_step = config['wwvb.clock_step']
     if 'debug.debug' in config:
         flag_debug = config['debug.debug']
     if 'debug.verbose' in config:
         flag_verbose = config['debug.verbose']
     if 'ntpd.unit' in config:
-        ntpd_unit_number = config['ntpd.unit']
+        # one or more units, comma separated
+        ntpd_units = config_list(config['ntpd.unit'])
+    if 'ntpd.mode' in config and config['ntpd.mode'] is not None:
+        ntpd_mode = config['ntpd.mode']
+    if 'chrony.socket' in config:
+        # one or more sockets, comma separated
+        chrony_sockets = config_list(config['chrony.socket'])
+    if 'chrony.time_bits' in config:
+        chrony_time_bits = config['chrony.time_bits']
     if 'wwvb.gpiod' in config:
         flag_gpiod = config['wwvb.gpiod']
+    if 'metrics.port' in config:
+        metrics_port = config['metrics.port']
+    if 'metrics.address' in config and config['metrics.address'] is not None:
+        metrics_address = config['metrics.address']
+    if 'journal.path' in config:
+        journal_path = config['journal.path']
+    for option in ['max_bytes', 'max_age', 'backups', 'fsync_interval']:
+        if 'journal.' + option in config and config['journal.' + option] is not None:
+            journal_options[option] = config['journal.' + option]
+    if 'history.path' in config:
+        history_path = config['history.path']
+    if 'wwvb.receivers' in config:
+        receiver_names = config_list(config['wwvb.receivers'])
+    if 'daemon.socket' in config:
+        socket_path = config['daemon.socket']
+    if 'daemon.fixshm' in config:
+        fixshm_path = config['daemon.fixshm']
+    if 'fleet.collector' in config:
+        fleet_address = config['fleet.collector']
+    if 'fleet.site' in config:
+        fleet_site = config['fleet.site']
+    if 'daemon.processes' in config:
+        flag_processes = config['daemon.processes']
+    if 'realtime.enabled' in config:
+        flag_realtime = config['realtime.enabled']
+    if 'realtime.priority' in config and config['realtime.priority'] is not None:
+        realtime_priority = config['realtime.priority']
+    if 'realtime.cpus' in config:
+        realtime_cpus = config['realtime.cpus']
+    if 'realtime.lock_memory' in config:
+        realtime_lock_memory = config['realtime.lock_memory']
+    if 'realtime.prefault' in config and config['realtime.prefault'] is not None:
+        realtime_prefault = config['realtime.prefault']
+    if 'realtime.gc_guard' in config:
+        flag_gc_guard = config['realtime.gc_guard']
+    if 'realtime.gc_lead' in config and config['realtime.gc_lead'] is not None:
+        gc_lead = config['realtime.gc_lead']
 
     try:
         opts, args = getopt.getopt(args,
-                                    'Vhvdb:a:i:e:l:m:ntAN:G',
+                                    'Vhvdb:a:i:e:l:m:ntAN:C:GM:J:H:T:S:F:R:Prg',
                                     [
                                         'version',
                                         'help',
@@ -133,7 +239,18 @@ def doit(program_name, args):
                                         'tracking',
                                         'antenna',
                                         'ntpd=',
+                                        'chrony=',
                                         'gpiod',
+                                        'metrics=',
+                                        'journal=',
+                                        'history=',
+                                        'trace=',
+                                        'socket=',
+                                        'fixshm=',
+                                        'fleet=',
+                                        'processes',
+                                        'realtime',
+                                        'gcguard',
                                     ])
     except getopt.GetoptError:
         sys.exit('usage: ' + usage)
@@ -215,19 +332,104 @@ def doit(program_name, args):
                 ntpd_unit_number = int(arg)
                 if not 0 <= ntpd_unit_number < 256:
                     raise ValueError
+                # can be repeated
+                cli_ntpd_units.append(ntpd_unit_number)
             except ValueError:
                 print("%s %s" % (program_name, 'invalid ntpd unit number'), file=sys.stderr)
                 sys.exit('usage: ' + usage)
             continue
+        if opt in ('-C', '--chrony'):
+            if len(arg) == 0:
+                print("%s %s" % (program_name, 'invalid chrony socket path'), file=sys.stderr)
+                sys.exit('usage: ' + usage)
+            # can be repeated
+            cli_chrony_sockets.append(arg)
+            continue
         if opt in ('-G', '--gpiod'):
             flag_gpiod = True
             if es100_irq == RPI_DEFAULT_GPIO_IRQ or es100_en == RPI_DEFAULT_GPIO_EN:
                 print("%s %s" % (program_name, 'gpiod based boards requires irq/en pin selection'), file=sys.stderr)
                 sys.exit('usage: ' + usage)
             continue
+        if opt in ('-M', '--metrics'):
+            try:
+                metrics_port = int(arg)
+                if not 0 < metrics_port < 65536:
+                    raise ValueError
+            except ValueError:
+                print("%s %s" % (program_name, 'invalid metrics port'), file=sys.stderr)
+                sys.exit('usage: ' + usage)
+            continue
+        if opt in ('-J', '--journal'):
+            if len(arg) == 0:
+                print("%s %s" % (program_name, 'invalid journal path'), file=sys.stderr)
+                sys.exit('usage: ' + usage)
+            journal_path = arg
+            continue
+        if opt in ('-H', '--history'):
+            if len(arg) == 0:
+                print("%s %s" % (program_name, 'invalid history path'), file=sys.stderr)
+                sys.exit('usage: ' + usage)
+            history_path = arg
+            continue
+        if opt in ('-T', '--trace'):
+            if len(arg) == 0:
+                print("%s %s" % (program_name, 'invalid trace filename'), file=sys.stderr)
+                sys.exit('usage: ' + usage)
+            trace_filename = arg
+            continue
+        if opt in ('-S', '--socket'):
+            if len(arg) == 0:
+                print("%s %s" % (program_name, 'invalid socket path'), file=sys.stderr)
+                sys.exit('usage: ' + usage)
+            socket_path = arg
+            continue
+        if opt in ('-F', '--fixshm'):
+            if len(arg) == 0:
+                print("%s %s" % (program_name, 'invalid fixshm path'), file=sys.stderr)
+                sys.exit('usage: ' + usage)
+            fixshm_path = arg
+            continue
+        if opt in ('-R', '--fleet'):
+            if len(arg) == 0:
+                print("%s %s" % (program_name, 'invalid fleet collector address'), file=sys.stderr)
+                sys.exit('usage: ' + usage)
+            fleet_address = arg
+            continue
+        if opt in ('-P', '--processes'):
+            flag_processes = True
+            continue
+        if opt in ('-r', '--realtime'):
+            flag_realtime = True
+            continue
+        if opt in ('-g', '--gcguard'):
+            flag_gc_guard = True
+            continue
+
+    # command line sinks replace (not add to) the config file ones
+    if len(cli_ntpd_units) > 0:
+        ntpd_units = cli_ntpd_units
+    if len(cli_chrony_sockets) > 0:
+        chrony_sockets = cli_chrony_sockets
 
-    if not is_i2c_bus_valid(i2c_bus):
-        print("%s %s" % (program_name, 'i2c bus number not present on system'), file=sys.stderr)
+    # [WWVB] (plus command line) values are the defaults for every receiver section
+    default_settings = {
+        'bus': i2c_bus,
+        'address': i2c_address,
+        'irq': es100_irq,
+        'en': es100_en,
+        'antenna': antenna_choice,
+        'use_gpiod': flag_gpiod,
+        'clock_step': clock_step,
+    }
+    receiver_settings = build_receiver_settings(config, receiver_names, default_settings)
+
+    for (receiver_name, settings) in receiver_settings:
+        if not is_i2c_bus_valid(settings['bus']):
+            print("%s %s: %s" % (program_name, receiver_name, 'i2c bus number not present on system'), file=sys.stderr)
+            sys.exit('usage: ' + usage)
+    if len(set([(settings['bus'], settings['address']) for (_, settings) in receiver_settings])) != len(receiver_settings):
+        print("%s %s" % (program_name, 'receivers must each have their own i2c bus/address'), file=sys.stderr)
         sys.exit('usage: ' + usage)
 
     log = logging.getLogger(program_name)
@@ -236,6 +438,13 @@ def doit(program_name, args):
     if flag_verbose:
         log.setLevel(logging.INFO)
 
+    if trace_filename:
+        # every span (es100, gpio, i2c, ntpd28, chrony) is kept and written out on exit
+        tracer = trace.ChromeTrace()
+        trace.add_callback(tracer)
+        atexit.register(tracer.dump, trace_filename)
+        log.info('trace will be written to: %s' % (trace_filename))
+
     (distance_km, bearing, latency_secs) = caculate_latency(our_location[0], our_location[1])
 
     log.info('The great circle distance to WWVB: %.1f Km and ' +
@@ -247,134 +456,586 @@ def doit(program_name, args):
             )
 
     our_latency = timedelta(microseconds=latency_secs*1000000.0)
+    our_latency_ns = int(latency_secs * 1000000000.0)
 
+    # A clock step between a receiver's IRQ and here (i.e. while queued) is taken back out of the reception
     try:
-        es100 = ES100(antenna=antenna_choice, irq=es100_irq, en=es100_en, bus=i2c_bus, address=i2c_address, use_gpiod=flag_gpiod, debug=flag_debug, verbose=flag_verbose)
-    except ES100Error as err:
-        sys.exit(err)
+        clock = ClockStep(clock_step)
+    except (ValueError, TypeError) as err:
+        print("%s %s: %s" % (program_name, 'invalid clock_step', err), file=sys.stderr)
+        sys.exit('usage: ' + usage)
 
-    # If we are talking to NTPD, now's the time to set that up.
-    if ntpd_unit_number is not None:
+    # Optional real-time profile for whichever thread(s) wait on the ES100 IRQ
+    realtime = None
+    if flag_realtime:
         try:
-            driver28 = NTPDriver28(unit=ntpd_unit_number, debug=flag_debug, verbose=flag_verbose)
-            log.info('ntpd connected via: %s' % (driver28))
-        except NTPDriver28Error as err:
-            log.warning('failed to connect to ntpd, continuing anyway')
-            ntpd_unit_number = None
-            driver28 = None
+            realtime = RealtimeProfile(
+                                priority=realtime_priority,
+                                cpus=parse_cpus(realtime_cpus) if realtime_cpus else None,
+                                lock_memory=realtime_lock_memory,
+                                prefault=realtime_prefault,
+                                debug=flag_debug,
+                                verbose=flag_verbose
+                        )
+        except (RealtimeError, TypeError) as err:
+            print("%s %s: %s" % (program_name, 'invalid realtime settings', err), file=sys.stderr)
+            sys.exit('usage: ' + usage)
+        log.info('realtime profile: %s', realtime)
+
+    # Optional guard that keeps garbage collection away from the IRQ timestamp
+    gcguard = None
+    if flag_gc_guard and not flag_processes:
+        try:
+            gcguard = GCGuard(lead=gc_lead, debug=flag_debug, verbose=flag_verbose)
+        except (GCGuardError, TypeError) as err:
+            print("%s %s: %s" % (program_name, 'invalid gc guard settings', err), file=sys.stderr)
+            sys.exit('usage: ' + usage)
+
+    # One receiver; or several (each with its own i2c bus/address and GPIO pins) listed in wwvb.ini
+    receiver_options = {
+        'flag_force_tracking': flag_force_tracking,
+        'flag_enable_nighttime': flag_enable_nighttime,
+        'our_location': our_location,
+        'our_masl': our_masl,
+        'realtime': realtime,
+    }
+    receivers = []
+    results = queue.Queue()
+    hardware = None
+    if flag_processes:
+        # the ES100(s) are only touched by the hardware process; receptions arrive via a shared memory ring
+        hardware = HardwareWorker(receiver_settings, receiver_options, gc_lead=gc_lead if flag_gc_guard else None,
+                                    log_format=required_format, debug=flag_debug, verbose=flag_verbose)
+        if trace_filename:
+            log.warning('es100 spans are in the hardware process; they are not traced')
     else:
-        driver28 = None
+        receivers = build_receivers(receiver_settings, receiver_options, results, gcguard, flag_debug, flag_verbose)
 
-    # All set. Let's start receiving till the end of time
+    # With more than one receiver, full receptions are voted on before publishing
+    fusion = None
+    if len(receiver_settings) > 1:
+        fusion = Fusion(debug=flag_debug, verbose=flag_verbose)
+        log.info('receivers: %s via %s', ', '.join([receiver_name for (receiver_name, _) in receiver_settings]), fusion)
 
-    while True:
-        received_dt = receive(es100, log, flag_force_tracking, flag_enable_nighttime, our_location, our_masl)
-        if not received_dt:
-            continue
+    # The precision we advertise is based on measured jitter; which depends on how we received
+    precision = PrecisionEstimator(debug=flag_debug, verbose=flag_verbose)
 
-        # by default WWVB has microsecond == 0 (as it's not in the receive frames)
+    # If we are talking to NTPD and/or chronyd, now's the time to set that up.
+    # Every fix is published to all of them.
+    sinks = build_sinks(log, ntpd_units, ntpd_mode, chrony_sockets, chrony_time_bits, flag_debug, flag_verbose)
 
-        # Remember that our_latency we caculated based on our location?
-        # We now add it into the time received time to correct for our location
-        received_dt += our_latency
+    # Everything after a reception (sinks, consumers, metrics, recording, output) runs as pipeline stages
+    pipeline = Pipeline(debug=flag_debug, verbose=flag_verbose)
 
-        sys_received_dt = es100.system_time()
-        if received_dt.year == 1 and received_dt.month == 1 and received_dt.day == 1:
-            # tracking result with only seconnd and microsecond being accurate
-            log.info('Time received (seconds only): HH:MM:%02d.%03d at %s',
-                        received_dt.second,
-                        int(received_dt.microsecond / 1000),
-                        sys_received_dt
-                    )
-            print('WWVB: (tracking) HH:MM:%02d.%03d at %s' % (
-                        received_dt.second,
-                        int(received_dt.microsecond / 1000),
-                        sys_received_dt
-                    ))
-            sys.stdout.flush()
-            continue
+    # Optional Prometheus metrics; served from a background thread
+    metrics = None
+    if metrics_port:
+        metrics = build_metrics(log, metrics_port, metrics_address, sinks, pipeline,
+                                    None if flag_processes else realtime, gcguard, flag_debug, flag_verbose)
 
-        delta_seconds = es100.delta_seconds()
-        rx_antenna = es100.rx_antenna()
+    # Optional records of every reception attempt (journal file and/or SQLite history)
+    recorders = build_recorders(log, journal_path, journal_options, history_path, flag_processes, required_format, flag_debug, flag_verbose)
 
-        if driver28:
-            leap_second = es100.leap_second()
-            update_ntpd(driver28, log, received_dt, sys_received_dt, leap_second)
+    # Optional local consumers of the latest fix; a memory mapped file and/or a Unix domain socket
+    consumers = build_consumers(log, fixshm_path, socket_path, fleet_address, fleet_site, our_latency_ns, flag_debug, flag_verbose)
 
-        log.info('Reception of %s at system time %s with difference %.3f via %s',
-                                received_dt,
-                                sys_received_dt,
-                                delta_seconds,
-                                rx_antenna
-                        )
+    # Each of the above is a pipeline stage
+    build_pipeline(pipeline, log, sinks, consumers, metrics, recorders, gcguard)
 
-        print('WWVB: %s at %s' % (received_dt, sys_received_dt))
-        sys.stdout.flush()
+    # All set. Let's start receiving till the end of time
+
+    source = start_receivers(hardware, receivers, results, fusion, gcguard, realtime)
+    publishing = len(sinks) > 0 or fusion is not None or len(consumers) > 0
+
+    while True:
+        if source is None:
+            reception = receivers[0].receive_once()
+        else:
+            try:
+                reception = source.get(timeout=fusion.timeout(time.time_ns()) if fusion else None)
+            except queue.Empty:
+                reception = None
+            except WorkerError as err:
+                sys.exit('hardware: %s' % (err))
+            if fusion:
+                publish_decision(pipeline, log, fusion.ready(time.time_ns()))
+            if reception is None:
+                continue
+        handle_reception(pipeline, log, reception, clock, precision, fusion, publishing, our_latency, our_latency_ns)
 
     # not reached
 
-previous_nighttime = None
+def build_receiver_settings(config, receiver_names, default_settings):
+    """ build_receiver_settings()
 
-def receive(es100, log, flag_force_tracking, flag_enable_nighttime, our_location, our_masl):
-    """ receive()
+    :param config: dict from readconfig()
+    :param receiver_names: Receiver section names from [WWVB] receivers (or an empty list)
+    :param default_settings: ES100() arguments from [WWVB] and the command line
+    :return: list of (receiver name, ES100() arguments)
 
-    :param es100: The previously opened instance used to talk with the ES100-MOD
-    :param log: Standard Python logging instance
-    :param flag_force_tracking: A flag used to run the ES100-MODE in trackmode all the time (Default is False)
-    :param flag_enable_nighttime: A flag used to produce compluted nighttime/daytime.  Such that the  ES100-MODE can swap between daytime tracking and nighttime reception.  (Default is False)
-    :param our_location [lat, lon]: Receivers location. Negative lat and lon is South and West.
-    :param our_masl: Receivers MASL (Meters Above Sea Level)
+    Any value missing from a receiver's section comes from default_settings
+    """
+    receiver_settings = []
+    if len(receiver_names) == 0:
+        receiver_settings.append((DEFAULT_RECEIVER_NAME, default_settings))
+    for receiver_name in receiver_names:
+        settings = dict(default_settings)
+        for option in ['bus', 'address', 'irq', 'en', 'antenna']:
+            if config.get(receiver_name.lower() + '.' + option) is not None:
+                settings[option] = config[receiver_name.lower() + '.' + option]
+        if receiver_name.lower() + '.gpiod' in config:
+            settings['use_gpiod'] = config[receiver_name.lower() + '.gpiod']
+        receiver_settings.append((receiver_name, settings))
+    return receiver_settings
 
-    :return: The received date and time as datetime.datetime
+def build_receivers(receiver_settings, receiver_options, results, gcguard=None, debug=False, verbose=False):
+    """ build_receivers()
 
-    Setup everything to receive the date and time.
+    :param receiver_settings: list of (receiver name, ES100() arguments)
+    :param receiver_options: Receiver() arguments shared by every receiver
+    :param results: queue.Queue each Receiver() thread puts its receptions on
+    :param gcguard: GCGuard instance (or None)
+    :param debug: True to enable debug messages
+    :param verbose: True to enable verbose messages
+    :return: list of Receiver instances (in this process)
     """
+    receivers = []
+    for (receiver_name, settings) in receiver_settings:
+        try:
+            es100 = ES100(guard=gcguard, debug=debug, verbose=verbose, **settings)
+        except ES100Error as err:
+            sys.exit('%s: %s' % (receiver_name, err))
+        receivers.append(Receiver(receiver_name, es100, results, debug=debug, verbose=verbose, **receiver_options))
+    return receivers
 
-    global previous_nighttime
+def build_sinks(log, ntpd_units, ntpd_mode, chrony_sockets, chrony_time_bits=None, debug=False, verbose=False):
+    """ build_sinks()
 
-    if flag_force_tracking:
-        # Always do tracking (ignore nighttime flag)
-        new_tracking_flag = True
-        log.info('Reception starting (tracking forced on)')
-    else:
-        if flag_enable_nighttime:
-            if  is_it_nighttime(our_location[0], our_location[1], our_masl):
-                # nighttime
-                new_tracking_flag = False
-                if previous_nighttime is not True:
-                    log.info('Nighttime in-progress (Reception starting)')
-                previous_nighttime = True
-            else:
-                # daytime
-                new_tracking_flag = True
-                if previous_nighttime is not False:
-                    log.info('Daytime in-progress (Tracking starting)')
-                previous_nighttime = False
-        else:
-            # Don't care about nighttime/daytime; always receive
-            new_tracking_flag = False
-            log.info('Reception starting')
+    :param log: logging instance
+    :param ntpd_units: ntpd shared memory unit numbers
+    :param ntpd_mode: ntpd shared memory mode (0 or 1)
+    :param chrony_sockets: chronyd SOCK refclock paths
+    :param chrony_time_bits: Size of chronyd's time_t (or None)
+    :param debug: True to enable debug messages
+    :param verbose: True to enable verbose messages
+    :return: Sinks instance; a sink that fails to connect is logged and left out
+    """
+    sinks = Sinks(debug=debug, verbose=verbose)
 
+    for ntpd_unit_number in ntpd_units:
+        try:
+            driver28 = NTPDriver28(unit=ntpd_unit_number, debug=debug, verbose=verbose, mode=ntpd_mode)
+            log.info('ntpd connected via: %s' % (driver28))
+            sinks.add(driver28)
+        except NTPDriver28Error as err:
+            log.warning('failed to connect to ntpd unit %s (%s), continuing anyway', ntpd_unit_number, err)
+
+    for chrony_socket in chrony_sockets:
+        try:
+            chronysock = ChronySOCK(path=chrony_socket, time_bits=chrony_time_bits, debug=debug, verbose=verbose)
+            log.info('chronyd connected via: %s' % (chronysock))
+            sinks.add(chronysock)
+        except ChronySOCKError as err:
+            log.warning('failed to connect to chronyd %s (%s), continuing anyway', chrony_socket, err)
+
+    return sinks
+
+def build_metrics(log, port, address, sinks, pipeline, realtime=None, gcguard=None, debug=False, verbose=False):
+    """ build_metrics()
+
+    :param log: logging instance
+    :param port: TCP port to serve /metrics on
+    :param address: Address to listen on
+    :param sinks: Sinks instance
+    :param pipeline: Pipeline instance
+    :param realtime: RealtimeProfile instance in this process (or None)
+    :param gcguard: GCGuard instance (or None)
+    :param debug: True to enable debug messages
+    :param verbose: True to enable verbose messages
+    :return: Metrics instance (already serving) or None if it couldn't be started
+    """
+    metrics = Metrics(sinks=sinks, pipeline=pipeline, realtime=realtime, gcguard=gcguard, debug=debug, verbose=verbose)
     try:
-        received_dt = es100.time(tracking=new_tracking_flag)
-    except (ES100Error, OSError):
+        metrics.start(port, address)
+    except MetricsError as err:
+        log.warning('failed to start metrics (%s), continuing anyway', err)
         return None
+    log.info('metrics served via: %s' % (metrics))
+    return metrics
 
-    return received_dt
+def build_recorders(log, journal_path, journal_options, history_path, processes=False, log_format=None, debug=False, verbose=False):
+    """ build_recorders()
+
+    :param log: logging instance
+    :param journal_path: Journal file name (or None)
+    :param journal_options: Journal() arguments from [JOURNAL]
+    :param history_path: SQLite history file name (or None)
+    :param processes: True to write both from their own process
+    :param log_format: Logging format for that process
+    :param debug: True to enable debug messages
+    :param verbose: True to enable verbose messages
+    :return: list of Journal, HistoryDB and/or RecorderWorker instances; one that fails to open is logged and left out
+    """
+    recorders = []
+    if processes and (journal_path or history_path):
+        # written from their own process; the files are opened (and errors logged) there
+        recorder = RecorderWorker(journal_path=journal_path, journal_options=journal_options, history_path=history_path,
+                                    log_format=log_format, debug=debug, verbose=verbose)
+        recorder.start()
+        log.info('journal/history written by: %s' % (recorder))
+        atexit.register(recorder.close)
+        recorders.append(recorder)
+        return recorders
+    if journal_path:
+        try:
+            journal = Journal(path=journal_path, debug=debug, verbose=verbose, **journal_options)
+            log.info('journal written to: %s' % (journal))
+            # exit is via a signal and sys.exit(); commit whatever is waiting
+            atexit.register(journal.close)
+            recorders.append(journal)
+        except JournalError as err:
+            log.warning('failed to open journal (%s), continuing anyway', err)
+    if history_path:
+        try:
+            history = HistoryDB(path=history_path, debug=debug, verbose=verbose)
+            log.info('history written to: %s' % (history))
+            atexit.register(history.close)
+            recorders.append(history)
+        except HistoryDBError as err:
+            log.warning('failed to open history (%s), continuing anyway', err)
+    return recorders
 
-def update_ntpd(driver28, log, received_dt, sys_received_dt, leap_second):
-    """ update_ntpd()
+def build_consumers(log, fixshm_path, socket_path, fleet_address, fleet_site, latency_ns, debug=False, verbose=False):
+    """ build_consumers()
 
-    :param driver28: shared memory instance
     :param log: logging instance
-    :param received_dt: date and time just received from WWVB
-    :param sys_received_dt: date and time of system when date and time was received
-    :param leap_second: leap second indication
+    :param fixshm_path: Fix shm file name (or None)
+    :param socket_path: Fix server Unix domain socket path (or None)
+    :param fleet_address: Fleet collector host:port (or None)
+    :param fleet_site: Site name sent to the fleet collector (or None)
+    :param latency_ns: Our latency from WWVB in nanoseconds
+    :param debug: True to enable debug messages
+    :param verbose: True to enable verbose messages
+    :return: list of consumers of the latest fix (each has update()); one that fails to start is logged and left out
+    """
+    consumers = []
+    if fixshm_path:
+        try:
+            fixshm = FixSHM(path=fixshm_path, debug=debug, verbose=verbose)
+            log.info('fixes written to: %s' % (fixshm))
+            consumers.append(fixshm)
+        except FixSHMError as err:
+            log.warning('failed to open fix shm (%s), continuing anyway', err)
+    if socket_path:
+        fixserver = FixServer(path=socket_path, debug=debug, verbose=verbose)
+        try:
+            fixserver.start()
+            log.info('fixes served via: %s' % (fixserver))
+            atexit.register(fixserver.stop)
+            consumers.append(fixserver)
+        except FixServerError as err:
+            log.warning('failed to start fix server (%s), continuing anyway', err)
+    if fleet_address:
+        try:
+            fleet = FleetSender(address=fleet_address, site=fleet_site, latency_ns=latency_ns, debug=debug, verbose=verbose)
+            log.info('fixes sent to: %s' % (fleet))
+            consumers.append(fleet)
+        except FleetError as err:
+            log.warning('failed to start fleet sender (%s), continuing anyway', err)
+    return consumers
+
+def build_pipeline(pipeline, log, sinks, consumers, metrics=None, recorders=None, gcguard=None):
+    """ build_pipeline()
+
+    :param pipeline: Pipeline instance (not yet started)
+    :param log: logging instance
+    :param sinks: Sinks instance
+    :param consumers: list from build_consumers()
+    :param metrics: Metrics instance (or None)
+    :param recorders: list from build_recorders() (or None)
+    :param gcguard: GCGuard instance (or None)
+
+    Add a stage for each and start the pipeline
+    """
+    # the sinks go first; each stage has its own thread and queue, so the reception loop never waits
+    if len(sinks) > 0:
+        pipeline.add('ntp', functools.partial(publish_ntp, sinks, log, pipeline), fix=True)
+        # registered before pipeline.stop; hence it runs after the ntp stage has finished
+        atexit.register(sinks.report)
+    for consumer in consumers:
+        pipeline.add(str(consumer), consumer.update, fix=True)
+    if metrics:
+        pipeline.add('metrics', functools.partial(update_metrics, metrics))
+    if recorders:
+        pipeline.add('record', functools.partial(record_attempt, recorders))
+    pipeline.add('display', display)
+    if gcguard:
+        pipeline.add('gc', gcguard.collect)
+    pipeline.start()
+    # exit handlers run last registered first; hence the queues are finished before the recorders close
+    atexit.register(pipeline.stop)
+    log.info('pipeline: %s', pipeline)
+
+def start_receivers(hardware, receivers, results, fusion=None, gcguard=None, realtime=None):
+    """ start_receivers()
+
+    :param hardware: HardwareWorker instance (or None)
+    :param receivers: list of Receiver instances in this process (when there's no hardware process)
+    :param results: queue.Queue the Receiver threads put their receptions on
+    :param fusion: Fusion instance (or None)
+    :param gcguard: GCGuard instance (or None)
+    :param realtime: RealtimeProfile instance (or None)
+    :return: Where receptions come from (get()); None if the one receiver runs in this thread
+
+    Called last; after every other thread has started
+    """
+    if hardware:
+        try:
+            hardware.start()
+        except WorkerError as err:
+            sys.exit('hardware: %s' % (err))
+        atexit.register(hardware.stop)
+        return hardware
+    if gcguard:
+        # everything alive now is frozen; hence after every other setup
+        gcguard.start()
+        atexit.register(gcguard.report)
+    if realtime:
+        # every other thread is already running; hence only the receiver(s) (and the probe) get the profile
+        realtime.start()
+        realtime.shared_gil()
+        atexit.register(realtime.report)
+    if fusion:
+        # one thread per receiver; everything else (publishing, metrics, recording) stays in this thread
+        for receiver in receivers:
+            receiver.start()
+        return results
+    if realtime:
+        # the one receiver runs in this thread
+        realtime.apply_thread(receivers[0].name)
+    return None
+
+def handle_reception(pipeline, log, reception, clock, precision, fusion, publishing, our_latency, our_latency_ns):
+    """ handle_reception()
+
+    :param pipeline: Pipeline instance
+    :param log: logging instance
+    :param reception: Reception instance (from a receiver, the hardware process or the results queue)
+    :param clock: ClockStep instance
+    :param precision: PrecisionEstimator instance
+    :param fusion: Fusion instance (or None)
+    :param publishing: True if there's anywhere (sinks, fusion or consumers) for a sample to go
+    :param our_latency: Our latency from WWVB (timedelta)
+    :param our_latency_ns: Our latency from WWVB in nanoseconds
+
+    One pass of the reception loop; everything slow is handed to the pipeline
+    """
+    # the receiver's window has closed; the best time there is to collect garbage
+    pipeline.submit('gc', 'reception')
+
+    attempt = reception.attempt
+    if attempt:
+        pipeline.submit('metrics', 'attempt', attempt)
+    if reception.start_late_ns is not None:
+        pipeline.submit('metrics', 'deadline', reception.receiver, reception.start_late_ns)
+    received_dt = reception.received_dt
+    if not received_dt:
+        pipeline.submit('record', attempt, None, None)
+        return
+
+    # Only prefix the output with the receiver name if there's more than one
+    prefix = '%s: ' % (reception.receiver) if fusion else ''
+
+    if attempt and attempt['irq_monotonic_ns'] is not None:
+        step_ns = clock.since(reception.system_time_ns, attempt['irq_monotonic_ns'], time.time_ns(), time.monotonic_ns())
+        if step_ns:
+            log.warning('%ssystem clock stepped %+.6f seconds since the IRQ; reception restated', prefix, step_ns / 1000000000.0)
+            reception.restate(step_ns)
+            pipeline.submit('metrics', 'clock_step', reception.receiver, step_ns)
+    rx_antenna = reception.rx_antenna
+    precision_antenna = '%s.%s' % (reception.receiver, rx_antenna) if fusion else rx_antenna
+
+    # by default WWVB has microsecond == 0 (as it's not in the receive frames)
+
+    # Remember that our_latency we caculated based on our location?
+    # We now add it into the time received time to correct for our location
+    received_dt += our_latency
+
+    sys_received_dt = reception.system_time
+    if reception.tracking():
+        # tracking result with only seconnd and microsecond being accurate
+        # the offset is still useful for the jitter (hence precision) estimate
+        if attempt and attempt.get('clock_step_ns'):
+            # START was written at HH:MM:55 on the clock before the step; the result can't be trusted
+            log.warning('%stracking result ignored; system clock stepped %+.6f seconds after START',
+                            prefix, attempt['clock_step_ns'] / 1000000000.0)
+        else:
+            precision.add(('tracking', precision_antenna),
+                            tracking_offset(received_dt.second, our_latency_ns, reception.system_time_ns))
+        pipeline.submit('record', attempt, None, None)
+        log.info('%sTime received (seconds only): HH:MM:%02d.%03d at %s',
+                    prefix,
+                    received_dt.second,
+                    int(received_dt.microsecond / 1000),
+                    sys_received_dt
+                )
+        pipeline.submit('display', '%sWWVB: (tracking) HH:MM:%02d.%03d at %s' % (
+                    prefix,
+                    received_dt.second,
+                    int(received_dt.microsecond / 1000),
+                    sys_received_dt
+                ))
+        return
+
+    delta_seconds = reception.delta_seconds
+
+    sample = None
+    if publishing:
+        # nanoseconds all the way through - the datetime values are only microsecond/millisecond based
+        # the sample is computed once and then published to every sink
+        sample = NTPSample(
+                        datetime_to_ns(reception.wwvb_time) + our_latency_ns,
+                        reception.system_time_ns,
+                        reception.leap_second
+                    )
+        key = ('reception', precision_antenna)
+        precision.add(key, sample.offset)
+        # same antenna; hence tracking jitter stands in until there's enough receptions
+        sample.precision = precision.precision(key, fallback=('tracking', precision_antenna))
+
+    if fusion:
+        # published (and recorded) once the vote is done
+        publish_decision(pipeline, log, fusion.add(reception, sample))
+    elif sample:
+        publish_sample(pipeline, reception, sample)
+    else:
+        pipeline.submit('record', attempt, None, None)
+
+    log.info('%sReception of %s at system time %s with difference %.3f via %s',
+                            prefix,
+                            received_dt,
+                            sys_received_dt,
+                            delta_seconds,
+                            rx_antenna
+                    )
+
+    pipeline.submit('display', '%sWWVB: %s at %s' % (prefix, received_dt, sys_received_dt))
+
+def tracking_offset(wwvb_second, latency_ns, sys_received_ns):
+    """ tracking_offset()
+
+    :param wwvb_second: The second (0-59) heard during tracking
+    :param latency_ns: Our latency from WWVB in nanoseconds
+    :param sys_received_ns: System time when received in nanoseconds since the epoch
+    :return: Offset in seconds (WWVB minus system time) within -30 thru +30 seconds
+
+    Tracking only provides the second; hence the offset is worked out modulo one minute
+    """
+    minute_ns = 60 * 1000000000
+    offset_ns = (wwvb_second * 1000000000 + latency_ns - sys_received_ns) % minute_ns
+    if offset_ns >= minute_ns // 2:
+        offset_ns -= minute_ns
+    return offset_ns / 1000000000.0
+
+def update_sinks(sinks, log, sample):
+    """ update_sinks()
+
+    :param sinks: Sinks instance (ntpd shared memory units and/or chronyd sockets)
+    :param log: logging instance
+    :param sample: NTPSample instance just received from WWVB
+
+    Try to update NTPD and/or chronyd; a failing sink does not stop the others
+    """
+    log.info('NTPD/chronyd being updated: %s', sample)
+    start_ns = trace.begin()
+    count = sinks.publish(sample)
+    if start_ns:
+        trace.end('wwvb.update_sinks', start_ns, {'sinks': len(sinks), 'published': count})
+
+def publish_ntp(sinks, log, pipeline, reception, sample, votes=1, candidates=1):
+    """ publish_ntp()
+
+    :param sinks: Sinks instance
+    :param log: logging instance
+    :param pipeline: Pipeline instance
+    :param reception: Reception the sample came from
+    :param sample: NTPSample to publish
+    :param votes: Receivers that agreed with this sample
+    :param candidates: Receivers that had a fix for this minute
+
+    The "ntp" pipeline stage; the attempt is recorded here as only now is it known which sinks took the sample
+    """
+    update_sinks(sinks, log, sample)
+    pipeline.submit('metrics', 'published', time.time_ns() - sample.sys_received_ns, votes, candidates)
+    published = [sink_stats.sink for sink_stats in sinks.stats() if sink_stats.last_ok]
+    pipeline.submit('record', reception.attempt, sample, published)
+
+def publish_sample(pipeline, reception, sample, votes=1, candidates=1):
+    """ publish_sample()
+
+    :param pipeline: Pipeline instance
+    :param reception: Reception the sample came from
+    :param sample: NTPSample to publish
+    :param votes: Receivers that agreed with this sample
+    :param candidates: Receivers that had a fix for this minute
+    """
+    pipeline.publish(reception, sample, votes, candidates)
+    if 'ntp' not in pipeline:
+        # else recorded by publish_ntp()
+        pipeline.submit('record', reception.attempt, sample, None)
+
+def publish_decision(pipeline, log, decision):
+    """ publish_decision()
+
+    :param pipeline: Pipeline instance
+    :param log: logging instance
+    :param decision: list of fusion.Candidate after the vote (chosen first, if any) or an empty list
+
+    Only the chosen candidate is published; every candidate is recorded (unresolved ones included)
+    """
+    votes = len([candidate for candidate in decision if candidate.result in ('chosen', 'agreed')])
+    for candidate in decision:
+        if candidate.result == 'chosen':
+            log.info('%s chosen for this minute (%d of %d agree)', candidate.reception.receiver, votes, len(decision))
+            publish_sample(pipeline, candidate.reception, candidate.sample, votes, len(decision))
+        else:
+            pipeline.submit('record', candidate.reception.attempt, candidate.sample, None)
+        pipeline.submit('metrics', 'fused', candidate.reception.receiver, candidate.result)
+
+def update_metrics(metrics, method, *args):
+    """ update_metrics()
+
+    :param metrics: Metrics instance
+    :param method: Metrics method name (i.e. 'attempt')
+    :param args: Passed to that method
+
+    The "metrics" pipeline stage; hence Metrics still has a single writer
+    """
+    getattr(metrics, method)(*args)
+
+def display(line):
+    """ display()
+
+    :param line: Text for stdout
+
+    The "display" pipeline stage; a blocked stdout (i.e. a slow pipe) can't hold up reception
+    """
+    print(line)
+    sys.stdout.flush()
+
+def record_attempt(recorders, attempt, sample=None, published=None):
+    """ record_attempt()
 
-    Try to update NTPD via SHM
+    :param recorders: list of Journal and/or HistoryDB (or RecorderWorker) instances
+    :param attempt: dict from ES100.attempt() (or None if there wasn't a new attempt)
+    :param sample: NTPSample published (or None)
+    :param published: list of sinks successfully published to (or None)
     """
-    log.info('NTPD being updated: %s', received_dt)
-    driver28.update(received_dt, sys_received_dt, leap_second)
+    if not recorders or not attempt:
+        return
+    entry = journal_entry(attempt, sample, published)
+    for recorder in recorders:
+        recorder.write(entry)
 
 def is_i2c_bus_valid(bus):
     """ _is_i2c_bus_valid """
@@ -419,6 +1080,21 @@ def wwvb(args=None):
 
     #program_name = sys.argv[0]
     program_name = 'wwvb'
+    if len(args) > 0 and args[0] == 'stats':
+        stats(program_name, args[1:])
+        sys.exit(0)
+    if len(args) > 0 and args[0] == 'report':
+        report(program_name, args[1:])
+        sys.exit(0)
+    if len(args) > 0 and args[0] == 'query':
+        query(program_name, args[1:])
+        sys.exit(0)
+    if len(args) > 0 and args[0] == 'collect':
+        collect(program_name, args[1:])
+        sys.exit(0)
+    if len(args) > 0 and args[0] in ('scan', '--scan'):
+        scan(program_name, args[1:])
+        sys.exit(0)
     doit(program_name, args)
 
     sys.exit(0)